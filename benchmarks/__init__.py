@@ -0,0 +1,8 @@
+"""
+Performance benchmarks for the model service
+
+python -m benchmarks runs the suite over a synthetic cohort and emits
+JSON; benchmarks.compare reports regressions between two such runs.
+sqlite_profiles.py separately compares the SQLite engine profiles under
+concurrent load.
+"""
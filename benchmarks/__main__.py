@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Run the benchmark suite and emit the results as JSON
+
+    python -m benchmarks --individuals 200 --variants 5000 --output base.json
+    python -m benchmarks.compare base.json new.json
+
+A synthetic cohort is loaded into a fresh database, then the
+micro-benchmarks and the in-process endpoint benchmarks are run against
+it; worker cold start is timed separately.  The output records the
+parameters, the git commit and the library versions alongside the
+results.
+"""
+import sys
+import os
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tempfile
+
+import sqlalchemy
+
+from python_model_service import orm
+from python_model_service.orm.models import Variant
+from benchmarks import cohort, micro, endpoints, startup
+
+
+def _git_commit():
+    """Current commit, or None outside a git checkout"""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))
+                                       ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _run_cohort(args):
+    """Load the synthetic cohort, and run the benchmarks which use it"""
+    database = args.database or os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+    if os.path.exists(database):
+        os.remove(database)
+    orm.init_db('sqlite:///' + database)
+    session = orm.get_session()
+
+    started = time.perf_counter()
+    ids = cohort.load_cohort(session, args.individuals, args.variants, seed=args.seed)
+    load_seconds = time.perf_counter() - started
+    variants = session.query(Variant.chromosome, Variant.start).all()
+    session.remove()
+
+    results = {'cohort': {'individuals': len(ids['individuals']),
+                          'variants': len(ids['variants']),
+                          'calls': len(ids['calls']),
+                          'load_seconds': round(load_seconds, 3)}}
+    if args.only in (None, 'micro'):
+        results['micro'] = micro.run(session)
+        session.remove()
+    if args.only in (None, 'endpoints'):
+        results['endpoints'] = endpoints.run(ids, variants, args.requests, args.seed,
+                                             args.strict_responses)
+    return results
+
+
+def main(args=None):
+    """Command line entry point"""
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser('python -m benchmarks',
+                                     description='Benchmark the model service')
+    parser.add_argument('--individuals', type=int, default=100)
+    parser.add_argument('--variants', type=int, default=2000)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per endpoint scenario')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', choices=['micro', 'endpoints', 'startup'], default=None)
+    parser.add_argument('--strict-responses', action='store_true',
+                        help='check every response against the spec, as in the tests, '
+                             'rather than a background sample')
+    parser.add_argument('--database', default=None,
+                        help='SQLite file to load the cohort into; a temporary one by default')
+    parser.add_argument('--output', default=None, help='write JSON here rather than stdout')
+    args = parser.parse_args(args)
+
+    results = {}
+    if args.only in (None, 'startup'):
+        results['startup'] = startup.run()
+    if args.only != 'startup':
+        results.update(_run_cohort(args))
+
+    report = {
+        'meta': {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                 'commit': _git_commit(),
+                 'python': platform.python_version(),
+                 'sqlalchemy': sqlalchemy.__version__,
+                 'platform': platform.platform(),
+                 'parameters': vars(args)},
+        'results': results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            outfile.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
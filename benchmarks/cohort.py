@@ -0,0 +1,86 @@
+"""
+Synthetic cohorts for benchmarking
+
+N individuals by M variants spread along a few chromosomes.  Each
+variant gets an alternate allele frequency from a distribution skewed
+towards rare alleles, as in real cohorts, and each individual's genotype
+is drawn from Hardy-Weinberg proportions at that frequency.  As with a
+VCF import, only non-reference genotypes become Call rows, so the call
+matrix is sparse.  The same seed always gives the same cohort.
+"""
+import datetime
+import random
+import uuid
+
+from python_model_service.orm.models import Individual, Variant, Call
+
+BASES = 'ACGT'
+
+# Beta(alpha, beta) for allele frequencies: mean alpha/(alpha+beta), mostly rare
+AF_ALPHA = 0.25
+AF_BETA = 4.0
+
+
+def _uuid(rng):
+    """Reproducible UUID4"""
+    return uuid.UUID(int=rng.getrandbits(128), version=4)
+
+
+def generate_cohort(n_individuals, n_variants, seed=0, chromosomes=('1', '2', '3'),
+                    spacing=100):
+    """
+    Generate the model objects for a cohort
+
+    :param spacing: mean distance between variant positions
+    :return: (individuals, variants, calls) lists of unsaved model objects
+    """
+    rng = random.Random(seed)
+    now = datetime.datetime(2019, 1, 1)
+
+    individuals = [Individual(id=_uuid(rng), description='synthetic individual %d' % i,
+                              created=now, updated=now)
+                   for i in range(n_individuals)]
+
+    variants = []
+    per_chromosome = -(-n_variants // len(chromosomes))
+    for chromosome in chromosomes:
+        position = 1
+        for _ in range(min(per_chromosome, n_variants - len(variants))):
+            position += rng.randint(1, 2 * spacing - 1)
+            ref = rng.choice(BASES)
+            alt = rng.choice(BASES.replace(ref, ''))
+            variants.append(Variant(id=_uuid(rng), chromosome=chromosome, start=position,
+                                    ref=ref, alt=alt, name='rs%d' % (len(variants) + 1),
+                                    created=now, updated=now))
+
+    calls = []
+    for variant in variants:
+        freq = rng.betavariate(AF_ALPHA, AF_BETA)
+        het, hom = 2 * freq * (1 - freq), freq * freq
+        for individual in individuals:
+            draw = rng.random()
+            if draw >= het + hom:
+                continue
+            genotype = '0/1' if draw < het else '1/1'
+            calls.append(Call(id=_uuid(rng), individual_id=individual.id,
+                              variant_id=variant.id, genotype=genotype,
+                              fmt='GQ:DP %d:%d' % (rng.randint(10, 99), rng.randint(5, 60)),
+                              created=now, updated=now))
+
+    return individuals, variants, calls
+
+
+def load_cohort(session, n_individuals, n_variants, seed=0, chunk_size=5000, **kwargs):
+    """
+    Generate a cohort and save it through the session
+
+    :return: dict of the individual, variant and call ids
+    """
+    individuals, variants, calls = generate_cohort(n_individuals, n_variants, seed, **kwargs)
+    for objects in (individuals, variants, calls):
+        for i in range(0, len(objects), chunk_size):
+            session.add_all(objects[i:i + chunk_size])
+            session.commit()
+    return {'individuals': [obj.id for obj in individuals],
+            'variants': [obj.id for obj in variants],
+            'calls': [obj.id for obj in calls]}
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Compare two benchmark reports from python -m benchmarks
+
+    python -m benchmarks.compare base.json new.json --threshold 0.1
+
+Prints the relative change of every timing and throughput figure, and
+exits with status 1 if any got worse by more than the threshold.
+"""
+import sys
+import json
+import argparse
+
+# figures where a larger value is better; for the rest, smaller is better
+HIGHER_IS_BETTER = ('req_per_s', 'ops_per_s')
+COMPARED = HIGHER_IS_BETTER + ('mean_ms', 'p50_ms', 'p90_ms', 'p99_ms', 'us_per_op',
+                               'load_seconds', 'import_seconds', 'ready_seconds')
+
+
+def _figures(results, prefix=''):
+    """Flatten nested results to {'group.name.figure': value}"""
+    figures = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            figures.update(_figures(value, prefix + key + '.'))
+        elif key in COMPARED:
+            figures[prefix + key] = value
+    return figures
+
+
+def compare(base, new, threshold=0.1):
+    """
+    Relative changes between two reports' results
+
+    :return: list of (figure, base value, new value, change, regressed),
+             where change > 0 is always an improvement
+    """
+    base_figures = _figures(base['results'])
+    new_figures = _figures(new['results'])
+    rows = []
+    for name in sorted(set(base_figures) & set(new_figures)):
+        old, value = base_figures[name], new_figures[name]
+        if not old:
+            continue
+        change = (value - old) / old
+        if not name.endswith(HIGHER_IS_BETTER):
+            change = -change
+        rows.append((name, old, value, change, change < -threshold))
+    return rows
+
+
+def main(args=None):
+    """Command line entry point"""
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser('python -m benchmarks.compare',
+                                     description='Compare two benchmark reports')
+    parser.add_argument('base')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='fractional worsening counted as a regression')
+    args = parser.parse_args(args)
+
+    with open(args.base) as infile:
+        base = json.load(infile)
+    with open(args.new) as infile:
+        new = json.load(infile)
+
+    rows = compare(base, new, args.threshold)
+    regressions = 0
+    for name, old, value, change, regressed in rows:
+        regressions += regressed
+        print('%-60s %12g %12g %+7.1f%%%s' % (name, old, value, 100 * change,
+                                              '  REGRESSION' if regressed else ''))
+    print('%d figures compared (%s -> %s), %d regressions' %
+          (len(rows), base['meta'].get('commit'), new['meta'].get('commit'), regressions))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,126 @@
+"""
+End-to-end endpoint benchmarks against the Flask app, in-process
+
+The app is set up as __main__ sets it up by default - request
+validation, and a sample of responses checked against the spec in the
+background - and driven through Flask's test client, so the numbers
+cover connexion, the handlers, serialization and the database, but not
+the HTTP server.  With strict=True every response is checked before it
+is returned, as in the tests.
+"""
+import random
+import time
+
+import connexion
+
+from python_model_service import orm
+from python_model_service.api.cache import OBJECT_CACHE
+from python_model_service.api.spec import load_spec
+from python_model_service.api.validation import VALIDATOR_MAP, configure_validation
+
+
+def create_app(strict=False):
+    """The connexion app, with sessions torn down after each request"""
+    configure_validation(strict=strict)
+    app = connexion.FlaskApp(__name__)
+    db_session = orm.get_session()
+
+    @app.app.teardown_appcontext
+    def shutdown_session(exception=None):  # pylint:disable=unused-variable,unused-argument
+        """Tear down the DB session"""
+        db_session.remove()
+
+    app.add_api(load_spec(), strict_validation=True, validate_responses=True,
+                validator_map=VALIDATOR_MAP)
+    return app
+
+
+def _percentile(ordered, fraction):
+    """Nearest-rank percentile of sorted values"""
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def _measure(client, requests, expect):
+    """
+    Issue (method, url, json) requests in turn
+
+    :return: latency summary in milliseconds, and throughput
+    """
+    latencies = []
+    started = time.perf_counter()
+    for method, url, body in requests:
+        before = time.perf_counter()
+        response = client.open(url, method=method, json=body)
+        latencies.append(time.perf_counter() - before)
+        if response.status_code != expect:
+            raise RuntimeError('%s %s: %d' % (method, url, response.status_code))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {'requests': len(latencies),
+            'req_per_s': round(len(latencies) / elapsed, 1),
+            'mean_ms': round(1000 * sum(latencies) / len(latencies), 3),
+            'p50_ms': round(1000 * _percentile(latencies, 0.50), 3),
+            'p90_ms': round(1000 * _percentile(latencies, 0.90), 3),
+            'p99_ms': round(1000 * _percentile(latencies, 0.99), 3)}
+
+
+def scenarios(ids, variants, n_requests, seed=0):
+    """
+    The benchmarked requests: name -> (list of (method, url, json), expected status)
+
+    :param ids: cohort ids, as returned by cohort.load_cohort
+    :param variants: (chromosome, start) of every variant in the cohort
+    """
+    rng = random.Random(seed)
+
+    def pick(kind):
+        return [rng.choice(ids[kind]) for _ in range(n_requests)]
+
+    def region():
+        chromosome, start = rng.choice(variants)
+        return '/v1/variants?chromosome=%s&start=%d&end=%d&limit=100' % \
+            (chromosome, start, start + 10000)
+
+    return {
+        'get_variants_region': ([('GET', region(), None) for _ in range(n_requests)], 200),
+        'get_one_variant': ([('GET', '/v1/variants/%s' % v, None)
+                             for v in pick('variants')], 200),
+        'get_one_individual': ([('GET', '/v1/individuals/%s' % i, None)
+                                for i in pick('individuals')], 200),
+        'get_individuals_page': ([('GET', '/v1/individuals?limit=100', None)] * n_requests, 200),
+        'get_calls_page': ([('GET', '/v1/calls?limit=100', None)] * n_requests, 200),
+        'get_variants_by_individual': ([('GET', '/v1/individuals/%s/variants?limit=100' % i, None)
+                                        for i in pick('individuals')], 200),
+        'get_individuals_by_variant': ([('GET', '/v1/variants/%s/individuals?limit=100' % v, None)
+                                        for v in pick('variants')], 200),
+        'post_variant': ([('POST', '/v1/variants',
+                           {'chromosome': 'bench', 'start': i + 1, 'ref': 'A', 'alt': 'T',
+                            'name': 'bench%d' % i})
+                          for i in range(n_requests)], 201),
+    }
+
+
+def run(ids, variants, n_requests=200, seed=0, strict=False):
+    """
+    Run every scenario, with the object cache disabled so single-object
+    GETs reach the database, then the single-object GETs again with it on
+
+    :return: dict of scenario name -> latency summary
+    """
+    app = create_app(strict)
+    client = app.app.test_client()
+    results = {}
+
+    maxsize, ttl = OBJECT_CACHE.maxsize, OBJECT_CACHE.ttl
+    try:
+        OBJECT_CACHE.configure(maxsize=0)
+        for name, (requests, expect) in scenarios(ids, variants, n_requests, seed).items():
+            results[name] = _measure(client, requests, expect)
+
+        OBJECT_CACHE.configure(maxsize=max(maxsize, len(ids['variants'])))
+        requests, expect = scenarios(ids, variants, n_requests, seed)['get_one_variant']
+        _measure(client, requests, expect)
+        results['get_one_variant_cached'] = _measure(client, requests, expect)
+    finally:
+        OBJECT_CACHE.configure(maxsize=maxsize, ttl=ttl)
+    return results
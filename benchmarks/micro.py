@@ -0,0 +1,114 @@
+"""
+Micro-benchmarks of the per-object work in the service
+
+orm.dump and the precompiled serializers, GUID conversion in each
+storage form, and history_meta's per-row and set-based versioning.
+"""
+import timeit
+import uuid
+
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.orm import sessionmaker
+
+from python_model_service.orm import dump, guid
+from python_model_service.orm.history_meta import create_version, version_objects
+from python_model_service.orm.models import Variant, Call
+from python_model_service.orm.serializers import serializer
+
+REPEAT = 5
+
+
+def _time(func, number):
+    """Best-of-REPEAT time per call of func, as a result entry"""
+    best = min(timeit.repeat(func, number=number, repeat=REPEAT)) / number
+    return {'us_per_op': round(best * 1e6, 3), 'ops_per_s': round(1.0 / best, 1)}
+
+
+def _dialect(storage):
+    """SQLite dialect with the given GUID storage"""
+    dialect = sqlite.dialect()
+    dialect.guid_storage = storage  # as guid.set_storage does for an engine
+    return dialect
+
+
+def bench_serialization(session, number=20000):
+    """orm.dump vs the precompiled serializer on a loaded Variant"""
+    variant = session.query(Variant).first()
+    ser = serializer(Variant)
+    row = session.query(*ser.columns).filter(Variant.id == variant.id).first()
+    return {
+        'orm_dump': _time(lambda: dump(variant), number),
+        'serializer_from_object': _time(lambda: ser.from_object(variant), number),
+        'serializer_row': _time(lambda: ser(row), number),
+    }
+
+
+def bench_guid(number=100000):
+    """GUID bind and result processing in each storage form"""
+    results = {}
+    value = uuid.uuid4()
+    column_type = guid.GUID()
+    for storage in guid.STORAGE_MODES:
+        dialect = _dialect(storage)
+        stored = column_type.process_bind_param(value, dialect)
+        results['guid_bind_' + storage] = _time(
+            lambda d=dialect: column_type.process_bind_param(value, d), number)
+        results['guid_result_' + storage] = _time(
+            lambda d=dialect, s=stored: column_type.process_result_value(s, d), number)
+    return results
+
+
+def bench_create_version(session, number=2000):
+    """history_meta.create_version for a modified Variant; rolled back afterwards"""
+    variant = session.query(Variant).first()
+    counter = [0]
+
+    def modify_and_version():
+        counter[0] += 1
+        variant.name = 'renamed%d' % counter[0]
+        create_version(variant, session)
+
+    result = _time(modify_and_version, number)
+    session.rollback()
+    return {'create_version': result}
+
+
+def bench_version_flush(session, batch=500, number=5):
+    """
+    Flushing a batch of modified Calls, versioned per row by create_version
+    and set-based by version_objects; rolled back afterwards
+    """
+    # a session without the versioning hook, so each path runs alone
+    plain = sessionmaker(bind=session.get_bind())()
+    calls = plain.query(Call).limit(batch).all()
+    counter = [0]
+
+    def flush(version):
+        counter[0] += 1
+        for call in calls:
+            call.genotype = '%d/1' % (counter[0] % 2)
+        version(calls)
+        plain.flush()
+
+    def per_row(objs):
+        for obj in objs:
+            create_version(obj, plain)
+
+    results = {}
+    for name, version in [('version_flush_per_row', per_row),
+                          ('version_flush_set_based', lambda objs: version_objects(objs, plain))]:
+        results[name] = _time(lambda v=version: flush(v), number)
+        results[name]['rows'] = len(calls)
+    plain.rollback()
+    plain.close()
+    return results
+
+
+def run(session):
+    """All micro-benchmarks, against a session on a loaded cohort"""
+    results = {}
+    results.update(bench_serialization(session))
+    results.update(bench_guid())
+    results.update(bench_create_version(session))
+    results.update(bench_version_flush(session))
+    return results
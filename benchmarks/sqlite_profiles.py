@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Read/write throughput of the SQLite engine profiles
+
+Runs a mixed workload against a fresh database for each configuration:
+one thread committing single-variant inserts, as POST /variants does,
+while reader threads fetch variants by id, as GET /variants/{id} does.
+Prints the operations per second and the number of "database is locked"
+failures for each, as JSON.
+
+    python benchmarks/sqlite_profiles.py --seconds 10 --readers 4
+"""
+import sys
+import os
+import json
+import time
+import uuid
+import random
+import argparse
+import tempfile
+import threading
+
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import scoped_session, sessionmaker
+from python_model_service import orm
+from python_model_service.orm.history_meta import versioned_session
+from python_model_service.orm.models import Variant
+from python_model_service.orm.serializers import serializer
+
+# (name, profile, pool_size)
+CONFIGURATIONS = [
+    ('default', 'default', None),
+    ('wal', 'wal', None),
+    ('wal+pool', 'wal', 8),
+]
+
+
+def _session(engine):
+    """Thread-local versioned sessions, as orm.get_session sets up"""
+    session = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
+    versioned_session(session)
+    return session
+
+
+def _new_variant(i):
+    """A synthetic variant"""
+    return Variant(id=uuid.uuid4(), chromosome=str(1 + i % 22), start=1000 + i * 10,
+                   ref='A', alt='T', name='rs%d' % i, created=None, updated=None)
+
+
+def _populate(session, nvariants):
+    """Fill the database, returning the variant ids"""
+    ids = []
+    for i in range(nvariants):
+        variant = _new_variant(i)
+        ids.append(variant.id)
+        session.add(variant)
+    session.commit()
+    session.remove()
+    return ids
+
+
+def run(profile, pool_size, seconds, readers, nvariants):
+    """
+    Run the workload against a temporary database
+
+    :return: dict of throughputs and failure counts
+    """
+    tmpdir = tempfile.mkdtemp()
+    engine = orm.make_engine('sqlite:///' + os.path.join(tmpdir, 'bench.db'),
+                             pragmas=orm.sqlite_pragmas(profile), pool_size=pool_size)
+    session = _session(engine)
+    ids = _populate(session, nvariants)
+    ser = serializer(Variant)
+
+    stop = threading.Event()
+    counts = {'reads': 0, 'writes': 0, 'read_errors': 0, 'write_errors': 0}
+    lock = threading.Lock()
+
+    def writer():
+        """Commit one insert at a time"""
+        i = nvariants
+        while not stop.is_set():
+            try:
+                session.add(_new_variant(i))
+                session.commit()
+                key = 'writes'
+            except OperationalError:
+                session.rollback()
+                key = 'write_errors'
+            session.remove()
+            i += 1
+            with lock:
+                counts[key] += 1
+
+    def reader():
+        """Fetch variants by id"""
+        rng = random.Random()
+        while not stop.is_set():
+            try:
+                row = session.query(*ser.columns).filter(Variant.id == rng.choice(ids)).first()
+                ser(row)
+                key = 'reads'
+            except OperationalError:
+                session.rollback()
+                key = 'read_errors'
+            session.remove()
+            with lock:
+                counts[key] += 1
+
+    threads = [threading.Thread(target=writer)] + \
+        [threading.Thread(target=reader) for _ in range(readers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    engine.dispose()
+
+    return {'reads_per_s': round(counts['reads'] / elapsed, 1),
+            'writes_per_s': round(counts['writes'] / elapsed, 1),
+            'read_errors': counts['read_errors'],
+            'write_errors': counts['write_errors']}
+
+
+def main(args=None):
+    """Command line entry point"""
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser('sqlite_profiles',
+                                     description='Compare SQLite engine profiles')
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--variants', type=int, default=10000)
+    args = parser.parse_args(args)
+
+    results = {}
+    for name, profile, pool_size in CONFIGURATIONS:
+        results[name] = run(profile, pool_size, args.seconds, args.readers, args.variants)
+    print(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
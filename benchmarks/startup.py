@@ -0,0 +1,64 @@
+"""
+Worker cold start: time to import the service, and to have the app ready
+
+Each run is a fresh interpreter, so nothing is already imported; the
+parsed spec cache is written beforehand, as it would be in a deployed
+image.  The budgets are deliberately generous - they are enforced by
+the test suite, and are there to catch a heavy import or parse creeping
+back onto the startup path, not to measure small changes.
+"""
+import sys
+import json
+import statistics
+import subprocess
+
+from python_model_service.api import spec
+
+# seconds, from the first import to the end of each phase
+BUDGET = {'import_seconds': 2.0, 'ready_seconds': 3.0}
+
+# modules which should only be loaded once they are needed
+DEFERRED = ('bravado_core.spec', 'tornado.options')
+
+_SCRIPT = '''
+import sys, json, time
+started = time.perf_counter()
+import python_model_service.api.operations
+result = {"import_seconds": time.perf_counter() - started,
+          "loaded": [name for name in %(deferred)r if name in sys.modules]}
+if %(app)r:
+    import connexion
+    from python_model_service.api.spec import load_spec
+    from python_model_service.api.validation import VALIDATOR_MAP
+    app = connexion.FlaskApp("python_model_service")
+    app.add_api(load_spec(), strict_validation=True, validate_responses=True,
+                validator_map=VALIDATOR_MAP)
+    result["ready_seconds"] = time.perf_counter() - started
+print(json.dumps(result))
+'''
+
+
+def cold_start(app=True):
+    """One fresh interpreter's import (and app setup) times"""
+    output = subprocess.check_output(
+        [sys.executable, '-c', _SCRIPT % {'deferred': DEFERRED, 'app': app}],
+        stderr=subprocess.DEVNULL)
+    return json.loads(output.decode().splitlines()[-1])
+
+
+def run(repeat=5, app=True):
+    """
+    Median times over `repeat` cold starts
+
+    :param app: also build the connexion app, as a worker does
+    :return: dict of phase -> seconds, and the deferred modules which
+             were loaded anyway
+    """
+    spec.compile_spec()
+    runs = [cold_start(app) for _ in range(repeat)]
+    result = {phase: round(statistics.median(one[phase] for one in runs), 3)
+              for phase in BUDGET if phase in runs[0]}
+    result['loaded'] = sorted(set().union(*(one['loaded'] for one in runs)))
+    result['over_budget'] = sorted(phase for phase, limit in BUDGET.items()
+                                   if result.get(phase, 0) > limit)
+    return result
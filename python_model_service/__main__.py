@@ -2,13 +2,74 @@
 """
 Driver program for service
 """
+import os
 import sys
 import argparse
 import logging
-import pkg_resources
 import connexion
 from tornado.options import define
 import python_model_service.orm
+from python_model_service.api.cache import OBJECT_CACHE, DEFAULT_TTL
+from python_model_service.api.logging import start_log_writer, configure_apilog
+from python_model_service.api.exports import configure_exports
+from python_model_service.api.spec import load_spec
+from python_model_service.api.validation import VALIDATOR_MAP, DEFAULT_SAMPLE_RATE
+from python_model_service.api.validation import configure_validation
+from python_model_service.api.streaming import CompressionMiddleware, DEFAULT_LEVEL
+from python_model_service.server import serve, DEFAULT_QUEUE_DEPTH
+
+
+def import_vcf(args):
+    """Bulk load a VCF"""
+    import python_model_service.vcf
+    return python_model_service.vcf.main(args)
+
+
+def migrate_guids(args):
+    """Rewrite a DB with a different GUID or genotype storage"""
+    import python_model_service.orm.migrate
+    return python_model_service.orm.migrate.main(args)
+
+
+def worker_logfile(logfile, worker_id):
+    """Log file for one of several worker processes"""
+    base, ext = os.path.splitext(logfile)
+    return '%s.worker%d%s' % (base, worker_id, ext)
+
+
+def compact_history(args):
+    """Drop old versions from the history tables"""
+    import python_model_service.orm.history
+    return python_model_service.orm.history.main(args)
+
+
+def rebuild_stats(args):
+    """Recompute the per-variant allele statistics"""
+    import python_model_service.orm.stats
+    return python_model_service.orm.stats.main(args)
+
+
+def export_matrix(args):
+    """Export the calls as a genotype matrix"""
+    import python_model_service.export
+    return python_model_service.export.main(args)
+
+
+def compile_spec(args):
+    """Parse the API spec ahead of time"""
+    import python_model_service.api.spec
+    return python_model_service.api.spec.main(args)
+
+
+# subcommands, given as the first argument; otherwise run the service
+COMMANDS = {
+    'import-vcf': import_vcf,
+    'migrate-guids': migrate_guids,
+    'compact-history': compact_history,
+    'compile-spec': compile_spec,
+    'export-matrix': export_matrix,
+    'rebuild-stats': rebuild_stats,
+}
 
 
 def main(args=None):
@@ -16,42 +77,141 @@ def main(args=None):
     if args is None:
         args = sys.argv[1:]
 
+    if args and args[0] in COMMANDS:
+        return COMMANDS[args[0]](args[1:])
+
     parser = argparse.ArgumentParser('Run python model service')
     parser.add_argument('--database', default="./data/model_service.sqlite")
     parser.add_argument('--port', default=3000)
     parser.add_argument('--logfile', default="./log/model_service.log")
     parser.add_argument('--loglevel', default='INFO',
                         choices=['DEBUG', 'INFO', 'WARN', 'ERROR', 'CRITICAL'])
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes serving requests; SIGHUP restarts them')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='run requests on a pool of this many threads per worker; '
+                             '0 runs them one at a time on the event loop')
+    parser.add_argument('--thread-queue-depth', type=int, default=DEFAULT_QUEUE_DEPTH,
+                        help='with --threads, requests to queue before answering 503')
+    parser.add_argument('--async-reads', action='store_true',
+                        help='serve the region, single-object and cross-reference GETs '
+                             'from the event loop with aiosqlite (Python 3.6+)')
+    parser.add_argument('--async-connections', type=int, default=4,
+                        help='with --async-reads, SQLite connections per worker')
+    parser.add_argument('--db-profile', default='default',
+                        choices=sorted(python_model_service.orm.SQLITE_PROFILES),
+                        help='SQLite PRAGMA profile; "wal" for concurrent readers/writers')
+    parser.add_argument('--db-journal-mode', default=None,
+                        choices=['DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'])
+    parser.add_argument('--db-synchronous', default=None,
+                        choices=['OFF', 'NORMAL', 'FULL', 'EXTRA'])
+    parser.add_argument('--db-cache-size', type=int, default=None,
+                        help='SQLite page cache; pages if positive, KiB if negative')
+    parser.add_argument('--db-mmap-size', type=int, default=None,
+                        help='bytes of the DB file to memory-map')
+    parser.add_argument('--db-busy-timeout', type=int, default=None,
+                        help='milliseconds to wait on a locked DB before failing')
+    parser.add_argument('--db-pool-size', type=int, default=None,
+                        help='SQLite connections to keep open for reuse')
+    parser.add_argument('--log-max-bytes', type=int, default=10*1024*1024,
+                        help='rotate the log file when it reaches this size')
+    parser.add_argument('--log-backups', type=int, default=5,
+                        help='number of rotated log files to keep')
+    parser.add_argument('--log-sample-rate', type=float, default=1.0,
+                        help='fraction of API requests to log')
+    parser.add_argument('--log-max-body', type=int, default=1024,
+                        help='maximum bytes of request body to log')
+    parser.add_argument('--log-queue-size', type=int, default=10000,
+                        help='log records buffered for the writer thread before dropping')
+    parser.add_argument('--cache-size', type=int, default=0,
+                        help='max objects in the single-object GET cache (eg 10000); '
+                             'single process only, so not with --workers; 0 disables it')
+    parser.add_argument('--cache-ttl', type=float, default=DEFAULT_TTL,
+                        help='seconds before a cached object is re-read')
+    parser.add_argument('--compress-level', type=int, default=DEFAULT_LEVEL,
+                        choices=range(10), metavar='0-9',
+                        help='zlib level for gzip/deflate responses; 0 disables compression')
+    parser.add_argument('--export-dir', default='./data/exports',
+                        help='directory genotype matrix exports are written under')
+    parser.add_argument('--strict-responses', action='store_true',
+                        help='check every response against the API spec before sending it, '
+                             'replacing invalid ones with a 500 (for testing)')
+    parser.add_argument('--validate-sample-rate', type=float, default=DEFAULT_SAMPLE_RATE,
+                        help='fraction of responses checked against the API spec '
+                             'in the background')
+    parser.add_argument('--validate-operations', default='',
+                        help='comma-separated operations whose responses are always checked, '
+                             'named as in the metrics (eg get_variants)')
     args = parser.parse_args(args)
+    if args.cache_size and args.workers > 1:
+        # writes only invalidate the cache of the worker making them
+        parser.error('--cache-size can only be used with a single worker')
 
     # set up the application
     app = connexion.FlaskApp(__name__, server='tornado')
     define("dbfile", default=args.database)
-    python_model_service.orm.init_db()
-    db_session = python_model_service.orm.get_session()
+    pragmas = python_model_service.orm.sqlite_pragmas(
+        args.db_profile, journal_mode=args.db_journal_mode,
+        synchronous=args.db_synchronous, cache_size=args.db_cache_size,
+        mmap_size=args.db_mmap_size, busy_timeout=args.db_busy_timeout)
+
+    # create any missing tables once, before any workers start
+    python_model_service.orm.init_db(pragmas=pragmas, pool_size=args.db_pool_size)
+    if args.workers > 1:
+        # SQLite connections must not be carried across a fork
+        python_model_service.orm.dispose_engine()
 
-    @app.app.teardown_appcontext
-    def shutdown_session(exception=None):  # pylint:disable=unused-variable,unused-argument
+    numeric_loglevel = getattr(logging, args.loglevel.upper())
+    app.app.logger.setLevel(numeric_loglevel)
+    configure_apilog(sample_rate=args.log_sample_rate, max_body=args.log_max_body)
+    configure_exports(directory=args.export_dir)
+    configure_validation(strict=args.strict_responses, sample_rate=args.validate_sample_rate,
+                         operations=[op for op in args.validate_operations.split(',') if op])
+
+    # add the swagger APIs, from the parsed spec cached by api.spec
+    app.add_api(load_spec(), strict_validation=True, validate_responses=True,
+                validator_map=VALIDATOR_MAP)
+    if args.compress_level:
+        app.app.wsgi_app = CompressionMiddleware(app.app.wsgi_app, level=args.compress_level)
+
+    def setup_worker(worker_id):
         """
-        Tear down the DB session
+        Per-process state, set up in each worker: DB engine and session
+        registry, object cache, and the background log writer
         """
-        db_session.remove()
+        logfile = args.logfile
+        if args.workers > 1:
+            python_model_service.orm.init_db(pragmas=pragmas, pool_size=args.db_pool_size)
+            logfile = worker_logfile(args.logfile, worker_id)
+        db_session = python_model_service.orm.get_session()
+        OBJECT_CACHE.configure(maxsize=args.cache_size, ttl=args.cache_ttl)
 
-    # configure logging
-    log_handler = logging.FileHandler(args.logfile)
-    numeric_loglevel = getattr(logging, args.loglevel.upper())
-    log_handler.setLevel(numeric_loglevel)
+        @app.app.teardown_appcontext
+        def shutdown_session(exception=None):  # pylint:disable=unused-variable,unused-argument
+            """
+            Tear down the DB session
+            """
+            db_session.remove()
 
-    app.app.logger.addHandler(log_handler)
-    app.app.logger.setLevel(numeric_loglevel)
+        # logging is written by a background thread, off the request path
+        log_writer = start_log_writer(app.app.logger, logfile, numeric_loglevel,
+                                      max_bytes=args.log_max_bytes,
+                                      backup_count=args.log_backups,
+                                      queue_size=args.log_queue_size)
+        return log_writer.stop
 
-    # add the swagger APIs
-    api_def = pkg_resources.resource_filename('python_model_service',
-                                              'api/swagger.yaml')
-    app.add_api(api_def, strict_validation=True, validate_responses=True)
+    routes, on_stop = None, None
+    if args.async_reads:
+        import python_model_service.api.async_operations as async_operations
+        async_db = async_operations.AsyncDB(args.database, size=args.async_connections,
+                                            pragmas=pragmas)
+        routes, on_stop = async_operations.routes(async_db, app.app.logger), async_db.close
 
-    app.run(port=args.port)
+    serve(app.app, args.port, workers=args.workers, setup=setup_worker,
+          threads=args.threads, queue_depth=args.thread_queue_depth,
+          routes=routes, on_stop=on_stop, compress=bool(args.compress_level))
+    return 0
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
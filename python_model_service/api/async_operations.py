@@ -0,0 +1,503 @@
+"""
+Asyncio read path for the hot GET endpoints
+
+get_variants, get_one_* and the two cross-reference endpoints, served by
+tornado request handlers on the event loop rather than through the WSGI
+app.  Queries are built with the same SQLAlchemy expressions as
+api/operations.py, compiled for the engine's SQLite dialect, and run on a
+small pool of aiosqlite connections, so many requests can be waiting on
+the database without a thread each.  Results are serialized, paginated,
+cached, logged and given ETags as on the synchronous path; streamed
+responses and long pages are flushed to the client chunk by chunk, and
+gzipped if the server was started with compression.
+
+Parameters are checked against the same constraints as the swagger spec,
+with errors in connexion's problem+json form, but responses are not
+validated against the spec.  Every other method and path falls through
+to the WSGI app.
+"""
+import json
+import time
+import uuid
+import asyncio
+import sqlite3
+
+import tornado.web
+from sqlalchemy.orm import Query
+
+try:
+    import aiosqlite
+except ImportError:  # pragma: no cover
+    aiosqlite = None
+
+from python_model_service import orm
+from python_model_service.orm import models
+from python_model_service.orm.serializers import serializer
+from python_model_service.api.models import BASEPATH
+from python_model_service.api.operations import region_filter
+from python_model_service.api.pagination import paginate, encode_token, next_link
+from python_model_service.api.pagination import PageTokenError
+from python_model_service.api.streaming import YIELD_PER, BATCH_ROWS, json_array
+from python_model_service.api.cache import OBJECT_CACHE, cache_key
+from python_model_service.api import etags
+from python_model_service.api.logging import request_entry, sampled, log_entry
+from python_model_service.api.logging import structured_log as struct_log
+from python_model_service.api.metrics import METRICS
+
+DEFAULT_CONNECTIONS = 4
+
+# query parameters of the list endpoints: name: (type, required, minimum, maximum)
+_PAGE_PARAMS = {
+    'limit': (int, False, 1, 100000),
+    'after': (str, False, None, None),
+    'stream': (bool, False, None, None),
+}
+_VARIANT_PARAMS = dict(_PAGE_PARAMS, chromosome=(str, True, None, None),
+                       start=(int, True, None, None), end=(int, True, None, None))
+
+
+class AsyncDB(object):
+    """
+    Pool of read-only aiosqlite connections to the service's database,
+    opened as needed on the running event loop
+    """
+    def __init__(self, database, size=DEFAULT_CONNECTIONS, pragmas=None):
+        if aiosqlite is None:
+            raise RuntimeError('the async read path requires the aiosqlite package')
+        self.database = database
+        self.size = size
+        self.pragmas = pragmas or {}
+        self._idle = None
+        self._opened = 0
+        self._connections = []
+
+    async def _connect(self):
+        """Open a connection with the profile's PRAGMAs, refusing writes"""
+        self._opened += 1
+        conn = await aiosqlite.connect(self.database)
+        for name, value in self.pragmas.items():
+            await conn.execute("PRAGMA %s = %s" % (name, value))
+        await conn.execute("PRAGMA query_only = 1")
+        self._connections.append(conn)
+        return conn
+
+    async def acquire(self):
+        """Take a connection, waiting for one if all are in use"""
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+        if self._idle.empty() and self._opened < self.size:
+            return await self._connect()
+        return await self._idle.get()
+
+    def release(self, conn):
+        """Return a connection taken with acquire()"""
+        self._idle.put_nowait(conn)
+
+    def connection(self):
+        """Borrow a connection, as an async context manager"""
+        return _Borrowed(self)
+
+    async def fetch(self, statement):
+        """All rows of a compiled statement"""
+        async with self.connection() as conn:
+            async with conn.execute(statement.sql, statement.params) as cursor:
+                rows = await cursor.fetchall()
+        return [statement.convert(row) for row in rows]
+
+    async def close(self):
+        """Close all connections"""
+        for conn in self._connections:
+            await conn.close()
+        self._connections = []
+        self._opened = 0
+        self._idle = None
+
+
+class _Borrowed(object):
+    """A connection borrowed from an AsyncDB for an async with block"""
+    def __init__(self, db):
+        self.db = db
+        self.conn = None
+
+    async def __aenter__(self):
+        self.conn = await self.db.acquire()
+        return self.conn
+
+    async def __aexit__(self, *exc_info):
+        self.db.release(self.conn)
+        self.conn = None
+
+
+class Statement(object):
+    """
+    A SQLAlchemy query compiled for the engine's dialect: SQL text,
+    positional parameters with the column types' bind processing applied,
+    and a converter applying their result processing to each row
+    """
+    def __init__(self, query, dialect):
+        compiled = query.statement.compile(dialect=dialect)
+        values = compiled.construct_params()
+        self.sql = str(compiled)
+        self.params = []
+        for name in compiled.positiontup:
+            process = compiled.binds[name].type.dialect_impl(dialect).bind_processor(dialect)
+            self.params.append(process(values[name]) if process else values[name])
+        self._processors = [col.type.dialect_impl(dialect).result_processor(dialect, None)
+                            for col in query.statement.inner_columns]
+
+    def convert(self, row):
+        """Result row with column values converted to Python types"""
+        return tuple(process(value) if process else value
+                     for process, value in zip(self._processors, row))
+
+
+class _BadRequest(Exception):
+    """Request parameters don't match the spec"""
+
+
+def _parse_uuid(name, value):
+    """UUID path parameter"""
+    try:
+        return uuid.UUID(value)
+    except ValueError:
+        raise _BadRequest("'%s' is not a 'uuid' for path parameter '%s'" % (value, name))
+
+
+class ReadHandler(tornado.web.RequestHandler):  # pylint:disable=abstract-method
+    """
+    Base for the async GET handlers; anything but a GET, or a GET with
+    any of the fallback_params, is passed on to the WSGI app.  GETs are
+    recorded in the request metrics under the name of the equivalent
+    operation in api/operations.py.
+    """
+    params = {}
+    fallback_params = ()
+    operation = None
+
+    def initialize(self, db, logger, fallback):  # pylint:disable=arguments-differ
+        self.db = db  # pylint:disable=attribute-defined-outside-init
+        self.logger = logger  # pylint:disable=attribute-defined-outside-init
+        self.fallback = fallback  # pylint:disable=attribute-defined-outside-init
+        self.tracker = None  # pylint:disable=attribute-defined-outside-init
+
+    def prepare(self):
+        if self.request.method != 'GET' or \
+           any(name in self.request.query_arguments for name in self.fallback_params):
+            self.fallback(self.request)
+            self._finished = True  # pylint:disable=attribute-defined-outside-init
+            self.on_finish()
+            return
+        # pylint:disable=attribute-defined-outside-init
+        self.tracker = METRICS.start(self.operation)
+        if sampled():
+            log_entry(self.logger, request_entry(
+                self.request.method, self.request.uri, self.request.body,
+                self.request.remote_ip, self.request.headers))
+
+    def on_finish(self):
+        if self.tracker is not None:
+            self.tracker.finish(self.get_status())
+
+    def compute_etag(self):
+        return None
+
+    async def fetch(self, statement):
+        """All rows of a compiled statement, charging the time to this request"""
+        started = time.perf_counter()
+        try:
+            return await self.db.fetch(statement)
+        finally:
+            self.tracker.db_time += time.perf_counter() - started
+
+    def query_args(self):
+        """Query parameters, checked and converted per self.params"""
+        extra = set(self.request.query_arguments) - set(self.params)
+        if extra:
+            raise _BadRequest('Extra query parameter(s) %s not in spec' % ', '.join(sorted(extra)))
+        args = {}
+        for name, (kind, required, minimum, maximum) in self.params.items():
+            value = self.get_query_argument(name, None)
+            if value is None:
+                if required:
+                    raise _BadRequest("Missing query parameter '%s'" % name)
+                continue
+            try:
+                if kind is bool:
+                    if value.lower() not in ('true', 'false'):
+                        raise ValueError(value)
+                    value = value.lower() == 'true'
+                else:
+                    value = kind(value)
+            except ValueError:
+                raise _BadRequest("Wrong type, expected '%s' for query parameter '%s'" %
+                                  ({int: 'integer', bool: 'boolean'}.get(kind, 'string'), name))
+            if minimum is not None and value < minimum:
+                raise _BadRequest('%s is less than the minimum of %d' % (value, minimum))
+            if maximum is not None and value > maximum:
+                raise _BadRequest('%s is greater than the maximum of %d' % (value, maximum))
+            args[name] = value
+        return args
+
+    def write_json(self, body, status=200):
+        """Write a complete JSON response"""
+        self.set_status(status)
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps(body))
+
+    def not_modified(self, etag):
+        """
+        Set the ETag; if the request's If-None-Match matches it, write
+        a 304 and return True
+        """
+        self.set_header('ETag', etag)
+        if etags.not_modified(self.request.headers.get('If-None-Match'), etag):
+            self.set_status(304)
+            self.finish()
+            return True
+        return False
+
+    def write_error_json(self, message, code):
+        """Write an API Error"""
+        self.write_json({'message': message, 'code': code}, code)
+
+    def write_bad_request(self, detail):
+        """Write a parameter validation error as connexion does"""
+        self.set_status(400)
+        self.set_header('Content-Type', 'application/problem+json')
+        self.finish(json.dumps({'detail': detail, 'status': 400,
+                                'title': 'Bad Request', 'type': 'about:blank'}))
+
+    def report_search_failed(self, typename, exception, **kwargs):
+        """Log and write an internal search error, as operations does"""
+        self.logger.error(struct_log(action=typename + ' search failed',
+                                     exception=str(exception), **kwargs))
+        self.write_error_json('Internal error searching for ' + typename + 's', 500)
+
+    def next_link(self, last):
+        """Link header value for the page after the given key"""
+        req = self.request
+        args = {name: values[0].decode('utf-8')
+                for name, values in req.query_arguments.items()}
+        return next_link(encode_token(last), req.protocol + '://' + req.host + req.path, args)
+
+    async def exists(self, column, object_id):
+        """Is there a row with this id?"""
+        query = Query([column]).filter(column == object_id).limit(1)
+        return bool(await self.fetch(Statement(query, orm.get_engine().dialect)))
+
+    async def write_list(self, query, key, ser,  # pylint:disable=too-many-arguments
+                         key_index, limit=None, stream=False):
+        """
+        Write a paginated list as operations._list_response does
+
+        :param key_index: positions of the key values in the result rows
+        """
+        dialect = orm.get_engine().dialect
+        if stream:
+            if limit:
+                # look ahead at just the key columns to find where the page ends
+                ends = await self.fetch(Statement(
+                    query.with_entities(*key).offset(limit - 1).limit(2), dialect))
+                if len(ends) > 1:
+                    self.set_header('Link', self.next_link(ends[0]))
+                query = query.limit(limit)
+            return await self.stream_rows(Statement(query, dialect), ser)
+
+        link = None
+        if limit:
+            rows = await self.fetch(Statement(query.limit(limit + 1), dialect))
+            if len(rows) > limit:
+                rows = rows[:limit]
+                link = self.next_link([rows[-1][i] for i in key_index])
+                self.set_header('Link', link)
+        else:
+            rows = await self.fetch(Statement(query, dialect))
+
+        etag = etags.list_etag(rows, ser.keys.index('id'), ser.keys.index('version'), link)
+        if self.not_modified(etag):
+            return None
+        if len(rows) <= BATCH_ROWS:
+            return self.write_json([ser(row) for row in rows])
+
+        # a long page is encoded and sent a batch of rows at a time
+        self.set_header('Content-Type', 'application/json')
+        for chunk in json_array(rows, ser):
+            self.write(chunk)
+            await self.flush()
+        return self.finish()
+
+    async def stream_rows(self, statement, ser):
+        """Write all rows as a JSON array, flushing as they are fetched"""
+        self.set_header('Content-Type', 'application/json')
+        separator = '['
+        async with self.db.connection() as conn:
+            async with conn.execute(statement.sql, statement.params) as cursor:
+                while True:
+                    started = time.perf_counter()
+                    rows = await cursor.fetchmany(YIELD_PER)
+                    self.tracker.db_time += time.perf_counter() - started
+                    if not rows:
+                        break
+                    batch = json.dumps([ser(statement.convert(row)) for row in rows])
+                    self.write(separator + batch[1:-1])
+                    separator = ','
+                    await self.flush()
+        self.finish('[]' if separator == '[' else ']')
+
+
+class VariantsHandler(ReadHandler):  # pylint:disable=abstract-method
+    """GET /variants"""
+    params = _VARIANT_PARAMS
+    # the statistics are joined in on the WSGI path
+    fallback_params = ('stats',)
+    operation = 'get_variants'
+
+    async def get(self):
+        try:
+            args = self.query_args()
+        except _BadRequest as e:
+            return self.write_bad_request(str(e))
+        chromosome, start, end = args['chromosome'], args['start'], args['end']
+
+        ser = serializer(models.Variant)
+        key = [models.Variant.start, models.Variant.id]
+        try:
+            q = region_filter(Query(ser.columns), chromosome, start, end)
+            q = paginate(q, key, args.get('after'))
+            key_index = [ser.keys.index('start'), ser.keys.index('id')]
+            return await self.write_list(q, key, ser, key_index,
+                                         args.get('limit'), args.get('stream'))
+        except PageTokenError as e:
+            self.logger.warning(struct_log(action='variant: invalid page token',
+                                           exception=str(e), after=args.get('after')))
+            return self.write_error_json(str(e), 400)
+        except sqlite3.Error as e:
+            return self.report_search_failed('variant', e, chromosome=chromosome,
+                                             start=start, end=end)
+
+
+class OneObjectHandler(ReadHandler):  # pylint:disable=abstract-method
+    """GET /variants/{id}, /individuals/{id} and /calls/{id}"""
+    # point-in-time reads go to the history tables, through the WSGI app
+    fallback_params = ('as_of',)
+
+    def initialize(self, db, logger, fallback, model):  # pylint:disable=arguments-differ
+        super(OneObjectHandler, self).initialize(db, logger, fallback)
+        self.model = model  # pylint:disable=attribute-defined-outside-init
+        self.operation = 'get_one_' + model.__name__.lower()
+
+    async def get(self, object_id):
+        typename = self.model.__name__.lower()
+        try:
+            object_id = _parse_uuid(typename + '_id', object_id)
+            self.query_args()
+        except _BadRequest as e:
+            return self.write_bad_request(str(e))
+
+        key = cache_key(typename, object_id)
+        cached = OBJECT_CACHE.get(key)
+        if cached is not None:
+            if self.not_modified(etags.object_etag(cached['version'])):
+                return None
+            return self.write_json(cached)
+
+        ser = serializer(self.model)
+        q = Query(ser.columns).filter(self.model.id == object_id).limit(1)
+        try:
+            rows = await self.fetch(Statement(q, orm.get_engine().dialect))
+        except sqlite3.Error as e:
+            return self.report_search_failed(typename, e, id=str(object_id))
+
+        if not rows:
+            return self.write_error_json('No %s found: %s' % (typename, object_id), 404)
+
+        if self.not_modified(etags.object_etag(rows[0][ser.keys.index('version')])):
+            return None
+        result = ser(rows[0])
+        OBJECT_CACHE.put(key, result)
+        return self.write_json(result)
+
+
+class VariantsByIndividualHandler(ReadHandler):  # pylint:disable=abstract-method
+    """GET /individuals/{id}/variants"""
+    params = _PAGE_PARAMS
+    operation = 'get_variants_by_individual'
+
+    async def get(self, individual_id):
+        try:
+            ind_id = _parse_uuid('individual_id', individual_id)
+            args = self.query_args()
+        except _BadRequest as e:
+            return self.write_bad_request(str(e))
+
+        try:
+            if not await self.exists(models.Individual.id, ind_id):
+                return self.write_error_json('No individual found: ' + str(ind_id), 404)
+
+            ser = serializer(models.Variant)
+            key = [models.Call.variant_id]
+            q = Query(ser.columns)\
+                .join(models.Call, models.Call.variant_id == models.Variant.id)\
+                .filter(models.Call.individual_id == ind_id)
+            q = paginate(q, key, args.get('after'))
+            return await self.write_list(q, key, ser, [ser.keys.index('id')],
+                                         args.get('limit'), args.get('stream'))
+        except PageTokenError as e:
+            return self.write_error_json(str(e), 400)
+        except sqlite3.Error as e:
+            return self.report_search_failed('variant', e, by_individual_id=str(ind_id))
+
+
+class IndividualsByVariantHandler(ReadHandler):  # pylint:disable=abstract-method
+    """GET /variants/{id}/individuals"""
+    params = _PAGE_PARAMS
+    operation = 'get_individuals_by_variant'
+
+    async def get(self, variant_id):
+        try:
+            var_id = _parse_uuid('variant_id', variant_id)
+            args = self.query_args()
+        except _BadRequest as e:
+            return self.write_bad_request(str(e))
+
+        try:
+            if not await self.exists(models.Variant.id, var_id):
+                return self.write_error_json('No variant found: ' + str(var_id), 404)
+
+            ser = serializer(models.Individual)
+            key = [models.Call.individual_id]
+            q = Query(ser.columns)\
+                .join(models.Call, models.Call.individual_id == models.Individual.id)\
+                .filter(models.Call.variant_id == var_id)
+            q = paginate(q, key, args.get('after'))
+            return await self.write_list(q, key, ser, [ser.keys.index('id')],
+                                         args.get('limit'), args.get('stream'))
+        except PageTokenError as e:
+            return self.write_error_json(str(e), 400)
+        except sqlite3.Error as e:
+            return self.report_search_failed('individual', e, by_variant_id=str(var_id))
+
+
+def routes(db, logger):
+    """
+    Tornado routing rules for the async read endpoints, as a function of
+    the WSGI container which non-GET requests are passed on to
+    """
+    def rules(fallback):
+        """Rules for the endpoints, falling back to the given container"""
+        common = {'db': db, 'logger': logger, 'fallback': fallback}
+        uuid_part = r'([^/:]+)'
+        return [
+            (BASEPATH + r'/variants', VariantsHandler, common),
+            (BASEPATH + r'/variants/' + uuid_part, OneObjectHandler,
+             dict(common, model=models.Variant)),
+            (BASEPATH + r'/individuals/' + uuid_part, OneObjectHandler,
+             dict(common, model=models.Individual)),
+            (BASEPATH + r'/calls/' + uuid_part, OneObjectHandler,
+             dict(common, model=models.Call)),
+            (BASEPATH + r'/individuals/' + uuid_part + r'/variants',
+             VariantsByIndividualHandler, common),
+            (BASEPATH + r'/variants/' + uuid_part + r'/individuals',
+             IndividualsByVariantHandler, common),
+        ]
+    return rules
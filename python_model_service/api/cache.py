@@ -0,0 +1,134 @@
+"""
+Bounded in-process read-through cache for single-object GETs
+
+Entries are the serialized API dicts, keyed by (type, id), and are
+dropped when least recently used, when older than the TTL, or when the
+object is written: the put_/delete_ operations invalidate explicitly
+after committing, and any flush which bumps a Versioned object's
+version (or deletes it) invalidates it too.
+
+The cache is off unless configured with a size, and is only for a
+service running as a single process: writes are only seen by the cache
+of the process making them, and bulk Query.update()/delete() calls and
+raw SQL writes not at all, so another process's cache (or this one,
+after a bulk write) can serve stale or deleted objects until the TTL
+expires.
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from sqlalchemy import event
+from python_model_service.orm.history_meta import Versioned
+from python_model_service.api.metrics import METRICS
+
+# off by default; see above
+DEFAULT_MAXSIZE = 0
+DEFAULT_TTL = 60.0
+
+
+class ObjectCache(object):
+    """
+    Thread-safe LRU cache with a per-entry time to live, and
+    hit/miss/eviction counters
+    """
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, ttl=DEFAULT_TTL, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = self.misses = self.evictions = self.expirations = self.invalidations = 0
+
+    def get(self, key):
+        """Cached value for key, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires = entry
+            if expires <= self._clock():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Cache value for key, evicting the least recently used entries if full"""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, self._clock() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Drop any entry for key"""
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        """Drop all entries"""
+        with self._lock:
+            self._entries.clear()
+
+    def configure(self, maxsize=None, ttl=None):
+        """Change the size or TTL; clears the cache"""
+        with self._lock:
+            if maxsize is not None:
+                self.maxsize = maxsize
+            if ttl is not None:
+                self.ttl = ttl
+            self._entries.clear()
+
+    def stats(self):
+        """Counters and current size"""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'expirations': self.expirations,
+                    'invalidations': self.invalidations,
+                    'size': len(self._entries), 'maxsize': self.maxsize,
+                    'ttl': self.ttl}
+
+
+OBJECT_CACHE = ObjectCache()
+
+
+def cache_key(typename, object_id):
+    """
+    Cache key for an object, or None if the id isn't a valid UUID
+    """
+    try:
+        return (typename, object_id if isinstance(object_id, uuid.UUID)
+                else uuid.UUID(str(object_id)))
+    except ValueError:
+        return None
+
+
+@event.listens_for(Versioned, "after_update", propagate=True)
+@event.listens_for(Versioned, "after_delete", propagate=True)
+def _invalidate_versioned(_mapper, _connection, target):
+    """Drop cached copies of any versioned object updated or deleted in a flush"""
+    key = cache_key(type(target).__name__.lower(), target.id)
+    if key is not None:
+        OBJECT_CACHE.invalidate(key)
+
+
+def _cache_metrics():
+    """Object cache counters and size"""
+    stats = OBJECT_CACHE.stats()
+    metrics = [('cache_' + name + '_total', 'counter', 'Object cache ' + name, stats[name])
+               for name in ('hits', 'misses', 'evictions', 'expirations', 'invalidations')]
+    metrics.append(('cache_size', 'gauge', 'Objects in the object cache', stats['size']))
+    return metrics
+
+
+METRICS.register_collector(_cache_metrics)
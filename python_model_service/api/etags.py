@@ -0,0 +1,123 @@
+"""
+Entity tags for conditional requests
+
+history_meta bumps an object's integer version on every change, so a
+single object's ETag is just its version.  A page of a list gets a
+digest of the ids and versions of its rows, and of the link to the next
+page: that changes whenever an object on the page is updated, deleted
+or added.  Both can be checked against If-None-Match before the body is
+serialized.  Streamed lists are written as they are read, so they have
+no ETag.
+
+A compressed response is a different representation of the same
+object or page, so it gets its own strong ETag: the tag with the
+content-coding appended, eg "3-gzip" for "3".  Conditional requests
+treat the two alike.
+
+The functions here take the header values as given, so that the WSGI
+handlers and the async ones can share them.
+"""
+import hashlib
+
+ANY = '*'
+
+# content-codings whose representations have their own ETags
+CODINGS = ('gzip', 'deflate')
+
+
+def object_etag(version):
+    """ETag for an object at a version"""
+    return '"%d"' % version
+
+
+def list_etag(rows, id_index, version_index, link=None, extra_indexes=()):
+    """
+    ETag for a page of rows
+
+    :param id_index: index of the (UUID) id in each row
+    :param version_index: index of the version in each row
+    :param link: the next page link, if any
+    :param extra_indexes: indexes of any other values in each row which
+                          can change without the version changing
+    """
+    digest = hashlib.sha1()
+    for row in rows:
+        digest.update(b'%s%d,' % (row[id_index].bytes, row[version_index]))
+        for index in extra_indexes:
+            digest.update(b'%r,' % (row[index],))
+    if link:
+        digest.update(link.encode('utf-8'))
+    return '"%s"' % digest.hexdigest()
+
+
+def parse_tags(header):
+    """
+    Entity tags of an If-Match or If-None-Match header: ANY, a list of
+    tags, or None if there was no header
+    """
+    if header is None:
+        return None
+    header = header.strip()
+    if header == ANY:
+        return ANY
+    return [tag.strip() for tag in header.split(',') if tag.strip()]
+
+
+def encoded_etag(etag, coding):
+    """ETag of the representation of a response compressed with a content-coding"""
+    return etag[:-1] + '-' + coding + '"'
+
+
+def _unencoded(tag):
+    """Tag without any content-coding suffix"""
+    for coding in CODINGS:
+        suffix = '-' + coding + '"'
+        if tag.endswith(suffix):
+            return tag[:-len(suffix)] + '"'
+    return tag
+
+
+def _opaque(tag):
+    """Tag without any weak indicator or content-coding, for weak comparison"""
+    return _unencoded(tag[2:] if tag.startswith('W/') else tag)
+
+
+def not_modified_etag(etag, coding, if_none_match):
+    """
+    ETag to send with a 304: that of the compressed representation if
+    the client asked with it, and could be sent it again
+    """
+    tags = parse_tags(if_none_match)
+    if coding is None or tags is None or tags == ANY:
+        return etag
+    encoded = encoded_etag(etag, coding)
+    return encoded if encoded in tags else etag
+
+
+def not_modified(if_none_match, etag):
+    """
+    Does an If-None-Match header match the current ETag, so that the
+    response should be a 304?
+    """
+    tags = parse_tags(if_none_match)
+    if tags is None:
+        return False
+    if tags == ANY:
+        return True
+    return _opaque(etag) in {_opaque(tag) for tag in tags}
+
+
+def matching_versions(if_match):
+    """
+    Object versions an If-Match header accepts: None if there is no
+    header or it accepts any version, otherwise a (possibly empty) list;
+    weak tags never match, per RFC 7232
+    """
+    tags = parse_tags(if_match)
+    if tags is None or tags == ANY:
+        return None
+    versions = []
+    for tag in (_unencoded(tag) for tag in tags):
+        if tag.startswith('"') and tag.endswith('"') and tag[1:-1].isdigit():
+            versions.append(int(tag[1:-1]))
+    return versions
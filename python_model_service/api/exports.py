@@ -0,0 +1,107 @@
+"""
+Genotype matrix exports as background jobs
+
+POST /exports starts an export (see python_model_service.export) on a
+background thread and returns at once; GET /exports/{id} reports on it.
+Each export is written to its own directory under the export directory,
+and its status kept there in status.json, so that any worker process
+can answer for any export, and a restart doesn't lose finished ones -
+though an export interrupted by one is left pending or running, and
+must be started again.  Jobs run one at a time per process, in the
+order they were started.
+"""
+import os
+import json
+import uuid
+import datetime
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from python_model_service import orm
+
+LOGGER = logging.getLogger(__name__)
+
+STATUS_FILE = 'status.json'
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class _ExportConfig(object):
+    """Where exports are written"""
+    directory = './data/exports'
+
+
+EXPORTS = _ExportConfig()
+
+_EXECUTOR = ThreadPoolExecutor(1)
+
+
+def configure_exports(directory=None):
+    """Set the directory exports are written under"""
+    if directory is not None:
+        EXPORTS.directory = directory
+
+
+def export_directory(export_id):
+    """Directory of an export's files"""
+    return os.path.join(EXPORTS.directory, str(export_id))
+
+
+def _now():
+    """Current time, as the API gives times"""
+    return datetime.datetime.utcnow().isoformat() + 'Z'
+
+
+def _write_status(status):
+    """Replace an export's status file"""
+    path = os.path.join(export_directory(status['id']), STATUS_FILE)
+    partial = path + '.partial'
+    with open(partial, 'w') as outfile:
+        json.dump(status, outfile)
+    os.replace(partial, path)
+
+
+def read_status(export_id):
+    """An export's status, or None if there is no such export"""
+    try:
+        path = os.path.join(export_directory(uuid.UUID(str(export_id))), STATUS_FILE)
+        with open(path) as infile:
+            return json.load(infile)
+    except (ValueError, FileNotFoundError):
+        return None
+
+
+def start_export():
+    """
+    Queue a new export of the database the ORM is set up with
+
+    :return: its initial status
+    """
+    export_id = uuid.uuid1()
+    os.makedirs(export_directory(export_id))
+    status = {'id': str(export_id), 'status': PENDING, 'created': _now()}
+    _write_status(status)
+    _EXECUTOR.submit(_run, dict(status))
+    return status
+
+
+def _run(status):
+    """On the export thread: write the export, recording its progress"""
+    from python_model_service.export import export_matrix
+
+    status.update(status=RUNNING, started=_now())
+    _write_status(status)
+    try:
+        metadata = export_matrix(orm.get_engine(), export_directory(status['id']))
+    except Exception as e:  # pylint:disable=broad-except
+        LOGGER.exception('export %s failed', status['id'])
+        status.update(status=FAILED, finished=_now(), error=str(e))
+    else:
+        status.update(status=DONE, finished=_now(), individuals=metadata['individuals'],
+                      variants=metadata['variants'], calls=metadata['calls'],
+                      files=[metadata['genotypes']['file'], metadata['individual_index'],
+                             metadata['variant_index']])
+    _write_status(status)
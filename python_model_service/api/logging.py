@@ -4,20 +4,26 @@ Logging wrappers for api calls
 """
 
 import json
+import queue
+import random
+import logging.handlers
 from datetime import datetime
-from uuid import UUID
 from decorator import decorator
 from connexion import request
 from flask import current_app
+from python_model_service.orm.serializers import json_value
+from python_model_service.api.metrics import METRICS, response_status
 
 
 class FieldEncoder(json.JSONEncoder):
-    """Wrap fields to be JSON-safe; handle datetime & UUID"""
+    """
+    Wrap fields to be JSON-safe; handle datetime & UUID the same way
+    as the API's row serializers
+    """
     def default(self, obj):   # pylint: disable=E0202
-        if isinstance(obj, UUID):
-            return str(obj)
-        if isinstance(obj, datetime):
-            return str(obj)
+        value = json_value(obj)
+        if value is not obj:
+            return value
         return json.JSONEncoder.default(self, obj)
 
 
@@ -36,24 +42,142 @@ def logger():
     return current_app.logger
 
 
+class _APILogConfig(object):
+    """Sampling and truncation settings for apilog"""
+    sample_rate = 1.0
+    max_body = 1024
+    log_headers = True
+
+
+APILOG = _APILogConfig()
+
+
+def configure_apilog(sample_rate=None, max_body=None, log_headers=None):
+    """
+    Set the fraction of API calls logged, the maximum number of bytes of
+    request body logged, and whether to log request headers
+    """
+    if sample_rate is not None:
+        APILOG.sample_rate = sample_rate
+    if max_body is not None:
+        APILOG.max_body = max_body
+    if log_headers is not None:
+        APILOG.log_headers = log_headers
+
+
+class _DeferredJSON(object):
+    """Log message which is only JSON-encoded when formatted"""
+    __slots__ = ('entry',)
+
+    def __init__(self, entry):
+        self.entry = entry
+
+    def __str__(self):
+        return json.dumps(self.entry, skipkeys=True, cls=FieldEncoder)
+
+
+_QUEUE_HANDLERS = []
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that leaves formatting to the listener thread and,
+    rather than blocking or erroring when the queue is full, drops the
+    record and counts it
+    """
+    def __init__(self, log_queue):
+        super(DroppingQueueHandler, self).__init__(log_queue)
+        self.dropped = 0
+        _QUEUE_HANDLERS.append(self)
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def start_log_writer(target_logger, filename, level,  # pylint:disable=too-many-arguments
+                     max_bytes=10*1024*1024, backup_count=5, queue_size=10000):
+    """
+    Send the logger's records through a bounded queue to a background
+    thread which writes them to a size-rotated file
+
+    :return: the started QueueListener; stop() it to flush on shutdown
+    """
+    file_handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes,
+                                                        backupCount=backup_count)
+    file_handler.setLevel(level)
+    log_queue = queue.Queue(queue_size)
+    target_logger.addHandler(DroppingQueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, file_handler,
+                                              respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def request_entry(method, path, data, address, headers):
+    """
+    Log entry for an API request, with the body truncated and headers
+    included as configured
+    """
+    entrydict = {"timestamp": str(datetime.now()), "method": method, "path": path}
+    if len(data) > APILOG.max_body:
+        entrydict['data'] = str(data[:APILOG.max_body])
+        entrydict['data_length'] = len(data)
+    else:
+        entrydict['data'] = str(data)
+    entrydict['address'] = address
+    if APILOG.log_headers:
+        entrydict['headers'] = dict(headers)
+    return entrydict
+
+
+def sampled():
+    """Should this API call be logged, given the sample rate?"""
+    return APILOG.sample_rate >= 1.0 or random.random() < APILOG.sample_rate
+
+
+def log_entry(target_logger, entrydict):
+    """Log an entry, JSON-encoding it only when it is written out"""
+    target_logger.info(_DeferredJSON(entrydict))
+
+
 @decorator
 def apilog(func, *args, **kwargs):
     """
-    Logging decorator for API calls
+    Logging decorator for API calls; logs a sample of calls, with the
+    request body truncated, and JSON-encodes the entry off the request path.
+    Every call is also recorded in the request metrics.
     """
-    entrydict = {"timestamp": str(datetime.now())}
-    try:
-        entrydict['method'] = request.method
-        entrydict['path'] = request.full_path
-        entrydict['data'] = str(request.data)
-        entrydict['address'] = request.remote_addr
-        entrydict['headers'] = str(request.headers)
-    except RuntimeError:
-        entrydict['called'] = func.__name__
-        entrydict['args'] = args
-        for key in kwargs:
-            entrydict[key] = kwargs[key]
-
-    logentry = json.dumps(entrydict)
-    current_app.logger.info(logentry)
-    return func(*args, **kwargs)
+    if sampled():
+        try:
+            entrydict = request_entry(request.method, request.full_path,
+                                      request.get_data(cache=True),
+                                      request.remote_addr, request.headers)
+        except RuntimeError:
+            entrydict = {"timestamp": str(datetime.now())}
+            entrydict['called'] = func.__name__
+            entrydict['args'] = args
+            for key in kwargs:
+                entrydict[key] = kwargs[key]
+
+        log_entry(current_app.logger, entrydict)
+
+    with METRICS.track(func.__name__) as tracker:
+        result = func(*args, **kwargs)
+        tracker.status = response_status(result)
+    return result
+
+
+def _log_metrics():
+    """Log records dropped because the writer fell behind"""
+    return [('log_records_dropped_total', 'counter',
+             'Log records dropped with the log queue full',
+             sum(handler.dropped for handler in _QUEUE_HANDLERS))]
+
+
+METRICS.register_collector(_log_metrics)
@@ -0,0 +1,207 @@
+"""
+Per-operation request metrics, exposed in Prometheus text format
+
+For each operation (the handler's function name, as in the swagger
+operationId) we keep a latency histogram, a histogram of time spent in
+the database, a gauge of requests in flight and a counter of responses
+by status code.  apilog records every call of the handlers it wraps,
+whether or not that call is sampled for logging; the async read path
+records its requests the same way.
+
+Database time is the time spent executing statements on any SQLAlchemy
+engine, on the request's thread, while the handler runs.  The rows of a
+streamed response are read after the handler returns, so for streamed
+requests both figures cover only the work before streaming starts.
+
+Metrics are kept per process: with several workers, each scrape is
+answered by whichever worker accepts the connection.
+"""
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PREFIX = 'model_service_'
+
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """Bucketed counts of observations, with their sum"""
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Add one observation"""
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        """
+        (name, labels, value) samples in Prometheus' cumulative form;
+        labels are (name, value) pairs, in the order they are written
+        """
+        cumulative = 0
+        for bound, count in zip(BUCKETS + (float('inf'),), self.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            yield name + '_bucket', labels + (('le', le),), cumulative
+        yield name + '_sum', labels, self.total
+        yield name + '_count', labels, self.count
+
+
+class Tracker(object):
+    """One request's measurements, from start until finish(status)"""
+    __slots__ = ('metrics', 'operation', 'started', 'db_time', 'status')
+
+    def __init__(self, metrics, operation):
+        self.metrics = metrics
+        self.operation = operation
+        self.started = time.perf_counter()
+        self.db_time = 0.0
+        self.status = 200
+
+    def finish(self, status):
+        """Record the request as complete with the given status code"""
+        self.metrics.record(self.operation, status,
+                            time.perf_counter() - self.started, self.db_time)
+
+
+class Metrics(object):
+    """
+    Thread-safe registry of per-operation request metrics
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._collectors = []
+        self.reset()
+
+    def reset(self):
+        """Drop all recorded values"""
+        with self._lock:
+            self.latency = defaultdict(Histogram)
+            self.db_latency = defaultdict(Histogram)
+            self.in_flight = defaultdict(int)
+            self.responses = defaultdict(int)
+
+    def start(self, operation):
+        """Begin tracking a request to the operation"""
+        with self._lock:
+            self.in_flight[operation] += 1
+        return Tracker(self, operation)
+
+    def record(self, operation, status, seconds, db_seconds):
+        """Record a completed request"""
+        with self._lock:
+            self.in_flight[operation] -= 1
+            self.latency[operation].observe(seconds)
+            self.db_latency[operation].observe(db_seconds)
+            self.responses[(operation, str(status))] += 1
+
+    @contextmanager
+    def track(self, operation):
+        """
+        Track a call made on this thread, including the time its
+        statements spend in the database; the caller sets .status on
+        the yielded tracker, and exceptions count as 500s
+        """
+        tracker = self.start(operation)
+        previous = getattr(self._local, 'tracker', None)
+        self._local.tracker = tracker
+        status = 500
+        try:
+            yield tracker
+            status = tracker.status
+        finally:
+            self._local.tracker = previous
+            tracker.finish(status)
+
+    def add_db_time(self, seconds):
+        """Charge database time to the call being tracked on this thread"""
+        tracker = getattr(self._local, 'tracker', None)
+        if tracker is not None:
+            tracker.db_time += seconds
+
+    def register_collector(self, collector):
+        """
+        Add a function returning extra (name, type, help, value) metrics
+        to include in the output
+        """
+        self._collectors.append(collector)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            families = [
+                ('requests_total', 'counter', 'Responses by operation and status code',
+                 [('requests_total', (('operation', op), ('code', code)), n)
+                  for (op, code), n in sorted(self.responses.items())]),
+                ('requests_in_flight', 'gauge', 'Requests currently being handled',
+                 [('requests_in_flight', (('operation', op),), n)
+                  for op, n in sorted(self.in_flight.items())]),
+                ('request_duration_seconds', 'histogram', 'Request handling time',
+                 [sample for op, hist in sorted(self.latency.items())
+                  for sample in hist.samples('request_duration_seconds', (('operation', op),))]),
+                ('db_duration_seconds', 'histogram', 'Database time per request',
+                 [sample for op, hist in sorted(self.db_latency.items())
+                  for sample in hist.samples('db_duration_seconds', (('operation', op),))]),
+            ]
+        for collector in self._collectors:
+            for name, kind, help_text, value in collector():
+                families.append((name, kind, help_text, [(name, (), value)]))
+
+        lines = []
+        for family, kind, help_text, samples in families:
+            lines.append('# HELP %s%s %s' % (PREFIX, family, help_text))
+            lines.append('# TYPE %s%s %s' % (PREFIX, family, kind))
+            for name, labels, value in samples:
+                lines.append(PREFIX + name + _labels(labels) + ' ' + _value(value))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    """Prometheus label set, from (name, value) pairs"""
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"'))
+                          for k, v in labels) + '}'
+
+
+def _value(value):
+    """Prometheus sample value"""
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def response_status(result):
+    """Status code of a connexion handler's return value"""
+    if isinstance(result, tuple) and len(result) > 1 and isinstance(result[1], int):
+        return result[1]
+    return getattr(result, 'status_code', 200)
+
+
+METRICS = Metrics()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_execute(conn, _cursor, _statement, _parameters, _context, _executemany):
+    """Note when a statement starts"""
+    conn.info['metrics_started'] = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_execute(conn, _cursor, _statement, _parameters, _context, _executemany):
+    """Charge the statement's time to the current request"""
+    METRICS.add_db_time(time.perf_counter() - conn.info['metrics_started'])
@@ -1,18 +1,14 @@
 """
 API Data Model definitions
 From Swagger file, with python classes via Bravado
+
+Building the bravado Spec is slow, so it is put off until a model is
+first used rather than done when this module is imported.
 """
 
-import pkg_resources
-import yaml
-from bravado_core.spec import Spec
+import functools
 
-#
-# Read in the API definition, and parse it with Bravado
-#
-_API_DEF = pkg_resources.resource_filename('python_model_service',
-                                           'api/swagger.yaml')
-_SPEC_DICT = yaml.safe_load(open(_API_DEF, 'r'))
+from python_model_service.api.spec import load_spec
 
 _BRAVADO_CONFIG = {
     'validate_requests': False,
@@ -21,14 +17,45 @@ _BRAVADO_CONFIG = {
     'validate_swagger_spec': False
 }
 
-_SWAGGER_SPEC = Spec.from_dict(_SPEC_DICT, config=_BRAVADO_CONFIG)
+
+@functools.lru_cache(maxsize=1)
+def _swagger_spec():
+    """Parse the API definition with Bravado, on first use"""
+    from bravado_core.spec import Spec
+    return Spec.from_dict(load_spec(), config=_BRAVADO_CONFIG)
+
 
 #
 # Generate the Python models from the spec
 #
 
-BASEPATH = _SWAGGER_SPEC.flattened_spec['basePath']
-Error = _SWAGGER_SPEC.definitions['Error']  # pylint:disable=invalid-name
-Individual = _SWAGGER_SPEC.definitions['Individual']  # pylint:disable=invalid-name
-Variant = _SWAGGER_SPEC.definitions['Variant']  # pylint:disable=invalid-name
-Call = _SWAGGER_SPEC.definitions['Call']  # pylint:disable=invalid-name
+BASEPATH = load_spec()['basePath']
+
+
+def model(name):
+    """The model class of a definition in the spec, eg model('Individual')"""
+    return _swagger_spec().definitions[name]
+
+
+class _LazyModel(object):
+    """
+    Stands in for a model class, which is looked up when first called
+    or its attributes are used
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, *args, **kwargs):
+        return model(self.name)(*args, **kwargs)
+
+    def __getattr__(self, attr):
+        return getattr(model(self.name), attr)
+
+    def __repr__(self):
+        return '<lazy model %s>' % self.name
+
+
+Error = _LazyModel('Error')
+Individual = _LazyModel('Individual')
+Variant = _LazyModel('Variant')
+Call = _LazyModel('Call')
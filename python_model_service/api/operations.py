@@ -5,13 +5,26 @@ Implement endpoints of model service
 """
 import datetime
 import uuid
-from sqlalchemy import and_
+from collections import OrderedDict
+from dateutil.parser import isoparse
+from flask import request
+from sqlalchemy import and_, or_
 from python_model_service import orm
 from python_model_service.orm import models
 from python_model_service.api.logging import apilog, logger
 from python_model_service.api.logging import structured_log as struct_log
 from python_model_service.api.models import Error, BASEPATH
+from python_model_service.orm import history
+from python_model_service.orm import stats as variant_stats
 from python_model_service.orm.models import Individual, Variant, Call
+from python_model_service.orm.binning import reg2bin_ranges
+from python_model_service.orm.serializers import serializer, json_value
+from python_model_service.api.pagination import paginate, row_key, encode_token, next_link
+from python_model_service.api.pagination import PageTokenError
+from python_model_service.api.streaming import streamed_response, json_response
+from python_model_service.api.cache import OBJECT_CACHE, cache_key
+from python_model_service.api import etags, exports
+from python_model_service.api.metrics import METRICS
 
 
 def _report_search_failed(typename, exception, **kwargs):
@@ -94,31 +107,234 @@ def _report_write_error(typename, exception, **kwargs):
     return err
 
 
+def _report_bad_page_token(typename, exception, **kwargs):
+    """
+    Generate standard log message + request error for warning:
+    Pagination token could not be decoded
+
+    :param typename: name of type involved
+    :param exception: PageTokenError raised decoding the token
+    :param **kwargs: arbitrary keyword parameters
+    :return: Connexion Error() type to return
+    """
+    report = typename + ': invalid page token'
+    message = str(exception)
+    logger().warning(struct_log(action=report, exception=str(exception), **kwargs))
+    return Error(message=message, code=400)
+
+
+def _list_response(query, key, serialize,  # pylint:disable=too-many-arguments
+                   limit=None, stream=False, key_attrs=None, etag_indexes=()):
+    """
+    Run a paginated list query, returning either a page of rows fetched
+    at once or a streamed response; either way the JSON is encoded a
+    batch at a time as it is written.  If there are rows past this page,
+    a Link header points to the next one.  A fetched page has an ETag,
+    and is a 304 without a body if it matches the request's If-None-Match.
+
+    :param query: query already ordered/filtered by pagination.paginate
+    :param key: the key columns the query is paginated on
+    :param serialize: serializer for the query's result rows
+    :param limit: maximum number of rows to return, or None for all
+    :param stream: stream rows out as they are fetched
+    :param key_attrs: attributes of the result rows holding the key
+                      values, if not named as the key columns (eg, joins)
+    :param etag_indexes: indexes of values in the result rows, besides
+                         the id and version, that the ETag must cover
+    :return: body, status, headers as for a connexion handler
+    """
+    headers = {}
+    if stream:
+        if limit:
+            # look ahead at just the key columns to find where the page ends
+            ends = query.with_entities(*key).offset(limit - 1).limit(2).all()
+            if len(ends) > 1:
+                headers['Link'] = next_link(encode_token(ends[0]))
+            query = query.limit(limit)
+        return streamed_response(query, serialize, headers=headers)
+
+    if limit:
+        rows = query.limit(limit + 1).all()
+        if len(rows) > limit:
+            rows = rows[:limit]
+            if key_attrs:
+                last = [getattr(rows[-1], attr) for attr in key_attrs]
+            else:
+                last = row_key(rows[-1], key)
+            headers['Link'] = next_link(encode_token(last))
+    else:
+        rows = query.all()
+
+    headers['ETag'] = etags.list_etag(rows, serialize.keys.index('id'),
+                                      serialize.keys.index('version'), headers.get('Link'),
+                                      etag_indexes)
+    if _not_modified(headers['ETag']):
+        return None, 304, headers
+    return json_response(rows, serialize, headers=headers)
+
+
+def _not_modified(etag):
+    """
+    Does the request's If-None-Match match the current ETag?
+    """
+    return etags.not_modified(request.headers.get('If-None-Match'), etag)
+
+
+def _check_if_match(db_session, typename, model, object_id):
+    """
+    Enforce any If-Match precondition of a write to an object.  The row
+    is locked, in the transaction the write is then made in, only if it
+    is still at a version the client named, so that no other write can
+    come between the check and this one.
+
+    :return: None to go ahead with the write, or error, status to return
+    """
+    versions = etags.matching_versions(request.headers.get('If-Match'))
+    if versions is None:
+        return None
+
+    table = model.__table__
+    try:
+        locked = 0
+        if versions:
+            locked = db_session.execute(
+                table.update()
+                .where(and_(table.c.id == object_id, table.c.version.in_(versions)))
+                .values(version=table.c.version)).rowcount
+        # a missing object is left to the caller to report as a 404
+        if locked or not db_session.query(model.id).filter(model.id == object_id).first():
+            return None
+    except orm.ORMException as e:
+        err = _report_update_failed(typename, e, id=str(object_id))
+        return err, 500
+
+    db_session.rollback()
+    err = Error(message=typename+" has been modified since the If-Match version: "+str(object_id),
+                code=412)
+    return err, 412
+
+
+def _parse_timestamp(value):
+    """
+    ISO 8601 timestamp as a naive UTC datetime, as the DB stores them;
+    taken to be UTC already if it has no offset
+
+    :raises ValueError: if the timestamp can't be parsed
+    """
+    when = isoparse(value)
+    if when.tzinfo is not None:
+        when = when.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return when
+
+
+def _get_one_as_of(typename, model, object_id, as_of):
+    """
+    A single object as it was at the as_of time, from its version history
+
+    :return: body, status as for a connexion handler
+    """
+    try:
+        when = _parse_timestamp(as_of)
+    except ValueError:
+        err = Error(message="Invalid as_of timestamp: "+as_of, code=400)
+        return err, 400
+
+    db_session = orm.get_session()
+    ser = serializer(model)
+    try:
+        row = history.as_of(db_session, model, object_id, when, ser.keys)
+    except orm.ORMException as e:
+        err = _report_search_failed(typename, e, id=str(object_id), as_of=as_of)
+        return err, 500
+
+    if row is None:
+        err = Error(message="No "+typename+" found as of "+as_of+": "+str(object_id), code=404)
+        return err, 404
+
+    etag = etags.object_etag(row.version)
+    if _not_modified(etag):
+        return None, 304, {'ETag': etag}
+    return ser(row), 200, {'ETag': etag}
+
+
+def region_filter(query, chromosome, start, end):
+    """
+    Restrict a query to the variants between [chrom, start) and (chrom, end],
+    through the bin index
+    """
+    bins = [models.Variant.bin.between(first, last)
+            for first, last in reg2bin_ranges(start - 1, end)]
+    return query\
+        .filter(models.Variant.chromosome == chromosome)\
+        .filter(or_(*bins))\
+        .filter(and_(models.Variant.start >= start, models.Variant.start <= end))
+
+
+class _VariantStatsSerializer(object):
+    """
+    Serializer for variant rows followed by their VariantStats counts,
+    giving each variant its statistics
+    """
+    def __init__(self):
+        self.variant = serializer(models.Variant)
+        self.keys = self.variant.keys + variant_stats.FIELDS
+        self.columns = self.variant.columns + variant_stats.COLUMNS
+        self.counts = tuple(range(len(self.variant.keys), len(self.keys)))
+
+    def __call__(self, row):
+        variant = self.variant(row)
+        variant['stats'] = variant_stats.summary(row[len(self.variant.keys):])
+        return variant
+
+
 @apilog
-def get_variants(chromosome, start, end):
+def get_variants(chromosome, start, end,  # pylint:disable=too-many-arguments
+                 limit=None, after=None, stream=False, stats=False):
     """
-    Return all variants between [chrom, start) and (chrom, end]
+    Return all variants between [chrom, start) and (chrom, end],
+    ordered by position, and optionally their allele statistics
     """
     db_session = orm.get_session()
+    ser = _VariantStatsSerializer() if stats else serializer(models.Variant)
+    key = [models.Variant.start, models.Variant.id]
     try:
-        q = db_session.query(orm.models.Variant)\
-            .filter(models.Variant.chromosome == chromosome)\
-            .filter(and_(models.Variant.start >= start, models.Variant.start <= end))
+        q = db_session.query(*ser.columns)
+        if stats:
+            q = q.outerjoin(models.VariantStats,
+                            models.VariantStats.variant_id == models.Variant.id)
+        q = region_filter(q, chromosome, start, end)
+        q = paginate(q, key, after)
+        return _list_response(q, key, ser, limit, stream,
+                              etag_indexes=ser.counts if stats else ())
+    except PageTokenError as e:
+        err = _report_bad_page_token('variant', e, after=after)
+        return err, 400
     except orm.ORMException as e:
         err = _report_search_failed('variant', e, chromosome=chromosome, start=start, end=end)
         return err, 500
 
-    return [orm.dump(p) for p in q], 200
-
 
 @apilog
-def get_one_variant(variant_id):
+def get_one_variant(variant_id, as_of=None):
     """
-    Return single variant object
+    Return single variant object, optionally as it was at a given time
     """
+    if as_of is not None:
+        return _get_one_as_of('variant', models.Variant, variant_id, as_of)
+
+    key = cache_key('variant', variant_id)
+    cached = OBJECT_CACHE.get(key) if key else None
+    if cached is not None:
+        etag = etags.object_etag(cached['version'])
+        if _not_modified(etag):
+            return None, 304, {'ETag': etag}
+        return cached, 200, {'ETag': etag}
+
     db_session = orm.get_session()
+    ser = serializer(models.Variant)
     try:
-        q = db_session.query(models.Variant).get(variant_id)
+        q = db_session.query(*ser.columns)\
+            .filter(models.Variant.id == variant_id).first()
     except orm.ORMException as e:
         err = _report_search_failed('variant', e, var_id=str(variant_id))
         return err, 500
@@ -127,30 +343,105 @@ def get_one_variant(variant_id):
         err = Error(message="No variant found: "+str(variant_id), code=404)
         return err, 404
 
-    return orm.dump(q), 200
+    etag = etags.object_etag(q.version)
+    if _not_modified(etag):
+        return None, 304, {'ETag': etag}
+
+    result = ser(q)
+    OBJECT_CACHE.put(key, result)
+    return result, 200, {'ETag': etag}
 
 
 @apilog
-def get_individuals():
+def get_variant_stats(variant_id):
+    """
+    Return a variant's allele statistics
+    """
+    db_session = orm.get_session()
+    try:
+        row = db_session.query(models.Variant.id, *variant_stats.COLUMNS)\
+            .outerjoin(models.VariantStats, models.VariantStats.variant_id == models.Variant.id)\
+            .filter(models.Variant.id == variant_id)\
+            .one_or_none()
+    except orm.ORMException as e:
+        err = _report_search_failed('variant', e, variant_id=str(variant_id))
+        return err, 500
+
+    if row is None:
+        err = Error(message="No variant found: "+str(variant_id), code=404)
+        return err, 404
+
+    result = variant_stats.summary(row[1:])
+    result['variant_id'] = str(row[0])
+    return result, 200
+
+
+@apilog
+def get_variant_history(variant_id):
+    """
+    Return every version of a variant, oldest first
+    """
+    db_session = orm.get_session()
+    ser = serializer(models.Variant)
+    try:
+        rows = history.versions(db_session, models.Variant, variant_id, ser.keys)
+    except orm.ORMException as e:
+        err = _report_search_failed('variant', e, var_id=str(variant_id))
+        return err, 500
+
+    if not rows:
+        err = Error(message="No variant found: "+str(variant_id), code=404)
+        return err, 404
+
+    result = []
+    for row, changed in rows:
+        version = ser(row)
+        if changed is not None:
+            version['changed'] = json_value(changed)
+        result.append(version)
+    return result, 200
+
+
+@apilog
+def get_individuals(limit=None, after=None, stream=False):
     """
     Return all individuals
     """
+    db_session = orm.get_session()
+    ser = serializer(models.Individual)
+    key = [models.Individual.id]
     try:
-        q = Individual().query.all()
+        q = paginate(db_session.query(*ser.columns), key, after)
+        return _list_response(q, key, ser, limit, stream)
+    except PageTokenError as e:
+        err = _report_bad_page_token('individual', e, after=after)
+        return err, 400
     except orm.ORMException as e:
         err = _report_search_failed('individuals', e, ind_id="all")
         return err, 500
 
-    return [orm.dump(p) for p in q], 200
-
 
 @apilog
-def get_one_individual(individual_id):
+def get_one_individual(individual_id, as_of=None):
     """
-    Return single individual object
+    Return single individual object, optionally as it was at a given time
     """
+    if as_of is not None:
+        return _get_one_as_of('individual', models.Individual, individual_id, as_of)
+
+    key = cache_key('individual', individual_id)
+    cached = OBJECT_CACHE.get(key) if key else None
+    if cached is not None:
+        etag = etags.object_etag(cached['version'])
+        if _not_modified(etag):
+            return None, 304, {'ETag': etag}
+        return cached, 200, {'ETag': etag}
+
+    db_session = orm.get_session()
+    ser = serializer(models.Individual)
     try:
-        q = Individual().query.get(individual_id)
+        q = db_session.query(*ser.columns)\
+            .filter(models.Individual.id == individual_id).first()
     except orm.ORMException as e:
         err = _report_search_failed('individual', e, ind_id=str(individual_id))
         return err, 500
@@ -159,31 +450,56 @@ def get_one_individual(individual_id):
         err = Error(message="No individual found: "+str(individual_id), code=404)
         return err, 404
 
-    return orm.dump(q), 200
+    etag = etags.object_etag(q.version)
+    if _not_modified(etag):
+        return None, 304, {'ETag': etag}
+
+    result = ser(q)
+    OBJECT_CACHE.put(key, result)
+    return result, 200, {'ETag': etag}
 
 
 @apilog
-def get_calls():
+def get_calls(limit=None, after=None, stream=False):
     """
     Return all calls
     """
+    db_session = orm.get_session()
+    ser = serializer(models.Call)
+    key = [models.Call.id]
     try:
-        q = Call().query.all()
+        q = paginate(db_session.query(*ser.columns), key, after)
+        return _list_response(q, key, ser, limit, stream)
+    except PageTokenError as e:
+        err = _report_bad_page_token('call', e, after=after)
+        return err, 400
     except orm.ORMException as e:
         err = _report_search_failed('call', e, call_id='all')
         return err, 500
 
-    return [orm.dump(p) for p in q], 200
-
 
 @apilog
-def get_one_call(call_id):
+def get_one_call(call_id, as_of=None):
     """
-    Return single call object
+    Return single call object, optionally as it was at a given time
     """
+    if as_of is not None:
+        return _get_one_as_of('call', models.Call, call_id, as_of)
+
+    key = cache_key('call', call_id)
+    cached = OBJECT_CACHE.get(key) if key else None
+    if cached is not None:
+        etag = etags.object_etag(cached['version'])
+        if _not_modified(etag):
+            return None, 304, {'ETag': etag}
+        return cached, 200, {'ETag': etag}
+
+    db_session = orm.get_session()
+    ser = serializer(models.Call)
     try:
-        q = Call().query.get(call_id)
-    except Error as e:
+        q = db_session.query(*ser.columns)\
+            .filter(models.Call.id == call_id).first()
+    except orm.ORMException as e:
         err = _report_search_failed('call', e, call_id=str(call_id))
         return err, 500
 
@@ -191,7 +507,13 @@ def get_one_call(call_id):
         err = Error(message="No call found: "+str(call_id), code=404)
         return err, 404
 
-    return orm.dump(q), 200
+    etag = etags.object_etag(q.version)
+    if _not_modified(etag):
+        return None, 304, {'ETag': etag}
+
+    result = ser(q)
+    OBJECT_CACHE.put(key, result)
+    return result, 200, {'ETag': etag}
 
 
 def variant_exists(id=None, chromosome=None,  # pylint:disable=redefined-builtin
@@ -226,7 +548,8 @@ def call_exists(id=None, variant_id=None,  # pylint:disable=redefined-builtin
     return c > 0
 
 
-def individual_exists(db_session, id=None, description=None, **_kwargs):  # pylint:disable=redefined-builtin
+def individual_exists(db_session, id=None,  # pylint:disable=redefined-builtin
+                      description=None, **_kwargs):
     """
     Check to see if individual exists, by ID if given or if by features if not
     """
@@ -289,6 +612,10 @@ def put_variant(variant_id, variant):
     and new Variant dict object (passed in body)
     """
     db_session = orm.get_session()
+    err = _check_if_match(db_session, 'variant', Variant, variant_id)
+    if err:
+        return err
+
     try:
         q = db_session.query(Variant).get(variant_id)
     except orm.ORMException as e:
@@ -310,12 +637,15 @@ def put_variant(variant_id, variant):
         row = db_session.query(Variant).filter(Variant.id == variant_id).first()
         for key in variant:
             setattr(row, key, variant[key])
+        db_session.flush()
+        etag = etags.object_etag(row.version)
         db_session.commit()
     except orm.ORMException as e:
         err = _report_update_failed('variant', e, var_id=str(variant_id))
         return err, 500
 
-    return None, 204, {'Location': BASEPATH+'/individuals/'+str(variant_id)}
+    OBJECT_CACHE.invalidate(cache_key('variant', variant_id))
+    return None, 204, {'Location': BASEPATH+'/individuals/'+str(variant_id), 'ETag': etag}
 
 
 @apilog
@@ -324,6 +654,10 @@ def delete_variant(variant_id):
     Delete a single call by call id (in URL)
     """
     db_session = orm.get_session()
+    err = _check_if_match(db_session, 'variant', Variant, variant_id)
+    if err:
+        return err
+
     try:
         q = db_session.query(Variant).get(variant_id)
     except orm.ORMException as e:
@@ -342,6 +676,7 @@ def delete_variant(variant_id):
         err = _report_update_failed('variant', e, var_id=str(variant_id))
         return err, 500
 
+    OBJECT_CACHE.invalidate(cache_key('variant', variant_id))
     return None, 204, {'Location': BASEPATH+'/variant/'+str(variant_id)}
 
 
@@ -391,6 +726,10 @@ def put_individual(individual_id, individual):
     and new api.models.Invididual object (passed in body)
     """
     db_session = orm.get_session()
+    err = _check_if_match(db_session, 'individual', Individual, individual_id)
+    if err:
+        return err
+
     try:
         q = db_session.query(Individual).get(individual_id)
     except orm.ORMException as e:
@@ -412,12 +751,15 @@ def put_individual(individual_id, individual):
         row = db_session.query(Individual).filter(Individual.id == individual_id).first()
         for key in individual:
             setattr(row, key, individual[key])
+        db_session.flush()
+        etag = etags.object_etag(row.version)
         db_session.commit()
     except orm.ORMException as e:
         err = _report_update_failed('individual', e, ind_id=str(individual_id))
         return err, 500
 
-    return None, 204, {'Location': BASEPATH+'/individuals/'+str(individual_id)}
+    OBJECT_CACHE.invalidate(cache_key('individual', individual_id))
+    return None, 204, {'Location': BASEPATH+'/individuals/'+str(individual_id), 'ETag': etag}
 
 
 @apilog
@@ -426,6 +768,10 @@ def delete_individual(individual_id):
     Delete a single individual by individual id (in URL)
     """
     db_session = orm.get_session()
+    err = _check_if_match(db_session, 'individual', Individual, individual_id)
+    if err:
+        return err
+
     try:
         q = db_session.query(Individual).get(individual_id)
     except orm.ORMException as e:
@@ -444,6 +790,7 @@ def delete_individual(individual_id):
         err = _report_update_failed('individual', e, ind_id=str(individual_id))
         return err, 500
 
+    OBJECT_CACHE.invalidate(cache_key('individual', individual_id))
     return None, 204, {'Location': BASEPATH+'/individuals/'+str(individual_id)}
 
 
@@ -493,6 +840,10 @@ def put_call(call_id, call):
     and new Call api dict (passed in body)
     """
     db_session = orm.get_session()
+    err = _check_if_match(db_session, 'call', Call, call_id)
+    if err:
+        return err
+
     try:
         q = db_session.query(Call).get(call_id)
     except orm.ORMException as e:
@@ -511,22 +862,30 @@ def put_call(call_id, call):
     call['updated'] = datetime.datetime.utcnow()
 
     try:
-        row = db_session.query(Individual).filter(Call.id == call_id).first()
+        row = db_session.query(Call).filter(Call.id == call_id).first()
         for key in call:
             setattr(row, key, call[key])
+        db_session.flush()
+        etag = etags.object_etag(row.version)
         db_session.commit()
     except orm.ORMException as e:
         err = _report_update_failed('call', e, call_id=str(call_id))
         return err, 500
 
-    return None, 204, {'Location': '/calls/'+str(call_id)}
+    OBJECT_CACHE.invalidate(cache_key('call', call_id))
+    return None, 204, {'Location': '/calls/'+str(call_id), 'ETag': etag}
 
 
+@apilog
 def delete_call(call_id):
     """
     Delete a single call by call id (in URL)
     """
     db_session = orm.get_session()
+    err = _check_if_match(db_session, 'call', Call, call_id)
+    if err:
+        return err
+
     try:
         q = db_session.query(Call).get(call_id)
     except orm.ORMException as e:
@@ -545,11 +904,185 @@ def delete_call(call_id):
         err = _report_update_failed('call', e, call_id=str(call_id))
         return err, 500
 
+    OBJECT_CACHE.invalidate(cache_key('call', call_id))
     return None, 204, {'Location': BASEPATH+'/calls/'+str(call_id)}
 
 
+BATCH_QUERY_CHUNK = 400
+
+
+def _chunks(items, size):
+    """
+    Split a list into consecutive chunks of at most size items
+    """
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+
+def _variant_key(variant):
+    """Natural key uniquely identifying a variant"""
+    return (variant['chromosome'], variant['start'], variant['ref'], variant['alt'])
+
+
+def _individual_key(individual):
+    """Natural key identifying an individual"""
+    return individual.get('description')
+
+
+def _call_key(call):
+    """Natural key uniquely identifying a call"""
+    return (uuid.UUID(str(call['variant_id'])), uuid.UUID(str(call['individual_id'])))
+
+
+def existing_variant_keys(db_session, keys):
+    """
+    Subset of the given variant natural keys that are already in the DB,
+    found with a handful of set-based queries rather than one per variant
+    """
+    found = set()
+    for chunk in _chunks(keys, BATCH_QUERY_CHUNK):
+        chromosomes = {key[0] for key in chunk}
+        starts = {key[1] for key in chunk}
+        q = db_session.query(Variant.chromosome, Variant.start, Variant.ref, Variant.alt)\
+            .filter(Variant.chromosome.in_(chromosomes))\
+            .filter(Variant.start.in_(starts))
+        found.update(tuple(row) for row in q)
+    return found & set(keys)
+
+
+def existing_individual_keys(db_session, keys):
+    """
+    Subset of the given individual descriptions that are already in the DB
+    """
+    found = set()
+    descriptions = [key for key in keys if key is not None]
+    for chunk in _chunks(descriptions, BATCH_QUERY_CHUNK):
+        q = db_session.query(Individual.description)\
+            .filter(Individual.description.in_(chunk))
+        found.update(row[0] for row in q)
+    return found
+
+
+def existing_call_keys(db_session, keys):
+    """
+    Subset of the given (variant_id, individual_id) call keys already in the DB
+    """
+    found = set()
+    for chunk in _chunks(keys, BATCH_QUERY_CHUNK):
+        variant_ids = {key[0] for key in chunk}
+        individual_ids = {key[1] for key in chunk}
+        q = db_session.query(Call.variant_id, Call.individual_id)\
+            .filter(Call.variant_id.in_(variant_ids))\
+            .filter(Call.individual_id.in_(individual_ids))
+        found.update(tuple(row) for row in q)
+    return found & set(keys)
+
+
+def _post_batch(typename, model, items,  # pylint:disable=too-many-arguments
+                natural_key, existing_keys, on_insert=None):
+    """
+    Insert a batch of new objects in one transaction
+
+    Duplicates, both against the DB and within the batch, are found with
+    set-based queries; the remaining rows are inserted with a single
+    executemany.  Each item gets its own status in the result.
+
+    :param typename: name of type involved
+    :param model: ORM model class to insert into
+    :param items: list of API dicts to insert
+    :param natural_key: function returning an item's identifying key
+    :param existing_keys: function(db_session, keys) returning the keys present in the DB
+    :param on_insert: function(execute, rows) called with the rows inserted,
+                      in the inserting transaction
+    :return: body, status, as for a connexion handler
+    """
+    db_session = orm.get_session()
+    # columns with defaults (version, bin) are filled in by the insert itself
+    columns = [c.key for c in model.__table__.c if c.default is None]
+    results = [None] * len(items)
+    keys = {}
+
+    for i, item in enumerate(items):
+        try:
+            keys[i] = natural_key(item)
+        except (KeyError, TypeError, ValueError) as e:
+            err = _report_conversion_error(typename, e, batch_index=i)
+            results[i] = {'code': 400, 'message': err.message}
+
+    try:
+        found = existing_keys(db_session, list(set(keys.values())))
+    except orm.ORMException as e:
+        err = _report_search_failed(typename, e, batch_size=len(items))
+        return err, 500
+
+    now = datetime.datetime.utcnow()
+    rows = []
+    first_seen = {}
+    for i, key in keys.items():
+        item = items[i]
+        if key is not None and key in found:
+            _report_object_exists(typename, batch_index=i)
+            results[i] = {'code': 405, 'message': 'Attempt to modify '+typename+' with a POST'}
+            continue
+        if key is not None and key in first_seen:
+            results[i] = {'code': 405,
+                          'message': 'Duplicate of batch item '+str(first_seen[key])}
+            continue
+        if key is not None:
+            first_seen[key] = i
+
+        oid = uuid.uuid1()
+        item['id'] = oid
+        item['created'] = now
+        item['updated'] = now
+        rows.append({column: item.get(column) for column in columns})
+        results[i] = {'code': 201, 'id': oid,
+                      'location': BASEPATH+'/'+typename+'s/'+str(oid)}
+
+    if rows:
+        try:
+            db_session.execute(model.__table__.insert(), rows)
+            if on_insert is not None:
+                on_insert(db_session.execute, rows)
+            db_session.commit()
+        except orm.ORMException as e:
+            db_session.rollback()
+            err = _report_write_error(typename, e, batch_size=len(items))
+            return err, 500
+
+    logger().info(struct_log(action=typename+'s_batch_created',
+                             created=len(rows), requested=len(items)))
+    return results, 200
+
+
+@apilog
+def post_variant_batch(variants):
+    """
+    Add a batch of new variants
+    """
+    return _post_batch('variant', models.Variant, variants,
+                       _variant_key, existing_variant_keys)
+
+
+@apilog
+def post_individual_batch(individuals):
+    """
+    Add a batch of new individuals
+    """
+    return _post_batch('individual', models.Individual, individuals,
+                       _individual_key, existing_individual_keys)
+
+
+@apilog
+def post_call_batch(calls):
+    """
+    Add a batch of new calls
+    """
+    return _post_batch('call', models.Call, calls,
+                       _call_key, existing_call_keys, on_insert=variant_stats.record_inserts)
+
+
 @apilog
-def get_variants_by_individual(individual_id):
+def get_variants_by_individual(individual_id, limit=None, after=None, stream=False):
     """
     Return variants that have been called in an individual
     """
@@ -557,7 +1090,7 @@ def get_variants_by_individual(individual_id):
     ind_id = individual_id
 
     try:
-        ind = db_session.query(orm.models.Individual)\
+        ind = db_session.query(orm.models.Individual.id)\
             .filter(orm.models.Individual.id == ind_id)\
             .one_or_none()
     except orm.ORMException as e:
@@ -568,24 +1101,32 @@ def get_variants_by_individual(individual_id):
         err = Error(message="No individual found: "+str(ind_id), code=404)
         return err, 404
 
+    # one join, walking the individual's calls in variant_id order
+    ser = serializer(models.Variant)
+    key = [models.Call.variant_id]
     try:
-        variants = [call.variant for call in ind.calls if call.variant]
+        q = db_session.query(*ser.columns)\
+            .join(models.Call, models.Call.variant_id == models.Variant.id)\
+            .filter(models.Call.individual_id == ind_id)
+        q = paginate(q, key, after)
+        return _list_response(q, key, ser, limit, stream, key_attrs=['id'])
+    except PageTokenError as e:
+        err = _report_bad_page_token('variant', e, after=after)
+        return err, 400
     except orm.ORMException as e:
         err = _report_search_failed('variants', e, by_individual_id=individual_id)
         return err, 500
 
-    return [orm.dump(v) for v in variants], 200
-
 
 @apilog
-def get_individuals_by_variant(variant_id):
+def get_individuals_by_variant(variant_id, limit=None, after=None, stream=False):
     """
-    Return variants that have been called in an individual
+    Return individuals that have a given variant called
     """
     db_session = orm.get_session()
 
     try:
-        var = db_session.query(orm.models.Variant)\
+        var = db_session.query(orm.models.Variant.id)\
             .filter(orm.models.Variant.id == variant_id)\
             .one_or_none()
     except orm.ORMException as e:
@@ -596,11 +1137,172 @@ def get_individuals_by_variant(variant_id):
         err = Error(message="No variant found: "+str(variant_id), code=404)
         return err, 404
 
+    # one join, walking the variant's calls in individual_id order
+    ser = serializer(models.Individual)
+    key = [models.Call.individual_id]
     try:
-        individuals = [call.individual for call in var.calls
-                       if call.individual is not None]
+        q = db_session.query(*ser.columns)\
+            .join(models.Call, models.Call.individual_id == models.Individual.id)\
+            .filter(models.Call.variant_id == variant_id)
+        q = paginate(q, key, after)
+        return _list_response(q, key, ser, limit, stream, key_attrs=['id'])
+    except PageTokenError as e:
+        err = _report_bad_page_token('individual', e, after=after)
+        return err, 400
     except orm.ORMException as e:
         err = _report_search_failed('individuals', e, by_variant_id=variant_id)
         return err, 500
 
-    return [orm.dump(i) for i in individuals], 200
+
+def _missing_individuals(db_session, individual_ids):
+    """
+    Those of the given individual ids not in the DB
+    """
+    found = set()
+    for chunk in _chunks(individual_ids, BATCH_QUERY_CHUNK):
+        q = db_session.query(Individual.id).filter(Individual.id.in_(chunk))
+        found.update(row[0] for row in q)
+    return [ind_id for ind_id in individual_ids if ind_id not in found]
+
+
+def _genotype_matrix(rows, ser, individual_ids=None, sparse=False):
+    """
+    Genotype matrix from (variant columns..., individual_id, genotype) rows
+    ordered by variant: individuals are the rows, variants the columns
+
+    :param individual_ids: the matrix rows, in order; if None, every
+                           individual with a call, in id order
+    :param sparse: give the calls as (row, column, genotype) lists rather
+                   than as a full matrix with nulls where there is no call
+    """
+    n_columns = len(ser.keys)
+    id_at = ser.keys.index('id')
+    variants, calls = [], []
+    last_variant = None
+    for row in rows:
+        if row[id_at] != last_variant:
+            last_variant = row[id_at]
+            variants.append(ser(row))
+        if row[n_columns] is not None:
+            calls.append((row[n_columns], len(variants) - 1, row[n_columns + 1]))
+
+    if individual_ids is None:
+        individual_ids = sorted({call[0] for call in calls})
+    positions = {ind_id: i for i, ind_id in enumerate(individual_ids)}
+    calls = [(positions[ind_id], column, genotype)
+             for ind_id, column, genotype in calls if ind_id in positions]
+
+    matrix = {'individuals': [str(ind_id) for ind_id in individual_ids],
+              'variants': variants}
+    if sparse:
+        rows, columns, genotypes = zip(*calls) if calls else ((), (), ())
+        matrix['calls'] = {'rows': list(rows), 'columns': list(columns),
+                           'genotypes': list(genotypes)}
+    else:
+        genotypes = [[None] * len(variants) for _ in individual_ids]
+        for row, column, genotype in calls:
+            genotypes[row][column] = genotype
+        matrix['genotypes'] = genotypes
+    return matrix
+
+
+@apilog
+def get_genotypes(chromosome, start, end,  # pylint:disable=too-many-arguments,too-many-locals
+                  individuals=None, sparse=False, limit=None, after=None):
+    """
+    Return the genotypes of the variants between [chrom, start) and
+    (chrom, end], in all or some individuals, as a matrix
+    """
+    db_session = orm.get_session()
+    individual_ids = None
+    if individuals:
+        try:
+            individual_ids = list(OrderedDict.fromkeys(uuid.UUID(ind_id) for ind_id in individuals))
+        except ValueError:
+            err = Error(message="Invalid individual id in: "+','.join(individuals), code=400)
+            return err, 400
+        try:
+            missing = _missing_individuals(db_session, individual_ids)
+        except orm.ORMException as e:
+            err = _report_search_failed('individual', e, individuals=','.join(individuals))
+            return err, 500
+        if missing:
+            err = Error(message="No individual found: "+str(missing[0]), code=404)
+            return err, 404
+
+    ser = serializer(models.Variant)
+    key = [models.Variant.start, models.Variant.id]
+    try:
+        # the page of variants, then one indexed join to their calls
+        page = paginate(region_filter(db_session.query(*key), chromosome, start, end),
+                        key, after)
+        if limit:
+            page = page.limit(limit + 1)
+        page = page.subquery()
+        on_call = models.Call.variant_id == models.Variant.id
+        if individual_ids and len(individual_ids) <= BATCH_QUERY_CHUNK:
+            on_call = and_(on_call, models.Call.individual_id.in_(individual_ids))
+        q = db_session.query(*ser.columns, models.Call.individual_id, models.Call.genotype)\
+            .join(page, page.c.id == models.Variant.id)\
+            .outerjoin(models.Call, on_call)\
+            .order_by(models.Variant.start, models.Variant.id)
+        rows = q.all()
+    except PageTokenError as e:
+        err = _report_bad_page_token('genotype', e, after=after)
+        return err, 400
+    except orm.ORMException as e:
+        err = _report_search_failed('genotype', e, chromosome=chromosome, start=start, end=end)
+        return err, 500
+
+    headers = {}
+    id_at, start_at = ser.keys.index('id'), ser.keys.index('start')
+    if limit:
+        # rows past this page are all of the one extra variant, at the end
+        variant_ids = list(OrderedDict.fromkeys(row[id_at] for row in rows))
+        if len(variant_ids) > limit:
+            rows = rows[:[row[id_at] for row in rows].index(variant_ids[limit])]
+            headers['Link'] = next_link(encode_token([rows[-1][start_at], rows[-1][id_at]]))
+
+    return _genotype_matrix(rows, ser, individual_ids, sparse), 200, headers
+
+
+@apilog
+def post_export():
+    """
+    Start exporting the calls as a genotype matrix, in the background
+    """
+    try:
+        status = exports.start_export()
+    except OSError as e:
+        logger().error(struct_log(action='export failed to start', exception=str(e)))
+        return Error(message='Internal error starting export', code=500), 500
+
+    logger().info(struct_log(action='export_started', id=status['id']))
+    return status, 202, {'Location': BASEPATH+'/exports/'+status['id']}
+
+
+@apilog
+def get_export(export_id):
+    """
+    Report on an export
+    """
+    status = exports.read_status(export_id)
+    if status is None:
+        err = Error(message="No export found: "+str(export_id), code=404)
+        return err, 404
+    return status, 200
+
+
+@apilog
+def get_cache_stats():
+    """
+    Return the single-object cache counters
+    """
+    return OBJECT_CACHE.stats(), 200
+
+
+def get_metrics():
+    """
+    Return request metrics in Prometheus text format
+    """
+    return METRICS.render(), 200
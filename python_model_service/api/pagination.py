@@ -0,0 +1,89 @@
+"""
+Keyset ("cursor") pagination for list endpoints
+
+Pages are ordered by a fixed tuple of key columns; the opaque `after`
+token is just the key of the last row of the previous page, so fetching
+any page is an indexed range scan rather than an ever-growing OFFSET.
+"""
+
+import base64
+import binascii
+import json
+import uuid
+from urllib.parse import urlencode
+
+from flask import request
+from sqlalchemy import and_, or_
+from python_model_service.orm.guid import GUID
+
+
+class PageTokenError(ValueError):
+    """Page token could not be decoded"""
+
+
+def encode_token(values):
+    """
+    Opaque token from a tuple of key values
+    """
+    plain = [v.hex if isinstance(v, uuid.UUID) else v for v in values]
+    raw = json.dumps(plain, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_token(token, columns):
+    """
+    Key values for the given columns from an opaque token
+
+    :raises PageTokenError: if the token is malformed
+    """
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise PageTokenError('wrong number of key values')
+        return [uuid.UUID(v) if isinstance(col.type, GUID) else v
+                for col, v in zip(columns, values)]
+    except (binascii.Error, UnicodeError, TypeError, AttributeError, ValueError) as e:
+        raise PageTokenError('Invalid page token: ' + str(token)) from e
+
+
+def row_key(row, columns):
+    """Key values for the given columns from an ORM object"""
+    return [getattr(row, col.key) for col in columns]
+
+
+def _after_clause(columns, values):
+    """
+    Lexicographic (c0, c1, ...) > (v0, v1, ...), spelled out so that it
+    doesn't rely on row-value support in the database
+    """
+    clauses = []
+    for i, (col, value) in enumerate(zip(columns, values)):
+        equal = [c == v for c, v in zip(columns[:i], values[:i])]
+        clauses.append(and_(*(equal + [col > value])))
+    return or_(*clauses)
+
+
+def paginate(query, columns, after=None):
+    """
+    Order the query by the key columns and skip everything up to and
+    including the row identified by `after`
+
+    :raises PageTokenError: if `after` is malformed
+    """
+    query = query.order_by(*columns)
+    if after:
+        query = query.filter(_after_clause(columns, decode_token(after, columns)))
+    return query
+
+
+def next_link(token, base_url=None, args=None):
+    """
+    RFC 5988 Link header value for the next page of the current request,
+    or of the request with the given URL (without query) and arguments
+    """
+    if base_url is None:
+        base_url, args = request.base_url, request.args.to_dict()
+    args = dict(args)
+    args['after'] = token
+    return '<' + base_url + '?' + urlencode(args) + '>; rel="next"'
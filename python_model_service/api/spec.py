@@ -0,0 +1,117 @@
+"""
+The API definition, parsed once and cached
+
+Parsing swagger.yaml with PyYAML's pure-Python loader is the slowest
+single step in starting a worker, and api.models and connexion each used
+to do it.  The parsed spec is instead cached as JSON, tagged with a
+digest of the YAML it came from, so that the YAML is only parsed again
+when it changes.  The cache is written on first use if possible, or
+ahead of time - eg when building an image - with
+
+    python -m python_model_service compile-spec
+
+Connexion and bravado still resolve references and build their own
+structures from the parsed spec.
+"""
+import os
+import sys
+import json
+import hashlib
+import logging
+import argparse
+import functools
+
+LOGGER = logging.getLogger(__name__)
+
+SPEC_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'swagger.yaml')
+
+# where the parsed spec is cached; overridden by MODEL_SERVICE_SPEC_CACHE
+DEFAULT_CACHE_FILE = os.path.join(os.path.dirname(SPEC_FILE), 'swagger.json')
+
+
+def cache_file():
+    """Path of the parsed spec cache"""
+    return os.environ.get('MODEL_SERVICE_SPEC_CACHE', DEFAULT_CACHE_FILE)
+
+
+def _digest(source):
+    """Digest identifying a version of the YAML"""
+    return hashlib.sha1(source).hexdigest()
+
+
+def _read_cache(path, digest):
+    """The cached spec's JSON text, or None if absent or out of date"""
+    try:
+        with open(path, 'r') as cached:
+            if cached.readline().strip() == digest:
+                return cached.read()
+    except OSError:
+        pass
+    return None
+
+
+def _parse(source):
+    """The YAML's content as JSON text"""
+    import yaml
+    return json.dumps(yaml.safe_load(source), separators=(',', ':'))
+
+
+def _write_cache(path, digest, text):
+    """
+    Write the cache - to a temporary file first, then renamed, so that
+    workers starting together never read a partial one
+    """
+    partial = '%s.%d' % (path, os.getpid())
+    with open(partial, 'w') as cached:
+        cached.write(digest + '\n' + text)
+    os.replace(partial, path)
+
+
+def compile_spec(path=None):
+    """
+    Parse the YAML and write the cache
+
+    :param path: cache file to write, by default cache_file()
+    """
+    with open(SPEC_FILE, 'rb') as spec:
+        source = spec.read()
+    _write_cache(path or cache_file(), _digest(source), _parse(source))
+
+
+@functools.lru_cache(maxsize=1)
+def _spec_text():
+    """The spec's JSON text, from the cache if it is up to date"""
+    with open(SPEC_FILE, 'rb') as spec:
+        source = spec.read()
+    digest = _digest(source)
+    text = _read_cache(cache_file(), digest)
+    if text is None:
+        text = _parse(source)
+        try:
+            _write_cache(cache_file(), digest, text)
+        except OSError as e:
+            LOGGER.debug('could not cache the parsed spec: %s', e)
+    return text
+
+
+def load_spec():
+    """
+    The parsed spec, as a new dict each time: connexion and bravado
+    both modify the spec they are given
+    """
+    return json.loads(_spec_text())
+
+
+def main(args=None):
+    """Command line entry point: compile-spec"""
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser('python_model_service compile-spec',
+                                     description='Parse the API spec ahead of time')
+    parser.add_argument('--output', default=None,
+                        help='cache file to write; by default ' + DEFAULT_CACHE_FILE +
+                        ', or MODEL_SERVICE_SPEC_CACHE if set')
+    args = parser.parse_args(args)
+    compile_spec(args.output)
+    return 0
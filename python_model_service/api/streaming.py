@@ -0,0 +1,189 @@
+"""
+Streamed and compressed responses for large result sets
+
+JSON arrays are encoded a batch of rows at a time rather than built as
+one list and one string, so a large response starts going out after
+its first batch and memory use doesn't grow with its size.
+CompressionMiddleware gzips or deflates responses for clients which
+accept it, chunk by chunk, so compressed streams still arrive as they
+are produced.
+"""
+import re
+import zlib
+from itertools import islice
+
+from flask import Response, json, stream_with_context
+from python_model_service.api import etags
+
+YIELD_PER = 1000
+
+# rows encoded per chunk of a JSON array
+BATCH_ROWS = 500
+
+
+def json_array(rows, serialize, batch_rows=BATCH_ROWS):
+    """
+    Generate a JSON array chunk by chunk, serializing rows as they are
+    produced and encoding each batch of them in one call
+    """
+    rows = iter(rows)
+    separator = '['
+    while True:
+        batch = [serialize(row) for row in islice(rows, batch_rows)]
+        if not batch:
+            break
+        yield separator + json.dumps(batch)[1:-1]
+        separator = ','
+    yield '[]' if separator == '[' else ']'
+
+
+def json_response(rows, serialize, status=200, headers=None):
+    """
+    Flask response for rows already fetched, encoded incrementally as
+    it is written rather than as a single string
+    """
+    return Response(json_array(rows, serialize), status=status, headers=headers,
+                    mimetype='application/json')
+
+
+def streamed_response(query, serialize, status=200, headers=None):
+    """
+    Flask response writing the query's rows as they are fetched from
+    the database, so memory use doesn't grow with the result size
+
+    Note that if the response is checked against the API spec, the body
+    is kept in memory to check it: collected before it is sent if the
+    check is strict, or as it is sent if the response is sampled.
+    """
+    rows = query.yield_per(YIELD_PER)
+    return Response(stream_with_context(json_array(rows, serialize)),
+                    status=status, headers=headers,
+                    mimetype='application/json')
+
+
+# zlib window bits giving each content-coding's framing
+_WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+_COMPRESSIBLE = re.compile(r'^(text/|application/([\w.+-]+\+)?json)')
+
+# responses of a known length below this are sent as they are
+MIN_SIZE = 1024
+
+DEFAULT_LEVEL = 6
+
+
+def accepted_coding(accept_encoding):
+    """
+    gzip or deflate, whichever of them an Accept-Encoding header prefers
+    (gzip if tied), or None for neither
+    """
+    quality = {}
+    for item in accept_encoding.split(','):
+        parts = item.strip().split(';')
+        coding = parts[0].strip().lower()
+        q = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding:
+            quality[coding] = q
+
+    best, best_q = None, 0.0
+    for coding in ('gzip', 'deflate'):
+        q = quality.get(coding, quality.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def _vary(headers):
+    """Response headers with Accept-Encoding added to any Vary header"""
+    for i, (name, value) in enumerate(headers):
+        if name.lower() == 'vary':
+            if 'accept-encoding' in value.lower() or value.strip() == '*':
+                return headers
+            headers = list(headers)
+            headers[i] = (name, value + ', Accept-Encoding')
+            return headers
+    return list(headers) + [('Vary', 'Accept-Encoding')]
+
+
+class CompressionMiddleware(object):
+    """
+    WSGI middleware compressing JSON and text responses with the
+    content-coding negotiated by Accept-Encoding
+
+    The body is compressed as the app produces it, with a sync flush
+    after each chunk so that nothing written is held back; compressed
+    responses drop any Content-Length, and are sent chunked, with the
+    ETag of the compressed representation.  Every response gets
+    Vary: Accept-Encoding.
+    """
+    def __init__(self, app, level=DEFAULT_LEVEL, min_size=MIN_SIZE):
+        self.app = app
+        self.level = level
+        self.min_size = min_size
+
+    def __call__(self, environ, start_response):
+        coding = accepted_coding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            coding = None
+
+        compressor = []
+
+        def compressing_start_response(status, headers, exc_info=None):
+            """Switch to the compressed form if the response suits"""
+            # whether or not this one is compressed, the response depends on
+            # Accept-Encoding, so shared caches mustn't serve it to every client
+            headers = _vary(headers)
+            if coding is not None and self._compressible(status, headers):
+                headers = [(name, etags.encoded_etag(value, coding)
+                            if name.lower() == 'etag' else value)
+                           for name, value in headers if name.lower() != 'content-length']
+                headers.append(('Content-Encoding', coding))
+                compressor.append(zlib.compressobj(self.level, zlib.DEFLATED, _WBITS[coding]))
+            elif status.startswith('304'):
+                if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+                headers = [(name, etags.not_modified_etag(value, coding, if_none_match)
+                            if name.lower() == 'etag' else value)
+                           for name, value in headers]
+            return start_response(status, headers, exc_info)
+
+        app_iter = self.app(environ, compressing_start_response)
+        if not compressor and hasattr(app_iter, '__len__'):
+            return app_iter
+        return self._compress(app_iter, compressor)
+
+    def _compressible(self, status, headers):
+        """Is a response with this status and these headers worth compressing?"""
+        if int(status.split(' ', 1)[0]) in (204, 304):
+            return False
+        values = {name.lower(): value for name, value in headers}
+        if 'content-encoding' in values:
+            return False
+        if not _COMPRESSIBLE.match(values.get('content-type', '')):
+            return False
+        length = values.get('content-length')
+        return length is None or int(length) >= self.min_size
+
+    @staticmethod
+    def _compress(app_iter, compressor):
+        """
+        Compress the app's chunks as they come, if start_response (which
+        the app may call as late as its first chunk) chose to
+        """
+        try:
+            for chunk in app_iter:
+                if not compressor:
+                    yield chunk
+                elif chunk:
+                    yield compressor[0].compress(chunk) + compressor[0].flush(zlib.Z_SYNC_FLUSH)
+            if compressor:
+                yield compressor[0].flush()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
@@ -0,0 +1,252 @@
+"""
+Checking responses against the API spec, on a sample of requests
+
+connexion's response validation checks every response body against its
+schema and replaces an invalid one with a 500.  That is what the tests
+want, but for a long list checking the body costs more than producing
+it, and a streamed body has to be collected first to be checked at all.
+
+SampledResponseValidator, installed through add_api's validator_map,
+checks responses according to the policy set by configure_validation:
+
+* strict (the default, and what the tests use): every response is
+  checked before it is sent, and an invalid one becomes a 500, as with
+  connexion's own validator
+* otherwise, a random sample of responses and every response of the
+  operations listed are checked, on a background thread once the body
+  has been sent; invalid responses are still sent as they are
+
+Either way, the response is serialized once, and what is checked is
+the body as sent.  A sampled response is sent as usual, streamed or not,
+keeping the chunks it is sent in, up to MAX_RECORDED bytes; once it has
+all been sent, they are handed to the background thread to join and
+check.  A longer body is not kept, and is counted as dropped.  Failures are
+logged and counted in the metrics.  Responses which are not checked are
+passed through untouched.
+"""
+import queue
+import random
+import logging
+import threading
+import functools
+
+from connexion.decorators.response import ResponseValidator
+from connexion.exceptions import NonConformingResponseBody, NonConformingResponseHeaders
+from connexion.problem import problem
+from python_model_service.api.logging import logger
+from python_model_service.api.logging import structured_log as struct_log
+from python_model_service.api.metrics import METRICS
+
+LOGGER = logging.getLogger(__name__)
+
+# fraction of responses checked when not strict, unless configured
+DEFAULT_SAMPLE_RATE = 0.01
+
+# responses waiting to be checked before more are dropped unchecked
+QUEUE_SIZE = 100
+
+# bytes of a sampled body kept to check; longer bodies go unchecked
+MAX_RECORDED = 1024 * 1024
+
+
+class _ValidationConfig(object):
+    """Which responses to check, and how"""
+    strict = True
+    sample_rate = DEFAULT_SAMPLE_RATE
+    operations = frozenset()
+
+    def sampled(self, operation):
+        """Should this response of the operation be checked?"""
+        return (self.strict or operation in self.operations or
+                random.random() < self.sample_rate)
+
+
+VALIDATION = _ValidationConfig()
+
+
+def configure_validation(strict=None, sample_rate=None, operations=None):
+    """
+    Check every response before sending it (strict), or a sample of them
+    after: the fraction given, plus every response of the operations
+    given, named as in the metrics (eg get_variants)
+    """
+    if strict is not None:
+        VALIDATION.strict = strict
+    if sample_rate is not None:
+        VALIDATION.sample_rate = sample_rate
+    if operations is not None:
+        VALIDATION.operations = frozenset(operations)
+
+
+class _Stats(object):
+    """Thread-safe counts of responses checked, failed and dropped"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checked = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def count(self, name):
+        """Add one to the named count"""
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+
+STATS = _Stats()
+
+
+def _validation_metrics():
+    """Response validation counts"""
+    return [('response_validations_total', 'counter',
+             'Responses checked against the API spec', STATS.checked),
+            ('response_validation_failures_total', 'counter',
+             'Responses which did not match the API spec', STATS.failed),
+            ('response_validations_dropped_total', 'counter',
+             'Sampled responses left unchecked, too long or with the validation queue full',
+             STATS.dropped)]
+
+
+METRICS.register_collector(_validation_metrics)
+
+
+class _Checker(object):
+    """Background thread checking queued responses"""
+    def __init__(self, queue_size=QUEUE_SIZE):
+        self.queue = queue.Queue(queue_size)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, check, *args):
+        """Queue a check, or drop it if the thread is too far behind"""
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='validation', daemon=True)
+                self.thread.start()
+        try:
+            self.queue.put_nowait((check, args))
+        except queue.Full:
+            STATS.count('dropped')
+
+    def _run(self):
+        while True:
+            check, args = self.queue.get()
+            try:
+                check(*args)
+            except Exception:  # pylint:disable=broad-except
+                LOGGER.exception('Error checking a response')
+
+
+CHECKER = _Checker()
+
+
+class _Recorder(object):
+    """
+    Response body passing chunks through as they are sent, and calling
+    on_sent with all of them if the whole body was; past max_size bytes
+    (a long streamed list, say) it stops keeping them, and the response
+    is counted as dropped rather than checked
+    """
+    def __init__(self, body, on_sent, max_size=MAX_RECORDED):
+        self.body = body
+        self.on_sent = on_sent
+        self.chunks = []
+        self.size = 0
+        self.max_size = max_size
+        self.complete = False
+
+    def __iter__(self):
+        for chunk in self.body:
+            if self.chunks is not None:
+                self.size += len(chunk)
+                if self.size <= self.max_size:
+                    self.chunks.append(chunk)
+                else:
+                    self.chunks = None
+            yield chunk
+        self.complete = True
+
+    def close(self):
+        """Close the body, then pass on the chunks sent"""
+        if hasattr(self.body, 'close'):
+            self.body.close()
+        on_sent, self.on_sent = self.on_sent, None
+        if not self.complete or on_sent is None:
+            return
+        if self.chunks is None:
+            STATS.count('dropped')
+        else:
+            on_sent(self.chunks)
+
+
+def _joined(chunks):
+    """The body sent in chunks of text or bytes"""
+    return b''.join(chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+                    for chunk in chunks)
+
+
+class SampledResponseValidator(ResponseValidator):
+    """
+    Response validator which checks responses as VALIDATION says
+    """
+    def check(self, target_logger, body, status_code, headers,  # pylint:disable=too-many-arguments
+              url):
+        """
+        Check a response, logging and counting any failure
+
+        :return: the failure, or None if the response is valid
+        """
+        STATS.count('checked')
+        try:
+            self.validate_response(body, status_code, headers, url)
+        except (NonConformingResponseBody, NonConformingResponseHeaders) as e:
+            STATS.count('failed')
+            target_logger.warning(struct_log(action='Response does not match the API spec',
+                                             operation=self.operation_name, status=status_code,
+                                             url=url, error=e.message.split('\n', 1)[0]))
+            return e
+        return None
+
+    def check_chunks(self, target_logger, chunks, status_code,  # pylint:disable=too-many-arguments
+                     headers, url):
+        """Check a response sent in the given chunks"""
+        return self.check(target_logger, _joined(chunks), status_code, headers, url)
+
+    @property
+    def operation_name(self):
+        """The handler's name, as the metrics give it"""
+        return self.operation.operation_id.rsplit('.', 1)[-1]
+
+    def __call__(self, function):
+        operation_name = self.operation_name
+
+        @functools.wraps(function)
+        def wrapper(request):
+            response = function(request)
+            if not VALIDATION.sampled(operation_name):
+                return response
+
+            # the Flask response, which is sent as it is
+            response = self.operation.api.get_response(response, self.mimetype)
+            target_logger, status_code = logger(), response.status_code
+            headers, url = dict(response.headers), request.url
+            if not VALIDATION.strict:
+                response.response = _Recorder(
+                    response.response,
+                    lambda chunks: CHECKER.submit(self.check_chunks, target_logger, chunks,
+                                                  status_code, headers, url))
+                return response
+
+            # this collects a streamed body; the response still sends it
+            error = self.check(target_logger, response.get_data(), status_code, headers, url)
+            if error is not None:
+                return self.operation.api.get_response(problem(500, error.reason, error.message))
+            return response
+
+        return wrapper
+
+    def __repr__(self):
+        return '<SampledResponseValidator>'
+
+
+# validator_map for add_api
+VALIDATOR_MAP = {'response': SampledResponseValidator}
@@ -0,0 +1,254 @@
+"""
+Columnar genotype matrix export
+
+Writes the calls table as a dense individuals x variants matrix of small
+integer genotype codes, in NumPy's .npy format so that it can be memory
+mapped rather than parsed:
+
+    genotypes.npy    int8, shape (individuals, variants)
+    individuals.npy  one record per matrix row: id (16 UUID bytes)
+    variants.npy     one record per matrix column: id, chromosome,
+                     start, ref, alt
+    metadata.json    shape, genotype codes and provenance; written last,
+                     so an export is complete once it exists
+
+Rows are in id order, columns in chromosome, start, ref, alt order.  A
+genotype code is the number of alternate alleles called (0 for 0/0, 1
+for 0/1, 2 for 1/1 or 1/2), MISSING if any allele is missing (./.) and
+ABSENT where there is no call at all - eg for reference calls left out
+on import.
+
+    matrix = numpy.load('export/genotypes.npy', mmap_mode='r')
+
+The calls are streamed from the database in batches; each batch's ids
+are mapped to matrix positions with a sorted search over the index
+arrays, and its genotype strings encoded through a table of the
+distinct values, so no per-call Python objects are built beyond the
+rows themselves.  The matrix is written through a memory map, and so
+need not fit in memory.
+"""
+import os
+import sys
+import json
+import uuid
+import argparse
+import datetime
+import logging
+
+import numpy
+from numpy.lib.format import open_memmap
+from sqlalchemy import LargeBinary, String, func, select, type_coerce
+
+from python_model_service import orm
+from python_model_service.orm import guid
+from python_model_service.orm.models import Individual, Variant, Call
+
+LOGGER = logging.getLogger(__name__)
+
+GENOTYPE_DTYPE = numpy.int8
+MISSING = -1
+ABSENT = -2
+
+# calls fetched from the database at a time
+BATCH_SIZE = 100000
+
+GENOTYPES_FILE = 'genotypes.npy'
+INDIVIDUALS_FILE = 'individuals.npy'
+VARIANTS_FILE = 'variants.npy'
+METADATA_FILE = 'metadata.json'
+
+
+def genotype_code(genotype):
+    """Matrix code for a genotype string such as '0/1' or '1|2'"""
+    alleles = (genotype or '').replace('|', '/').split('/')
+    if any(allele in ('', '.') for allele in alleles):
+        return MISSING
+    return min(sum(allele != '0' for allele in alleles), numpy.iinfo(GENOTYPE_DTYPE).max)
+
+
+def encode_genotypes(genotypes):
+    """Codes for an array of genotype strings, encoding each distinct value once"""
+    distinct, inverse = numpy.unique(genotypes, return_inverse=True)
+    table = numpy.array([genotype_code(genotype) for genotype in distinct],
+                        dtype=GENOTYPE_DTYPE)
+    return table[inverse.reshape(-1)]
+
+
+class _Positions(object):
+    """Maps raw stored ids to their positions in an index array"""
+    def __init__(self, raw_ids):
+        self.order = numpy.argsort(raw_ids, kind='stable')
+        self.sorted = raw_ids[self.order]
+
+    def lookup(self, raw_ids):
+        """
+        Positions of the ids, and a mask of which were found
+        """
+        if not len(self.sorted):  # pylint:disable=len-as-condition
+            return numpy.zeros(len(raw_ids), dtype=numpy.intp), \
+                numpy.zeros(len(raw_ids), dtype=bool)
+        found_at = numpy.searchsorted(self.sorted, raw_ids)
+        found_at[found_at == len(self.sorted)] = 0
+        return self.order[found_at], self.sorted[found_at] == raw_ids
+
+
+def _raw(column, engine):
+    """
+    The column as stored, without conversion to UUIDs: ids are only
+    compared with each other here, so their stored form will do
+    """
+    if engine.dialect.name != 'postgresql' and \
+            getattr(engine.dialect, 'guid_storage', None) == guid.BINARY_STORAGE:
+        return type_coerce(column, LargeBinary)
+    return type_coerce(column, String)
+
+
+def _uuid_bytes(raw_ids):
+    """Index array of 16-byte UUIDs from raw stored ids"""
+    return numpy.frombuffer(b''.join(guid.to_uuid(raw).bytes for raw in raw_ids),
+                            dtype=numpy.uint8).reshape(-1, 16)
+
+
+def _width(values):
+    """Width for a fixed-width byte string field holding the values"""
+    return max([len(value) for value in values] + [1])
+
+
+def _index_arrays(conn, engine):
+    """
+    Read the individuals and variants
+
+    :return: individual and variant index arrays, and the raw ids of each
+    """
+    individuals = conn.execute(select([_raw(Individual.id, engine)])
+                               .order_by(Individual.id)).fetchall()
+    individual_ids = [row[0] for row in individuals]
+    individual_index = numpy.zeros(len(individual_ids), dtype=[('id', numpy.uint8, (16,))])
+    individual_index['id'] = _uuid_bytes(individual_ids)
+
+    variants = conn.execute(
+        select([_raw(Variant.id, engine), Variant.chromosome, Variant.start,
+                Variant.ref, Variant.alt])
+        .order_by(Variant.chromosome, Variant.start, Variant.ref, Variant.alt)).fetchall()
+    variant_ids, chromosomes, starts, refs, alts = \
+        zip(*variants) if variants else ((), (), (), (), ())
+    chromosomes, refs, alts = [[(value or '').encode() for value in values]
+                               for values in (chromosomes, refs, alts)]
+    variant_index = numpy.zeros(len(variant_ids), dtype=[
+        ('id', numpy.uint8, (16,)), ('chromosome', 'S%d' % _width(chromosomes)),
+        ('start', numpy.int64), ('ref', 'S%d' % _width(refs)), ('alt', 'S%d' % _width(alts))])
+    variant_index['id'] = _uuid_bytes(variant_ids)
+    variant_index['chromosome'] = chromosomes
+    variant_index['start'] = [start if start is not None else -1 for start in starts]
+    variant_index['ref'] = refs
+    variant_index['alt'] = alts
+
+    return (individual_index, numpy.array(individual_ids),
+            variant_index, numpy.array(variant_ids))
+
+
+def export_matrix(engine, directory, batch_size=BATCH_SIZE):
+    """
+    Write the genotype matrix and its index arrays to a directory
+
+    :param engine: engine of the database to export
+    :param directory: output directory, created if need be
+    :return: the metadata written
+    """
+    os.makedirs(directory, exist_ok=True)
+    metadata_path = os.path.join(directory, METADATA_FILE)
+    if os.path.exists(metadata_path):
+        os.remove(metadata_path)
+
+    with engine.connect() as conn:
+        individual_index, individual_ids, variant_index, variant_ids = \
+            _index_arrays(conn, engine)
+        shape = (len(individual_index), len(variant_index))
+        LOGGER.info('exporting %d x %d genotype matrix to %s', shape[0], shape[1], directory)
+
+        genotypes_path = os.path.join(directory, GENOTYPES_FILE)
+        if not shape[0] or not shape[1]:
+            # an empty file can't be memory mapped
+            numpy.save(genotypes_path, numpy.zeros(shape, dtype=GENOTYPE_DTYPE))
+            matrix = None
+        else:
+            matrix = open_memmap(genotypes_path, mode='w+', dtype=GENOTYPE_DTYPE, shape=shape)
+            matrix[:] = ABSENT
+        rows, columns = _Positions(individual_ids), _Positions(variant_ids)
+
+        # in individual order, so writes to the matrix move along its rows
+        calls = conn.execution_options(stream_results=True).execute(
+            select([_raw(Call.individual_id, engine), _raw(Call.variant_id, engine),
+                    func.coalesce(Call.genotype, '')])
+            .order_by(Call.individual_id))
+        exported = 0
+        while matrix is not None:
+            batch = calls.fetchmany(batch_size)
+            if not batch:
+                break
+            batch_individuals, batch_variants, genotypes = zip(*batch)
+            row, row_found = rows.lookup(numpy.array(batch_individuals))
+            column, column_found = columns.lookup(numpy.array(batch_variants))
+            found = row_found & column_found
+            matrix[row[found], column[found]] = encode_genotypes(numpy.array(genotypes))[found]
+            exported += int(found.sum())
+        if matrix is not None:
+            matrix.flush()
+            del matrix
+
+    numpy.save(os.path.join(directory, INDIVIDUALS_FILE), individual_index)
+    numpy.save(os.path.join(directory, VARIANTS_FILE), variant_index)
+    metadata = {
+        'individuals': shape[0],
+        'variants': shape[1],
+        'calls': exported,
+        'genotypes': {'file': GENOTYPES_FILE, 'dtype': numpy.dtype(GENOTYPE_DTYPE).name,
+                      'shape': list(shape), 'missing': MISSING, 'absent': ABSENT},
+        'individual_index': INDIVIDUALS_FILE,
+        'variant_index': VARIANTS_FILE,
+        'created': datetime.datetime.utcnow().isoformat() + 'Z',
+    }
+    partial = metadata_path + '.partial'
+    with open(partial, 'w') as outfile:
+        json.dump(metadata, outfile, indent=2)
+    os.replace(partial, metadata_path)
+    LOGGER.info('exported %d calls', exported)
+    return metadata
+
+
+def load_matrix(directory, mmap_mode='r'):
+    """
+    Open an export: (genotypes, individual index, variant index), memory
+    mapped unless mmap_mode is None
+    """
+    return tuple(numpy.load(os.path.join(directory, name), mmap_mode=mmap_mode)
+                 for name in (GENOTYPES_FILE, INDIVIDUALS_FILE, VARIANTS_FILE))
+
+
+def index_uuids(index):
+    """The UUIDs of an individual or variant index array, in order"""
+    return [uuid.UUID(bytes=bytes(record)) for record in index['id']]
+
+
+def main(args=None):
+    """Command line entry point: export-matrix"""
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser('python_model_service export-matrix',
+                                     description='Export calls as a genotype matrix')
+    parser.add_argument('output', help='directory to write the matrix and index arrays to')
+    parser.add_argument('--database', default="./data/model_service.sqlite")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help='calls read from the database at a time')
+    parser.add_argument('--loglevel', default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARN', 'ERROR', 'CRITICAL'])
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=getattr(logging, args.loglevel.upper()),
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    engine = orm.make_engine('sqlite:///' + args.database)
+    export_matrix(engine, args.output, args.batch_size)
+    engine.dispose()
+    return 0
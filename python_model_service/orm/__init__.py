@@ -3,12 +3,13 @@ ORM module for service
 """
 import os
 import warnings
-from sqlalchemy import event, create_engine, exc
+from sqlalchemy import event, create_engine, exc, inspect
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.ext.declarative import declarative_base
-from python_model_service.orm.history_meta import versioned_session
-from tornado.options import options
+from python_model_service.orm.history_meta import versioned_session, create_history_indexes
+from python_model_service.orm import guid, compact
 
 ORMException = SQLAlchemyError
 
@@ -50,17 +51,117 @@ def add_engine_pidguard(engine):
             )
 
 
-def init_db(uri=None):
+# PRAGMA settings applied to every new SQLite connection.  "default"
+# leaves SQLite's own settings alone; "wal" allows readers to proceed
+# alongside a writer, fsyncs only at checkpoints, and gives each
+# connection a 64MB page cache and 256MB of memory-mapped I/O.
+SQLITE_PROFILES = {
+    'default': {},
+    'wal': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -64000,
+        'mmap_size': 256 * 1024 * 1024,
+        'busy_timeout': 5000,
+        'temp_store': 'MEMORY',
+    },
+}
+
+
+def sqlite_pragmas(profile='default', **overrides):
     """
-    Creates the DB engine + ORM
+    PRAGMA settings for a named profile, with any non-None overrides
+    """
+    pragmas = dict(SQLITE_PROFILES[profile])
+    pragmas.update((name, value) for name, value in overrides.items()
+                   if value is not None)
+    return pragmas
+
+
+def add_sqlite_pragmas(engine, pragmas):
+    """
+    Apply PRAGMA settings to each new connection of the engine
+    """
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, _connection_record):  # pylint:disable=unused-variable
+        """Run the PRAGMAs at connect time"""
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA %s = %s" % (name, value))
+        cursor.close()
+
+
+def make_engine(uri, guid_storage=None,  # pylint:disable=too-many-arguments
+                pragmas=None, pool_size=None, genotype_storage=None):
+    """
+    Create an engine for the models, creating any missing tables and
+    history indexes
+
+    :param uri: database URI
+    :param guid_storage: guid.CHAR_STORAGE or guid.BINARY_STORAGE; by
+                         default, whatever an existing DB uses, and
+                         binary for new DBs
+    :param pragmas: dict of PRAGMAs for SQLite connections (see sqlite_pragmas)
+    :param pool_size: keep this many SQLite connections open for reuse,
+                      so per-connection caches and PRAGMAs persist;
+                      by default each session opens a new connection
+    :param genotype_storage: compact.TEXT_STORAGE or compact.COMPACT_STORAGE
+                             for a new DB, text by default; an existing DB
+                             keeps whatever it uses
     """
-    global _ENGINE
     import python_model_service.orm.models # noqa401 #pylint: disable=unused-variable
+
+    kwargs = {}
+    if pool_size and uri.startswith('sqlite') and ':memory:' not in uri:
+        kwargs = {'poolclass': QueuePool, 'pool_size': pool_size,
+                  'max_overflow': pool_size,
+                  'connect_args': {'check_same_thread': False}}
+    engine = create_engine(uri, convert_unicode=True, **kwargs)
+    add_engine_pidguard(engine)
+    if pragmas and engine.dialect.name == 'sqlite':
+        add_sqlite_pragmas(engine, pragmas)
+    guid.set_storage(engine, guid_storage or guid.detect_storage(engine))
+    compact.set_storage(engine, compact.detect_storage(
+        engine, default=genotype_storage or compact.TEXT_STORAGE))
+    tables = set(inspect(engine).get_table_names())
+    Base.metadata.create_all(bind=engine)
+    python_model_service.orm.models.add_variant_bins(engine)
+    create_history_indexes(engine, Base.metadata)
+    if 'calls' in tables and 'variant_stats' not in tables:
+        # the statistics table is new to this database; count the calls already there
+        from python_model_service.orm.stats import rebuild_stats
+        with engine.begin() as conn:
+            rebuild_stats(conn)
+    return engine
+
+
+def init_db(uri=None, guid_storage=None, pragmas=None, pool_size=None,
+            genotype_storage=None):
+    """
+    Creates the DB engine + ORM; see make_engine for the arguments
+
+    :param uri: database URI; defaults to the sqlite dbfile option
+    """
+    global _ENGINE
     if not uri:
+        from tornado.options import options
         uri = 'sqlite:///' + options.dbfile
-    _ENGINE = create_engine(uri, convert_unicode=True)
-    add_engine_pidguard(_ENGINE)
-    Base.metadata.create_all(bind=_ENGINE)
+    _ENGINE = make_engine(uri, guid_storage, pragmas, pool_size, genotype_storage)
+
+
+def get_engine():
+    """
+    The engine created by init_db
+    """
+    return _ENGINE
+
+
+def dispose_engine():
+    """
+    Close the engine's pooled connections, eg before forking workers
+    """
+    if _ENGINE is not None:
+        _ENGINE.dispose()
 
 
 def get_session(**kwargs):
@@ -73,16 +174,18 @@ def get_session(**kwargs):
                                                   autoflush=False,
                                                   bind=_ENGINE, **kwargs))
         versioned_session(_DB_SESSION)
+        from python_model_service.orm.stats import track_variant_stats
+        track_variant_stats(_DB_SESSION)
         Base.query = _DB_SESSION.query_property()
     return _DB_SESSION
 
 
 def dump(obj, nonulls=False):
     """
-    Generate dictionary  of fields without SQLAlchemy internal fields
-    & relationships
+    Generate dictionary  of fields without SQLAlchemy internal fields,
+    relationships & internal index columns
     """
-    rels = ["calls", "variant", "individual"]
+    rels = ["calls", "variant", "individual", "bin"]
     if not nonulls:
         return {k: v for k, v in vars(obj).items()
                 if not k.startswith('_') and k not in rels}
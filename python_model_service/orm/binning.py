@@ -0,0 +1,103 @@
+"""
+UCSC-style hierarchical binning for genomic intervals
+
+Every interval is assigned to the smallest bin that fully contains it;
+a range query then only has to look at the (small, fixed) set of bins
+overlapping the query region rather than scanning the whole chromosome.
+See Kent et al., Genome Res. 2002, and the UCSC binRange.c sources.
+
+Coordinates here are 0-based, half-open, as in UCSC; callers with
+1-based VCF-style positions should subtract one from the start.
+"""
+
+_BIN_FIRST_SHIFT = 17
+_BIN_NEXT_SHIFT = 3
+
+# standard scheme: 128kb, 1Mb, 8Mb, 64Mb, 512Mb bins
+_BIN_OFFSETS = (512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0)
+_BIN_MAXEND = 512 * 1024 * 1024
+
+# extended scheme for chromosomes past 512Mb: adds a 4Gb level, and is
+# offset so that extended bins never collide with standard ones
+_BIN_OFFSETS_EXTENDED = (4096 + 512 + 64 + 8 + 1, 512 + 64 + 8 + 1,
+                         64 + 8 + 1, 8 + 1, 1, 0)
+_BIN_OFFSET_OLD_TO_EXTENDED = 4681
+_BIN_MAXEND_EXTENDED = 2 ** 35
+
+
+def _bin_from_range(start, end, offsets, base):
+    """Smallest bin containing [start, end) under the given scheme"""
+    start_bin = start >> _BIN_FIRST_SHIFT
+    end_bin = (end - 1) >> _BIN_FIRST_SHIFT
+    for offset in offsets:
+        if start_bin == end_bin:
+            return base + offset + start_bin
+        start_bin >>= _BIN_NEXT_SHIFT
+        end_bin >>= _BIN_NEXT_SHIFT
+    raise ValueError("interval [%d, %d) out of range for binning" % (start, end))
+
+
+def _bin_ranges_overlapping(start, end, offsets, base):
+    """
+    Bins under the given scheme that may hold intervals overlapping
+    [start, end), as one inclusive (first, last) range per level
+    """
+    ranges = []
+    start_bin = start >> _BIN_FIRST_SHIFT
+    end_bin = (end - 1) >> _BIN_FIRST_SHIFT
+    for offset in offsets:
+        ranges.append((base + offset + start_bin, base + offset + end_bin))
+        start_bin >>= _BIN_NEXT_SHIFT
+        end_bin >>= _BIN_NEXT_SHIFT
+    return ranges
+
+
+def reg2bin(start, end):
+    """
+    Return the bin for the 0-based, half-open interval [start, end)
+    """
+    end = max(end, start + 1)
+    if end <= _BIN_MAXEND:
+        return _bin_from_range(start, end, _BIN_OFFSETS, 0)
+    if end <= _BIN_MAXEND_EXTENDED:
+        return _bin_from_range(start, end, _BIN_OFFSETS_EXTENDED,
+                               _BIN_OFFSET_OLD_TO_EXTENDED)
+    raise ValueError("interval [%d, %d) out of range for binning" % (start, end))
+
+
+def reg2bin_ranges(start, end):
+    """
+    Return inclusive (first, last) bin ranges which may contain intervals
+    overlapping the 0-based, half-open region [start, end).  There is one
+    contiguous range per binning level, so a query needs only a handful
+    of BETWEEN clauses however large the region is.
+    """
+    start = max(start, 0)
+    end = min(max(end, start + 1), _BIN_MAXEND_EXTENDED)
+    ranges = []
+    if start < _BIN_MAXEND:
+        ranges.extend(_bin_ranges_overlapping(start, min(end, _BIN_MAXEND),
+                                              _BIN_OFFSETS, 0))
+    if end > _BIN_MAXEND:
+        ranges.extend(_bin_ranges_overlapping(start, end, _BIN_OFFSETS_EXTENDED,
+                                              _BIN_OFFSET_OLD_TO_EXTENDED))
+    return ranges
+
+
+def reg2bins(start, end):
+    """
+    Return the list of bins which may contain intervals overlapping
+    the 0-based, half-open region [start, end)
+    """
+    return [b for first, last in reg2bin_ranges(start, end)
+            for b in range(first, last + 1)]
+
+
+def variant_bin(start, ref):
+    """
+    Bin for a variant given its 1-based start position and reference bases
+    """
+    if start is None:
+        return None
+    length = len(ref) if ref else 1
+    return reg2bin(start - 1, start - 1 + length)
@@ -0,0 +1,295 @@
+# pylint: disable=no-else-return
+"""
+Compact storage of calls' genotypes and formats
+
+By default Call.genotype and Call.fmt are stored as the strings the API
+gives them, on every row and on every version in calls_history.  With
+COMPACT_STORAGE (SQLite only) both are stored as integers instead:
+
+* a genotype is packed into a small integer code: its ploidy, whether
+  it is phased, and each allele index (or missing), as in encode_genotype;
+  a diploid genotype takes 2 bytes
+* format strings, and the rare genotype with no code (eg '0/1|2'), are
+  interned in the call_strings lookup table and stored by id; the
+  empty format is 0, and needs no lookup
+
+The column types convert to and from the strings, so everything above
+the database - the API, serializers, queries comparing genotypes - sees
+strings either way.
+
+An interned string's id is derived from its hash rather than allocated,
+so the id a string is stored under is known without a round trip, the
+same in every process, and can't be handed to two strings by concurrent
+transactions (with 63 bits, a collision is vanishingly unlikely below
+billions of distinct strings).  The strings a statement writing calls
+uses are added to call_strings on the same connection, in the same
+transaction; reads look them up in a per-engine cache, reloading the
+table or fetching the one string on a miss.  Interning pays where
+format strings repeat; a format unique to each call is stored once in
+call_strings instead of once per call, and saves nothing.
+
+Like GUID storage, the storage is chosen per engine (set_storage), is
+detected from an existing database's schema, and an existing database
+can be converted with migrate-guids --genotype-storage.
+"""
+import re
+import hashlib
+import functools
+import threading
+
+from sqlalchemy import TypeDecorator, Integer, String, event, inspect, text
+
+TEXT_STORAGE = 'text'
+COMPACT_STORAGE = 'compact'
+STORAGE_MODES = (TEXT_STORAGE, COMPACT_STORAGE)
+
+STRINGS_TABLE = 'call_strings'
+
+# genotype codes: ploidy in the low 3 bits, then the phasing bit, then
+# 7 bits per allele holding its index + 1, or 0 for missing
+MAX_PLOIDY = 7
+_PHASED = 1 << 3
+_ALLELE_SHIFT = 4
+_ALLELE_BITS = 7
+_ALLELE_MASK = (1 << _ALLELE_BITS) - 1
+MAX_ALLELE = _ALLELE_MASK - 1
+
+# an allele index as VCF writes it, with no sign or leading zeros
+_ALLELE_INDEX = re.compile('0|[1-9][0-9]*')
+
+# interned strings cached per engine before the cache is emptied
+MAX_CACHED = 100000
+
+
+@functools.lru_cache(maxsize=1024)
+def encode_genotype(genotype):
+    """
+    Integer code for a genotype string such as '0/1', '1|2' or './.',
+    or None if it has none: mixed phasing, too many alleles, or alleles
+    which aren't canonical indexes
+    """
+    if genotype == '':
+        return 0
+    phased = '|' in genotype
+    if phased and '/' in genotype:
+        return None
+    alleles = genotype.split('|' if phased else '/')
+    if len(alleles) > MAX_PLOIDY:
+        return None
+    code = len(alleles) | (_PHASED if phased else 0)
+    for i, allele in enumerate(alleles):
+        if allele == '.':
+            value = 0
+        elif _ALLELE_INDEX.fullmatch(allele) and int(allele) <= MAX_ALLELE:
+            value = int(allele) + 1
+        else:
+            return None
+        code |= value << (_ALLELE_SHIFT + _ALLELE_BITS * i)
+    return code
+
+
+@functools.lru_cache(maxsize=1024)
+def decode_genotype(code):
+    """Genotype string of an integer code from encode_genotype"""
+    separator = '|' if code & _PHASED else '/'
+    alleles = []
+    for i in range(code & MAX_PLOIDY):
+        value = (code >> (_ALLELE_SHIFT + _ALLELE_BITS * i)) & _ALLELE_MASK
+        alleles.append(str(value - 1) if value else '.')
+    return separator.join(alleles)
+
+
+@functools.lru_cache(maxsize=4096)
+def string_id(value):
+    """
+    Id of an interned string: negative, so as not to overlap genotype codes
+    """
+    digest = hashlib.sha256(value.encode('utf-8')).digest()[:8]
+    return -(int.from_bytes(digest, 'big') >> 1) - 1
+
+
+class _Strings(object):
+    """An engine's cache of interned strings, by id"""
+    def __init__(self, engine):
+        self.engine = engine
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def remember(self, value):
+        """Id of a string, noting the string for reads"""
+        sid = string_id(value)
+        if sid not in self.values:
+            with self.lock:
+                if len(self.values) >= MAX_CACHED:
+                    self.values.clear()
+                self.values[sid] = value
+        return sid
+
+    def value(self, sid):
+        """
+        The string with an id, from the cache or the database: the whole
+        table if it would fit in the cache, otherwise just the string
+        """
+        try:
+            return self.values[sid]
+        except KeyError:
+            pass
+        with self.engine.connect() as conn:
+            count = conn.execute(text('SELECT count(*) FROM ' + STRINGS_TABLE)).scalar()
+            if count <= MAX_CACHED:
+                rows = conn.execute(text('SELECT id, value FROM ' + STRINGS_TABLE)).fetchall()
+            else:
+                rows = conn.execute(text('SELECT id, value FROM ' + STRINGS_TABLE +
+                                         ' WHERE id = :id'), id=sid).fetchall()
+        with self.lock:
+            if len(self.values) + len(rows) > MAX_CACHED:
+                self.values.clear()
+            self.values.update((row[0], row[1]) for row in rows)
+        if sid not in self.values:
+            raise LookupError('No interned string with id %d in %s' % (sid, STRINGS_TABLE))
+        return self.values[sid]
+
+
+def set_storage(engine, storage):
+    """
+    Choose how genotypes and formats are stored for an engine:
+    TEXT_STORAGE, or COMPACT_STORAGE on SQLite
+    """
+    if storage not in STORAGE_MODES:
+        raise ValueError('Unknown genotype storage: ' + str(storage))
+    if storage == COMPACT_STORAGE and engine.dialect.name != 'sqlite':
+        raise ValueError('Compact genotype storage is only available with SQLite')
+    engine.dialect.genotype_storage = storage
+    if storage == COMPACT_STORAGE and not hasattr(engine.dialect, 'call_strings'):
+        engine.dialect.call_strings = _Strings(engine)
+        event.listen(engine, 'after_cursor_execute', _intern_strings)
+        event.listen(engine, 'commit', _end_transaction)
+        event.listen(engine, 'rollback', _end_transaction)
+        event.listen(engine, 'rollback_savepoint', _end_savepoint)
+
+
+def detect_storage(engine, table='calls', default=TEXT_STORAGE):
+    """
+    Genotype storage used by an existing database, judging by the
+    genotype column of the calls table; `default` if there isn't one yet
+    """
+    inspector = inspect(engine)
+    if table not in inspector.get_table_names():
+        return default
+    for column in inspector.get_columns(table):
+        if column['name'] == 'genotype':
+            if 'INT' in str(column['type']).upper():
+                return COMPACT_STORAGE
+            return TEXT_STORAGE
+    return default
+
+
+def _compact(dialect):
+    """Does the dialect store compact genotypes?  Engines not set up store text"""
+    return getattr(dialect, 'genotype_storage', TEXT_STORAGE) == COMPACT_STORAGE
+
+
+class _CompactString(TypeDecorator):  # pylint: disable=abstract-method
+    """String stored as an integer under COMPACT_STORAGE, as given otherwise"""
+    impl = String
+
+    def load_dialect_impl(self, dialect):
+        """Dialect-specific implementation: INTEGER if compact, otherwise VARCHAR"""
+        if _compact(dialect):
+            return dialect.type_descriptor(Integer())
+        return dialect.type_descriptor(String(self.impl.length))
+
+    def encode(self, value, dialect):
+        """Integer stored for a string"""
+        raise NotImplementedError
+
+    def interned(self, value):
+        """Is the string stored by its call_strings id?"""
+        raise NotImplementedError
+
+    def process_bind_param(self, value, dialect):
+        """Process the value and return"""
+        if value is None or not _compact(dialect):
+            return value
+        return self.encode(value, dialect)
+
+    def process_result_value(self, value, dialect):
+        """Process provided value"""
+        if value is None or not _compact(dialect) or isinstance(value, str):
+            return value
+        if value < 0:
+            return dialect.call_strings.value(value)
+        return self.decode(value)
+
+    def decode(self, value):
+        """String for a non-negative stored integer"""
+        raise NotImplementedError
+
+
+class Genotype(_CompactString):  # pylint: disable=abstract-method
+    """Genotype string, packed into an integer code under COMPACT_STORAGE"""
+    def encode(self, value, dialect):
+        code = encode_genotype(value)
+        if code is None:
+            return dialect.call_strings.remember(value)
+        return code
+
+    def interned(self, value):
+        return encode_genotype(value) is None
+
+    def decode(self, value):
+        return decode_genotype(value)
+
+
+class InternedString(_CompactString):  # pylint: disable=abstract-method
+    """String stored by its call_strings id under COMPACT_STORAGE"""
+    def encode(self, value, dialect):
+        if value == '':
+            return 0
+        return dialect.call_strings.remember(value)
+
+    def interned(self, value):
+        return value != ''
+
+    def decode(self, value):
+        return ''
+
+
+def _intern_strings(conn, _cursor, _statement, _parameters, context, _executemany):
+    """
+    After an INSERT or UPDATE, add any strings it stored by id to
+    call_strings, on the same connection and so in the same transaction
+    """
+    if context is None or context.compiled is None or \
+            not (context.isinsert or context.isupdate):
+        return
+    binds = [(name, bind.type) for name, bind in context.compiled.binds.items()
+             if isinstance(bind.type, _CompactString)]
+    if not binds:
+        return
+
+    added = conn.info.setdefault('interned_strings', set())
+    new = {}
+    for params in context.compiled_parameters:
+        for name, kind in binds:
+            value = params.get(name)
+            if isinstance(value, str) and kind.interned(value):
+                sid = string_id(value)
+                if sid not in added:
+                    new[sid] = value
+    if new:
+        cursor = conn.connection.cursor()
+        cursor.executemany('INSERT OR IGNORE INTO ' + STRINGS_TABLE + ' (id, value) VALUES (?, ?)',
+                           list(new.items()))
+        cursor.close()
+        added.update(new)
+
+
+def _end_transaction(conn):
+    """Strings added in a transaction need adding again in the next"""
+    conn.info.pop('interned_strings', None)
+
+
+def _end_savepoint(conn, _name, _context):
+    """Strings added since a savepoint may have been rolled back with it"""
+    conn.info.pop('interned_strings', None)
@@ -4,15 +4,54 @@ UUIDs for the database - from SQLAlchemy docs
 """
 import uuid
 
-from sqlalchemy import TypeDecorator, CHAR
+from sqlalchemy import TypeDecorator, CHAR, LargeBinary, inspect
 from sqlalchemy.dialects.postgresql import UUID
 
+CHAR_STORAGE = 'char'
+BINARY_STORAGE = 'binary'
+STORAGE_MODES = (CHAR_STORAGE, BINARY_STORAGE)
+
+
+def set_storage(engine, storage):
+    """
+    Choose how GUIDs are stored for an engine on non-Postgres dialects:
+    CHAR_STORAGE (32 hex characters) or BINARY_STORAGE (16 byte BLOB)
+    """
+    if storage not in STORAGE_MODES:
+        raise ValueError('Unknown GUID storage: ' + str(storage))
+    engine.dialect.guid_storage = storage
+
+
+def detect_storage(engine, table='individuals', default=BINARY_STORAGE):
+    """
+    GUID storage used by an existing database, judging by the id column
+    of the given table; `default` if the table doesn't exist yet
+    """
+    inspector = inspect(engine)
+    if table not in inspector.get_table_names():
+        return default
+    for column in inspector.get_columns(table):
+        if column['name'] == 'id':
+            if isinstance(column['type'], (CHAR, UUID)) or \
+                    'CHAR' in str(column['type']).upper():
+                return CHAR_STORAGE
+            return BINARY_STORAGE
+    return default
+
+
+def _storage(dialect):
+    """Storage for the dialect; engines not set up by init_db keep CHAR"""
+    return getattr(dialect, 'guid_storage', CHAR_STORAGE)
+
 
 class GUID(TypeDecorator):  # pylint: disable=abstract-method
     """Platform-independent GUID type.
 
-    Uses Postgresql's UUID type, otherwise uses
-    CHAR(32), storing as stringified hex values.
+    Uses Postgresql's UUID type, otherwise uses either CHAR(32),
+    storing as stringified hex values, or a 16-byte BLOB, depending on
+    the engine's guid_storage (see set_storage).  The binary form
+    halves the size of keys and of the indexes on them; both sort in
+    the same order.
 
     from SQLAlchemy Docs
     http://docs.sqlalchemy.org/en/rel_0_9/core/custom_types.html
@@ -20,9 +59,11 @@ class GUID(TypeDecorator):  # pylint: disable=abstract-method
     impl = CHAR
 
     def load_dialect_impl(self, dialect):
-        """Dialect-specific implementation; use UUIDs for Postgres, otherwise CHAR"""
+        """Dialect-specific implementation; use UUIDs for Postgres, otherwise CHAR or BLOB"""
         if dialect.name == 'postgresql':
             return dialect.type_descriptor(UUID())
+        elif _storage(dialect) == BINARY_STORAGE:
+            return dialect.type_descriptor(LargeBinary(16))
         else:
             return dialect.type_descriptor(CHAR(32))
 
@@ -34,14 +75,28 @@ class GUID(TypeDecorator):  # pylint: disable=abstract-method
             return str(value)
         else:
             if not isinstance(value, uuid.UUID):
-                return "%.32x" % uuid.UUID(value).int  # noqa # pylint: disable=no-member
-            else:
-                # hexstring
-                return "%.32x" % value.int
+                value = uuid.UUID(value)
+            if _storage(dialect) == BINARY_STORAGE:
+                return value.bytes
+            # hexstring
+            return "%.32x" % value.int
 
     def process_result_value(self, value, dialect):
         """Process provided value"""
         if value is None:
             return value
+        elif isinstance(value, bytes):
+            return uuid.UUID(bytes=value)
         else:
             return uuid.UUID(value)
+
+
+def to_uuid(value):
+    """
+    UUID from a raw stored GUID in any storage form
+    """
+    if value is None or isinstance(value, uuid.UUID):
+        return value
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return uuid.UUID(bytes=bytes(value))
+    return uuid.UUID(value)
@@ -0,0 +1,132 @@
+"""
+Reading and compacting the version history kept by history_meta
+
+Each *_history row is a version of an object as it was until `changed`,
+the time it was superseded by the next version or the object was
+deleted; the live table holds the current version.  The object as of a
+time T is therefore the first version superseded after T or, failing
+that, the current one - provided the object had been created by T.
+
+Left alone, the history tables grow with every write.  compact_history
+drops the versions superseded before a retention horizon: all of them,
+or all but the newest for each object ("squash"), so that one version
+from before the horizon survives.  Point-in-time reads for times before
+the horizon see the oldest version retained.
+"""
+import sys
+import datetime
+import argparse
+import logging
+
+from sqlalchemy import and_, create_engine, exists
+from python_model_service.orm.models import Individual, Variant, Call
+
+LOGGER = logging.getLogger(__name__)
+
+VERSIONED_MODELS = (Individual, Variant, Call)
+
+
+def history_class(model):
+    """The class history_meta maps to a versioned model's history table"""
+    return model.__history_mapper__.class_
+
+
+def versions(session, model, object_id, keys):
+    """
+    Every version of an object, oldest first, the current one last
+
+    :param keys: attribute names to select, eg those of a serializer
+    :return: list of (row of the keys' values, time superseded or None)
+    """
+    hist = history_class(model)
+    rows = session.query(*[getattr(hist, key) for key in keys] + [hist.changed])\
+        .filter(hist.id == object_id)\
+        .order_by(hist.version).all()
+    result = [(row[:-1], row[-1]) for row in rows]
+
+    current = session.query(*[getattr(model, key) for key in keys])\
+        .filter(model.id == object_id).first()
+    if current is not None:
+        result.append((current, None))
+    return result
+
+
+def as_of(session, model, object_id, when, keys):
+    """
+    An object as it was at a time, or None if it did not exist then
+
+    :param when: naive UTC datetime
+    :param keys: attribute names to select, eg those of a serializer
+    :return: row of the keys' values
+    """
+    hist = history_class(model)
+    row = session.query(*[getattr(hist, key) for key in keys])\
+        .filter(and_(hist.id == object_id, hist.changed > when))\
+        .order_by(hist.changed, hist.version).first()
+    if row is None:
+        row = session.query(*[getattr(model, key) for key in keys])\
+            .filter(model.id == object_id).first()
+    if row is None:
+        return None
+
+    created = getattr(row, 'created', None)
+    if created is not None and created > when:
+        return None
+    return row
+
+
+def compact_history(connection, horizon, squash=False, models=VERSIONED_MODELS):
+    """
+    Delete versions superseded before the horizon
+
+    :param connection: engine or connection to run the deletes on
+    :param horizon: naive UTC datetime
+    :param squash: keep the newest of each object's versions before the horizon
+    :return: dict of history table name -> rows deleted
+    """
+    deleted = {}
+    for model in models:
+        table = model.__history_mapper__.local_table
+        old = table.c.changed < horizon
+        if squash:
+            newer = table.alias()
+            old = and_(old, exists().where(and_(newer.c.id == table.c.id,
+                                                newer.c.changed < horizon,
+                                                newer.c.version > table.c.version)))
+        deleted[table.name] = connection.execute(table.delete().where(old)).rowcount
+    return deleted
+
+
+def main(args=None):
+    """Command line entry point: compact-history"""
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser('python_model_service compact-history',
+                                     description='Drop old versions from the history tables')
+    parser.add_argument('--database', default="./data/model_service.sqlite")
+    parser.add_argument('--older-than', type=float, required=True, metavar='DAYS',
+                        help='retention horizon: versions superseded more than '
+                             'this many days ago are dropped')
+    parser.add_argument('--squash', action='store_true',
+                        help="keep the newest of each object's versions from before the horizon")
+    parser.add_argument('--vacuum', action='store_true',
+                        help='rebuild the database file afterwards to return the space')
+    parser.add_argument('--loglevel', default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARN', 'ERROR', 'CRITICAL'])
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=getattr(logging, args.loglevel.upper()),
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    horizon = datetime.datetime.utcnow() - datetime.timedelta(days=args.older_than)
+    engine = create_engine('sqlite:///' + args.database)
+    with engine.begin() as conn:
+        deleted = compact_history(conn, horizon, args.squash)
+    for table, count in sorted(deleted.items()):
+        LOGGER.info('%s: deleted %d versions superseded before %s', table, count,
+                    horizon.isoformat())
+    if args.vacuum:
+        engine.execute('VACUUM')
+    engine.dispose()
+    return 0
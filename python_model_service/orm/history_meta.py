@@ -4,18 +4,24 @@ From https://docs.sqlalchemy.org/en/latest/_modules/examples/versioned_history/h
 """
 
 import datetime
+from collections import defaultdict
 
 from sqlalchemy import Column
 from sqlalchemy import DateTime
 from sqlalchemy import event
 from sqlalchemy import ForeignKeyConstraint
+from sqlalchemy import Index
+from sqlalchemy import inspect
 from sqlalchemy import Integer
+from sqlalchemy import literal
+from sqlalchemy import select
 from sqlalchemy import Table
 from sqlalchemy import util
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.orm import attributes
 from sqlalchemy.orm import mapper
 from sqlalchemy.orm import object_mapper
+from sqlalchemy.orm import Query
 from sqlalchemy.orm.exc import UnmappedColumnError
 from sqlalchemy.orm.properties import RelationshipProperty  # pylint: disable=no-name-in-module
 
@@ -124,8 +130,17 @@ def _history_mapper(local_mapper):
         if super_fks:
             cols.append(ForeignKeyConstraint(*zip(*super_fks)))
 
+        # (id, version) is the primary key; (id, changed) finds the
+        # version current at a given time, and (changed) the versions
+        # older than a retention horizon
+        history_name = local_mapper.local_table.name + "_history"
+        pk_keys = [col.key for col in cols if col.primary_key and not _is_versioning_col(col)]
+        cols.append(Index("ix_%s_%s_changed" % (history_name, "_".join(pk_keys)),
+                          *(pk_keys + ["changed"])))
+        cols.append(Index("ix_%s_changed" % history_name, "changed"))
+
         table = Table(
-            local_mapper.local_table.name + "_history",
+            history_name,
             local_mapper.local_table.metadata,
             *cols,
             schema=local_mapper.local_table.schema
@@ -170,6 +185,23 @@ def _history_mapper(local_mapper):
         )
 
 
+def create_history_indexes(bind, metadata):
+    """
+    Create any indexes of the history tables missing from an existing
+    database; metadata.create_all() only indexes the tables it creates
+    """
+    inspector = inspect(bind)
+    existing_tables = set(inspector.get_table_names())
+    for table in metadata.tables.values():
+        if table.name not in existing_tables or \
+           not any(_is_versioning_col(col) for col in table.c):
+            continue
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind)
+
+
 class Versioned(object):
     @declared_attr
     def __mapper_cls__(cls): # pylint: disable=no-self-argument
@@ -273,10 +305,122 @@ def create_version(obj, session, deleted=False):
     obj.version += 1
 
 
+# ids per IN (...) clause, well under SQLite's limit on bound parameters
+VERSION_CHUNK_SIZE = 500
+
+
+def _set_based(obj_mapper):
+    """
+    Can the mapper's rows be versioned by copying them table to table?
+    True for classes mapped to a single table, as all of ours are.
+    """
+    return obj_mapper.inherits is None and obj_mapper.primary_key and \
+        len(obj_mapper.primary_key) == 1
+
+
+def history_insert(obj_mapper, whereclause, changed=None):
+    """
+    INSERT ... SELECT statement copying the current rows of the mapper's
+    table that match whereclause, version number included, into its
+    history table
+    """
+    if changed is None:
+        changed = datetime.datetime.utcnow()
+    table = obj_mapper.local_table
+    history_table = obj_mapper.class_.__history_mapper__.local_table
+
+    names, columns = [], []
+    for hist_col in history_table.c:
+        names.append(hist_col.key)
+        if hist_col.key == "changed":
+            columns.append(literal(changed, DateTime))
+        else:
+            columns.append(table.c[hist_col.key])
+
+    rows = select(columns)
+    if whereclause is not None:
+        rows = rows.where(whereclause)
+    return history_table.insert().from_select(names, rows)
+
+
+def version_objects(objs, session, deleted=False):
+    """
+    Set-based equivalent of create_version for many objects at once
+
+    The rows about to be overwritten are copied into the history tables
+    with one INSERT ... SELECT per table (per VERSION_CHUNK_SIZE objects)
+    rather than one history object per row, so the cost is in statements
+    rather than rows x columns.  The database row is the old version of
+    a modified object, as the rows are copied before the flush writes
+    over them.  Objects of inheriting mappers go through create_version.
+    """
+    by_mapper = defaultdict(list)
+    for obj in objs:
+        obj_mapper = object_mapper(obj)
+        if not _set_based(obj_mapper):
+            create_version(obj, session, deleted)
+        elif deleted or session.is_modified(obj, include_collections=False):
+            by_mapper[obj_mapper].append(obj)
+
+    changed = datetime.datetime.utcnow()
+    for obj_mapper, group in by_mapper.items():
+        pk_col = obj_mapper.primary_key[0]
+        ids = [obj_mapper.primary_key_from_instance(obj)[0] for obj in group]
+        for i in range(0, len(ids), VERSION_CHUNK_SIZE):
+            stmt = history_insert(obj_mapper, pk_col.in_(ids[i:i + VERSION_CHUNK_SIZE]),
+                                  changed)
+            session.execute(stmt, mapper=obj_mapper)
+        if not deleted:
+            for obj in group:
+                obj.version += 1
+
+
+def _bulk_mapper(bulk):
+    """Mapper of a bulk Query.update()/delete(), if it is versioned and set-based"""
+    obj_mapper = bulk.mapper
+    if obj_mapper is None or not hasattr(obj_mapper.class_, "__history_mapper__"):
+        return None
+    if not _set_based(obj_mapper):
+        raise NotImplementedError(
+            "bulk update/delete of %s is not versioned" % obj_mapper.class_.__name__)
+    return obj_mapper
+
+
+def _before_bulk_update(query, bulk):
+    """Copy the rows a Query.update() matches into history, and bump their versions"""
+    obj_mapper = _bulk_mapper(bulk)
+    if obj_mapper is None:
+        return
+    query.session.execute(history_insert(obj_mapper, query.whereclause),
+                          mapper=obj_mapper)
+    version = obj_mapper.class_.version
+    if hasattr(bulk.values, "items"):
+        if "version" not in bulk.values and version not in bulk.values:
+            bulk.values[version] = version + 1
+    else:
+        bulk.values = list(bulk.values) + [(version, version + 1)]
+
+
+def _before_bulk_delete(query, bulk):
+    """Copy the rows a Query.delete() matches into history"""
+    obj_mapper = _bulk_mapper(bulk)
+    if obj_mapper is None:
+        return
+    query.session.execute(history_insert(obj_mapper, query.whereclause),
+                          mapper=obj_mapper)
+
+
 def versioned_session(session):
+    """
+    Version the session's modified and deleted objects as it flushes,
+    and rows changed by bulk Query.update() and Query.delete() calls
+    on versioned classes (in any session) as they execute
+    """
+    if not event.contains(Query, "before_compile_update", _before_bulk_update):
+        event.listen(Query, "before_compile_update", _before_bulk_update)
+        event.listen(Query, "before_compile_delete", _before_bulk_delete)
+
     @event.listens_for(session, "before_flush")
     def before_flush(session, _flush_context, _instances):  # pylint: disable=unused-variable
-        for obj in versioned_objects(session.dirty):
-            create_version(obj, session)
-        for obj in versioned_objects(session.deleted):
-            create_version(obj, session, deleted=True)
\ No newline at end of file
+        version_objects(versioned_objects(session.dirty), session)
+        version_objects(versioned_objects(session.deleted), session, deleted=True)
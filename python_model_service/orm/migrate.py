@@ -0,0 +1,146 @@
+"""
+Rewrite an existing SQLite database with a different GUID storage, or
+genotype storage (see orm.compact)
+
+Every table is copied, in chunks, into a fresh database created from
+the current models with the requested storage; the new file then
+replaces the old one, which is kept as a backup.  Columns added to the
+models since the old database was created (eg, Variant.bin) are filled
+in by their defaults along the way.  Interned call strings are not
+copied as they are, but added again for the calls which use them.
+
+The service should not be running against the database while it is
+being migrated.
+"""
+import sys
+import os
+import argparse
+import logging
+
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.sql import column as sql_column, table as sql_table, select
+from sqlalchemy.types import NullType
+from python_model_service.orm import Base, guid, compact
+from python_model_service.orm.guid import GUID
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 10000
+
+
+def _copy_table(src, dst, table, chunk_size):
+    """
+    Copy the rows of one table, converting raw GUIDs of either storage
+    form to UUIDs which the destination's GUID type then stores
+
+    :return: number of rows copied
+    """
+    src_columns = {col['name'] for col in inspect(src).get_columns(table.name)}
+    columns = [col for col in table.c if col.name in src_columns]
+    guid_columns = [i for i, col in enumerate(columns) if isinstance(col.type, GUID)]
+
+    # GUIDs are read untyped, as whatever raw form the source stored
+    raw_columns = [sql_column(col.name, NullType() if isinstance(col.type, GUID) else col.type)
+                   for col in columns]
+    query = select(raw_columns).select_from(sql_table(table.name))
+    insert = table.insert()
+    nrows = 0
+    result = src.execute(query)
+    with dst.begin() as conn:
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            batch = []
+            for row in rows:
+                values = list(row)
+                for i in guid_columns:
+                    values[i] = guid.to_uuid(values[i])
+                batch.append({col.key: value for col, value in zip(columns, values)})
+            conn.execute(insert, batch)
+            nrows += len(batch)
+    result.close()
+    return nrows
+
+
+def migrate_guids(database, storage=guid.BINARY_STORAGE,  # pylint:disable=too-many-arguments
+                  output=None, chunk_size=DEFAULT_CHUNK_SIZE, genotype_storage=None):
+    """
+    Rewrite a SQLite database file with the given GUID storage
+
+    :param database: path of the existing database
+    :param storage: guid.BINARY_STORAGE or guid.CHAR_STORAGE
+    :param output: write the migrated database here, leaving the original
+                   in place; by default the original is replaced and kept
+                   as database + '.bak'
+    :param chunk_size: rows per insert batch
+    :param genotype_storage: compact.TEXT_STORAGE or compact.COMPACT_STORAGE;
+                             by default, whatever the database uses now
+    :return: the path of the migrated database, or None if no change was needed
+    """
+    import python_model_service.orm.models  # noqa401 #pylint: disable=unused-variable
+
+    src = create_engine('sqlite:///' + database)
+    current = guid.detect_storage(src, default=None)
+    if current is None:
+        raise ValueError(database + ' is not a model service database')
+    # genotypes and formats are read as strings, whatever their storage
+    current_genotypes = compact.detect_storage(src)
+    compact.set_storage(src, current_genotypes)
+    genotype_storage = genotype_storage or current_genotypes
+    if current == storage and current_genotypes == genotype_storage and output is None:
+        LOGGER.info('%s already uses %s GUID and %s genotype storage', database, storage,
+                    genotype_storage)
+        return None
+
+    target = output or database + '.migrating'
+    if os.path.exists(target):
+        os.remove(target)
+    dst = create_engine('sqlite:///' + target)
+    guid.set_storage(dst, storage)
+    compact.set_storage(dst, genotype_storage)
+    Base.metadata.create_all(bind=dst)
+
+    src_tables = set(inspect(src).get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in src_tables or table.name == compact.STRINGS_TABLE:
+            continue
+        nrows = _copy_table(src, dst, table, chunk_size)
+        LOGGER.info('%s: copied %d rows', table.name, nrows)
+
+    src.dispose()
+    dst.dispose()
+
+    if output is None:
+        os.replace(database, database + '.bak')
+        os.replace(target, database)
+        target = database
+    return target
+
+
+def main(args=None):
+    """Command line entry point: migrate-guids"""
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(
+        'python_model_service migrate-guids',
+        description='Rewrite a DB with a different GUID or genotype storage')
+    parser.add_argument('--database', default="./data/model_service.sqlite")
+    parser.add_argument('--storage', default=guid.BINARY_STORAGE,
+                        choices=guid.STORAGE_MODES)
+    parser.add_argument('--genotype-storage', default=None, choices=compact.STORAGE_MODES,
+                        help='store genotypes and formats as text or compact integers; '
+                             'by default, as now')
+    parser.add_argument('--output', default=None,
+                        help='write to a new file rather than replacing the DB')
+    parser.add_argument('--loglevel', default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARN', 'ERROR', 'CRITICAL'])
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=getattr(logging, args.loglevel.upper()),
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    migrate_guids(args.database, args.storage, args.output,
+                  genotype_storage=args.genotype_storage)
+    return 0
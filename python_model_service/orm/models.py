@@ -2,9 +2,12 @@
 SQLAlchemy models for the database
 """
 from sqlalchemy import Column, String, DateTime, Integer
-from sqlalchemy import UniqueConstraint, ForeignKey
+from sqlalchemy import UniqueConstraint, ForeignKey, Index, event
+from sqlalchemy import and_, bindparam, inspect, select
 from sqlalchemy.orm import relationship, backref
 from python_model_service.orm.guid import GUID
+from python_model_service.orm.compact import Genotype, InternedString, STRINGS_TABLE
+from python_model_service.orm.binning import variant_bin
 from python_model_service.orm import Base
 from python_model_service.orm.history_meta import Versioned
 
@@ -21,6 +24,15 @@ class Individual(Base, Versioned):
 #    calls = relationship("Call", back_populates="individual")
 
 
+def _default_variant_bin(context):
+    """
+    Column default for Variant.bin; works for ORM flushes and for
+    core (executemany) inserts alike
+    """
+    params = context.get_current_parameters()
+    return variant_bin(params.get('start'), params.get('ref'))
+
+
 class Variant(Base, Versioned):
     """
     SQLAlchemy class/table representing a Variant
@@ -29,6 +41,7 @@ class Variant(Base, Versioned):
     id = Column(GUID(), primary_key=True)
     chromosome = Column(String(10))
     start = Column(Integer)
+    bin = Column(Integer, default=_default_variant_bin)
     ref = Column(String(100))
     alt = Column(String(100))
     name = Column(String(100))
@@ -36,11 +49,49 @@ class Variant(Base, Versioned):
     updated = Column(DateTime())
 #    calls = relationship("Call", back_populates="variant")
     # chromosome, start, ref, alt _uniquely_ specifies a short variant
+    # (chromosome, bin) gives UCSC-style indexed range lookups
     __table_args__ = (
         UniqueConstraint("chromosome", "start", "ref", "alt"),
+        Index("ix_variants_chromosome_bin", "chromosome", "bin"),
     )
 
 
+@event.listens_for(Variant, "before_update")
+def _update_variant_bin(_mapper, _connection, target):
+    """Keep the bin in sync if a variant's position or ref changes"""
+    target.bin = variant_bin(target.start, target.ref)
+
+
+def add_variant_bins(bind):
+    """
+    Add the bin column, its index, and every row's bin to the variants
+    (and variants_history) tables of a database created before
+    Variant.bin existed; metadata.create_all() doesn't alter tables
+    """
+    inspector = inspect(bind)
+    existing_tables = set(inspector.get_table_names())
+    for table in (Variant.__table__, Variant.__history_mapper__.local_table):
+        if table.name not in existing_tables or \
+           'bin' in {column['name'] for column in inspector.get_columns(table.name)}:
+            continue
+        key = list(table.primary_key.columns)
+        update = table.update()\
+            .where(and_(*[column == bindparam('key_' + column.name) for column in key]))\
+            .values(bin=bindparam('new_bin'))
+        with bind.begin() as conn:
+            conn.execute('ALTER TABLE %s ADD COLUMN bin INTEGER' % table.name)
+            rows = conn.execute(select(key + [table.c.start, table.c.ref])
+                                .where(table.c.start.isnot(None))).fetchall()
+            if rows:
+                conn.execute(update, [dict({'key_' + column.name: value
+                                            for column, value in zip(key, row)},
+                                           new_bin=variant_bin(row[-2], row[-1]))
+                                      for row in rows])
+        for index in table.indexes:
+            if 'bin' in index.columns:
+                index.create(bind)
+
+
 class Call(Base, Versioned):
     """
     SQLAlchemy class/table representing Calls
@@ -53,11 +104,39 @@ class Call(Base, Versioned):
     variant_id = Column(GUID(), ForeignKey('variants.id'))
     variant = relationship("Variant",
                            backref=backref("calls", cascade="all, delete-orphan"))
-    genotype = Column(String(20))
-    fmt = Column(String(100))
+    genotype = Column(Genotype(20))
+    fmt = Column(InternedString(100))
     created = Column(DateTime())
     updated = Column(DateTime())
-    # a call is a _unique_ relationship between a variant and an individual
+    # a call is a _unique_ relationship between a variant and an individual;
+    # the index serves lookups from the individual side
     __table_args__ = (
         UniqueConstraint("variant_id", "individual_id"),
+        Index("ix_calls_individual_variant", "individual_id", "variant_id"),
     )
+
+
+class CallString(Base):
+    """
+    SQLAlchemy class/table of the strings calls store by id under
+    compact genotype storage (see orm.compact); not versioned
+    """
+    __tablename__ = STRINGS_TABLE
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    value = Column(String(100), nullable=False)
+
+
+class VariantStats(Base):
+    """
+    SQLAlchemy class/table of per-variant allele statistics, kept up to
+    date as calls change (see orm.stats); not versioned
+    """
+    __tablename__ = 'variant_stats'
+    variant_id = Column(GUID(), primary_key=True)
+    calls = Column(Integer, nullable=False, default=0)
+    allele_count = Column(Integer, nullable=False, default=0)
+    allele_number = Column(Integer, nullable=False, default=0)
+    hom_ref = Column(Integer, nullable=False, default=0)
+    het = Column(Integer, nullable=False, default=0)
+    hom_alt = Column(Integer, nullable=False, default=0)
+    missing = Column(Integer, nullable=False, default=0)
@@ -0,0 +1,101 @@
+"""
+Fast per-model serializers
+
+orm.dump() filters vars(obj) of a fully hydrated ORM instance for every
+row.  A ModelSerializer instead is built once per model from its mapped
+columns: queries select just those columns, and each result tuple is
+turned into a JSON-ready dict by a function generated for that model,
+with UUIDs and datetimes converted inline.
+"""
+import datetime
+import uuid
+
+from sqlalchemy import inspect, DateTime
+from python_model_service.orm.guid import GUID
+
+# internal columns never returned through the API
+HIDDEN_COLUMNS = ("bin",)
+
+
+def _uuid_value(value):
+    """UUID as its canonical string"""
+    return None if value is None else str(value)
+
+
+def _datetime_value(value):
+    """datetime as ISO 8601, as connexion's JSON encoder writes it; naive means UTC"""
+    if value is None:
+        return None
+    if value.tzinfo:
+        return value.isoformat('T')
+    return value.isoformat('T') + 'Z'
+
+
+def json_value(value):
+    """
+    JSON-safe representation of a single value of any column type
+    """
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, datetime.datetime):
+        return _datetime_value(value)
+    return value
+
+
+def _converter(column):
+    """Conversion function for a column's values, or None if already JSON-safe"""
+    if isinstance(column.type, GUID):
+        return _uuid_value
+    if isinstance(column.type, DateTime):
+        return _datetime_value
+    return None
+
+
+class ModelSerializer(object):
+    """
+    Serializer for one model, compiled from its mapper's column attributes
+
+    `columns` are the entities to pass to query(); calling the serializer
+    on a result row gives the dict for the API.
+    """
+    def __init__(self, model, hidden=HIDDEN_COLUMNS):
+        mapper = inspect(model)
+        attrs = [attr for attr in mapper.column_attrs if attr.key not in hidden]
+        self.model = model
+        self.keys = tuple(attr.key for attr in attrs)
+        self.columns = tuple(getattr(model, key) for key in self.keys)
+
+        namespace = {}
+        fields = []
+        for i, attr in enumerate(attrs):
+            conv = _converter(attr.columns[0])
+            if conv is None:
+                fields.append('%r: row[%d]' % (attr.key, i))
+            else:
+                namespace['_conv%d' % i] = conv
+                fields.append('%r: _conv%d(row[%d])' % (attr.key, i, i))
+
+        source = 'def serialize(row):\n    return {' + ', '.join(fields) + '}\n'
+        exec(source, namespace)  # pylint: disable=exec-used
+        self._serialize = namespace['serialize']
+
+    def __call__(self, row):
+        """Dict for a result tuple selected with self.columns"""
+        return self._serialize(row)
+
+    def from_object(self, obj):
+        """Dict for an ORM instance of the model"""
+        return self._serialize([getattr(obj, key) for key in self.keys])
+
+
+_SERIALIZERS = {}
+
+
+def serializer(model):
+    """
+    Return the (cached) serializer for a model
+    """
+    ser = _SERIALIZERS.get(model)
+    if ser is None:
+        ser = _SERIALIZERS[model] = ModelSerializer(model)
+    return ser
@@ -0,0 +1,292 @@
+"""
+Per-variant allele statistics, maintained incrementally
+
+variant_stats holds, for each variant with calls, the number of calls,
+the allele count (alternate alleles called) and allele number (alleles
+called), and the count of each kind of genotype.  Rather than being
+recomputed from the calls, a variant's row is adjusted by the
+difference each change of its calls makes:
+
+* calls added, changed or deleted through the session are tallied when
+  it flushes, from the same session events history_meta versions them in
+* bulk Query.delete() and Query.update() of calls are tallied as they
+  execute, again alongside history_meta
+* core inserts of calls, as the batch endpoint and VCF import make,
+  must be passed to record_inserts by whoever makes them
+
+The statistics are of the calls as stored: an import which leaves out
+reference calls leaves them out of the counts too.  rebuild_stats
+recomputes the whole table from the calls, eg for a database created
+before the table was.
+"""
+import sys
+import uuid
+import argparse
+import logging
+import functools
+from collections import defaultdict
+
+from sqlalchemy import bindparam, event, func, select
+from sqlalchemy.orm import Query
+from sqlalchemy.orm.attributes import get_history
+from python_model_service.orm.models import Call, Variant, VariantStats
+
+LOGGER = logging.getLogger(__name__)
+
+# the counts kept, in the order genotype_counts gives them
+FIELDS = ('calls', 'allele_count', 'allele_number', 'hom_ref', 'het', 'hom_alt', 'missing')
+
+# variant ids per IN (...) clause
+CHUNK_SIZE = 500
+
+_TABLE = VariantStats.__table__
+
+# VariantStats columns of the counts, to select with a variant
+COLUMNS = tuple(getattr(VariantStats, field) for field in FIELDS)
+
+
+@functools.lru_cache(maxsize=256)
+def genotype_counts(genotype):
+    """
+    What one call of a genotype such as '0/1' or '1|2' adds to each of FIELDS
+    """
+    alleles = (genotype or '').replace('|', '/').split('/')
+    called = [allele for allele in alleles if allele not in ('', '.')]
+    alt = sum(allele != '0' for allele in called)
+    if len(called) < len(alleles):
+        kind = 'missing'
+    elif not alt:
+        kind = 'hom_ref'
+    elif alt == len(called) and len(set(called)) == 1:
+        kind = 'hom_alt'
+    else:
+        kind = 'het'
+    return (1, alt, len(called)) + tuple(int(kind == field) for field in FIELDS[3:])
+
+
+def summary(counts):
+    """
+    API form of a variant's statistics
+
+    :param counts: the variant's counts in the order of FIELDS, eg the
+                   columns of its VariantStats row, or None if it has none
+    """
+    values = dict(zip(FIELDS, [count or 0 for count in counts or [0] * len(FIELDS)]))
+    called = values['calls'] - values['missing']
+    return {
+        'calls': values['calls'],
+        'allele_count': values['allele_count'],
+        'allele_number': values['allele_number'],
+        'allele_frequency': (values['allele_count'] / values['allele_number']
+                             if values['allele_number'] else None),
+        'genotype_counts': {field: values[field] for field in FIELDS[3:]},
+        'call_rate': called / values['calls'] if values['calls'] else None,
+    }
+
+
+class Tally(object):
+    """Changes to the counts of variants, to be applied together"""
+    def __init__(self):
+        self.deltas = defaultdict(lambda: [0] * len(FIELDS))
+
+    def add(self, variant_id, genotype, sign=1, times=1):
+        """Count (sign=1) or uncount (sign=-1) calls of a genotype"""
+        if variant_id is None:
+            return
+        if not isinstance(variant_id, uuid.UUID):
+            variant_id = uuid.UUID(str(variant_id))
+        delta = self.deltas[variant_id]
+        for i, count in enumerate(genotype_counts(genotype)):
+            delta[i] += sign * times * count
+
+    def apply(self, execute):
+        """
+        Adjust the stored counts: one UPDATE executemany for the variants
+        with counts already, one INSERT for the rest
+
+        :param execute: execute() of the session or connection to use
+        :return: number of variants whose counts changed
+        """
+        deltas = {variant_id: delta for variant_id, delta in self.deltas.items() if any(delta)}
+        self.deltas.clear()
+        if not deltas:
+            return 0
+        ids = list(deltas)
+        existing = set()
+        for i in range(0, len(ids), CHUNK_SIZE):
+            rows = execute(select([_TABLE.c.variant_id])
+                           .where(_TABLE.c.variant_id.in_(ids[i:i + CHUNK_SIZE])))
+            existing.update(row[0] for row in rows)
+
+        updates = [dict(zip(('d_' + field for field in FIELDS), delta), v_id=variant_id)
+                   for variant_id, delta in deltas.items() if variant_id in existing]
+        if updates:
+            execute(_TABLE.update()
+                    .where(_TABLE.c.variant_id == bindparam('v_id'))
+                    .values({field: _TABLE.c[field] + bindparam('d_' + field)
+                             for field in FIELDS}), updates)
+        inserts = [dict(zip(FIELDS, delta), variant_id=variant_id)
+                   for variant_id, delta in deltas.items() if variant_id not in existing]
+        if inserts:
+            execute(_TABLE.insert(), inserts)
+        return len(deltas)
+
+
+def _old_value(obj, key):
+    """An attribute's value as of the last flush"""
+    added, unchanged, deleted = get_history(obj, key)
+    if deleted:
+        return deleted[0]
+    if unchanged:
+        return unchanged[0]
+    return added[0] if added else None
+
+
+def _flushed_calls(session):
+    """Tally the calls a flush inserts, changes and deletes"""
+    tally = Tally()
+    for obj in session.new:
+        if isinstance(obj, Call):
+            tally.add(obj.variant_id, obj.genotype)
+    for obj in session.dirty:
+        if isinstance(obj, Call):
+            old = (_old_value(obj, 'variant_id'), _old_value(obj, 'genotype'))
+            if old != (obj.variant_id, obj.genotype):
+                tally.add(*old, sign=-1)
+                tally.add(obj.variant_id, obj.genotype)
+    for obj in session.deleted:
+        if isinstance(obj, Call):
+            tally.add(_old_value(obj, 'variant_id'), _old_value(obj, 'genotype'), sign=-1)
+    return tally
+
+
+def _after_flush(session, _flush_context):
+    """Apply the flush's changes of calls, and drop deleted variants' counts"""
+    tally = _flushed_calls(session)
+    deleted = [obj.id for obj in session.deleted if isinstance(obj, Variant)]
+    for variant_id in deleted:
+        tally.deltas.pop(variant_id, None)
+    tally.apply(functools.partial(session.execute, mapper=VariantStats))
+    for i in range(0, len(deleted), CHUNK_SIZE):
+        session.execute(_TABLE.delete().where(_TABLE.c.variant_id.in_(deleted[i:i + CHUNK_SIZE])),
+                        mapper=VariantStats)
+
+
+def _matched_calls(query, columns):
+    """Rows of the calls a bulk update or delete matches"""
+    stmt = select(columns)
+    if query.whereclause is not None:
+        stmt = stmt.where(query.whereclause)
+    return query.session.execute(stmt, mapper=Call).fetchall()
+
+
+def _before_bulk_delete(query, bulk):
+    """Uncount the calls a Query.delete() is about to delete"""
+    if bulk.mapper is None or bulk.mapper.class_ is not Call:
+        return
+    tally = Tally()
+    for variant_id, genotype in _matched_calls(query, [Call.variant_id, Call.genotype]):
+        tally.add(variant_id, genotype, sign=-1)
+    tally.apply(functools.partial(query.session.execute, mapper=VariantStats))
+
+
+def _updates_counts(bulk):
+    """Does a Query.update() set a call's variant or genotype?"""
+    if bulk.mapper is None or bulk.mapper.class_ is not Call:
+        return False
+    values = bulk.values.keys() if hasattr(bulk.values, 'keys') else \
+        [key for key, _value in bulk.values]
+    return any(getattr(key, 'key', key) in ('variant_id', 'genotype') for key in values)
+
+
+def _before_bulk_update(query, bulk):
+    """Uncount the calls a Query.update() is about to change"""
+    if not _updates_counts(bulk):
+        return
+    tally = Tally()
+    rows = _matched_calls(query, [Call.id, Call.variant_id, Call.genotype])
+    for _id, variant_id, genotype in rows:
+        tally.add(variant_id, genotype, sign=-1)
+    tally.apply(functools.partial(query.session.execute, mapper=VariantStats))
+    bulk.variant_stats_ids = [row[0] for row in rows]
+
+
+def _after_bulk_update(update_context):
+    """Count the calls a Query.update() changed, as they are now"""
+    ids = getattr(update_context, 'variant_stats_ids', None)
+    if not ids:
+        return
+    session = update_context.session
+    tally = Tally()
+    for i in range(0, len(ids), CHUNK_SIZE):
+        rows = session.execute(select([Call.variant_id, Call.genotype])
+                               .where(Call.id.in_(ids[i:i + CHUNK_SIZE])), mapper=Call)
+        for variant_id, genotype in rows:
+            tally.add(variant_id, genotype)
+    tally.apply(functools.partial(session.execute, mapper=VariantStats))
+
+
+def track_variant_stats(session):
+    """
+    Keep variant_stats up to date with the calls the session flushes,
+    and with bulk Query.update() and Query.delete() calls of calls
+    (in any session)
+    """
+    if not event.contains(Query, "before_compile_delete", _before_bulk_delete):
+        event.listen(Query, "before_compile_delete", _before_bulk_delete)
+        event.listen(Query, "before_compile_update", _before_bulk_update)
+    event.listen(session, "after_flush", _after_flush)
+    event.listen(session, "after_bulk_update", _after_bulk_update)
+
+
+def record_inserts(execute, calls):
+    """
+    Count calls inserted other than through a session flush
+
+    :param execute: execute() of the session or connection inserting them,
+                    so the counts are updated in the same transaction
+    :param calls: the inserted rows, as dicts with variant_id and genotype
+    """
+    tally = Tally()
+    for call in calls:
+        tally.add(call['variant_id'], call.get('genotype'))
+    tally.apply(execute)
+
+
+def rebuild_stats(connection):
+    """
+    Recompute every variant's counts from the calls
+
+    :return: number of variants with calls
+    """
+    tally = Tally()
+    rows = connection.execute(select([Call.variant_id, Call.genotype, func.count()])
+                              .group_by(Call.variant_id, Call.genotype))
+    for variant_id, genotype, times in rows:
+        tally.add(variant_id, genotype, times=times)
+    connection.execute(_TABLE.delete())
+    return tally.apply(connection.execute)
+
+
+def main(args=None):
+    """Command line entry point: rebuild-stats"""
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser('python_model_service rebuild-stats',
+                                     description='Recompute the per-variant allele statistics')
+    parser.add_argument('--database', default="./data/model_service.sqlite")
+    parser.add_argument('--loglevel', default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARN', 'ERROR', 'CRITICAL'])
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=getattr(logging, args.loglevel.upper()),
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    from python_model_service import orm
+    engine = orm.make_engine('sqlite:///' + args.database)
+    with engine.begin() as conn:
+        variants = rebuild_stats(conn)
+    LOGGER.info('rebuilt statistics of %d variants', variants)
+    engine.dispose()
+    return 0
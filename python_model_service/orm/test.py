@@ -3,12 +3,26 @@
 Tests for ORM module
 """
 import os
+import sqlite3
 import uuid
+import datetime
 
 import pytest
-
-from python_model_service.orm import dump, init_db, get_session
-from python_model_service.orm.models import Individual, Variant, Call
+from sqlalchemy import or_
+from sqlalchemy import inspect as sqlalchemy_inspect
+from sqlalchemy.orm import sessionmaker
+
+from python_model_service.orm import dump, init_db, get_session, make_engine, sqlite_pragmas
+from python_model_service.orm.models import Individual, Variant, Call, VariantStats
+from python_model_service.orm.binning import reg2bin, reg2bins, reg2bin_ranges
+from python_model_service.orm.serializers import serializer, json_value
+from python_model_service.orm import guid
+from python_model_service.orm.migrate import migrate_guids
+from python_model_service.orm.history_meta import versioned_session
+from python_model_service.orm import history
+from python_model_service.orm import stats
+from python_model_service.orm import compact
+from python_model_service import export
 
 
 def are_equivalent(ormobj1, ormobj2):
@@ -138,6 +152,385 @@ def test_search_individuals(simple_db):
     db_session.close()
 
 
+def test_binning():
+    """
+    Check UCSC bin assignment, and that region bins cover contained intervals
+    """
+    # known values from the UCSC scheme
+    assert reg2bin(0, 1) == 585
+    assert reg2bin(0, 1 << 17) == 585
+    assert reg2bin(0, (1 << 17) + 1) == 73
+    assert reg2bin(0, 512 * 1024 * 1024) == 0
+    assert reg2bin(600000000, 600000001) > 4681
+
+    for start, end in [(0, 1), (123456, 654321), (230000000, 240000000)]:
+        bins = set(reg2bins(start, end))
+        for pos in range(start, end, max(1, (end - start) // 100)):
+            assert reg2bin(pos, pos + 1) in bins
+            assert reg2bin(pos, min(pos + 100, end)) in bins
+
+
+def test_search_variants_by_bin(simple_db):
+    """
+    Region searches using the bin index match a plain range filter
+    """
+    _, variants, _, _ = simple_db
+    db_session = get_session()
+
+    start, end = 200000000, 240000000
+    bins = [Variant.bin.between(first, last)
+            for first, last in reg2bin_ranges(start - 1, end)]
+    varquery = db_session.query(Variant).\
+        filter(Variant.chromosome == 'chr1').\
+        filter(or_(*bins)).\
+        filter(Variant.start >= start, Variant.start <= end).all()
+
+    expected = [var for var in variants if start <= var.start <= end]
+    assert len(varquery) == len(expected) == 2
+    assert {var.id for var in varquery} == {var.id for var in expected}
+
+    db_session.close()
+
+
+def test_add_variant_bins(tmpdir):
+    """
+    Opening a database created before Variant.bin adds and fills it in
+    """
+    filename = str(tmpdir.join('nobins.db'))
+    conn = sqlite3.connect(filename)
+    columns = ('id CHAR(32) NOT NULL, chromosome VARCHAR(10), start INTEGER, '
+               'ref VARCHAR(100), alt VARCHAR(100), name VARCHAR(100), '
+               'created DATETIME, updated DATETIME, version INTEGER NOT NULL')
+    conn.execute('CREATE TABLE individuals (id CHAR(32) NOT NULL, description VARCHAR(100), '
+                 'created DATETIME, updated DATETIME, version INTEGER NOT NULL, '
+                 'PRIMARY KEY (id))')
+    conn.execute('CREATE TABLE variants (%s, PRIMARY KEY (id), '
+                 'UNIQUE (chromosome, start, ref, alt))' % columns)
+    conn.execute('CREATE TABLE variants_history (%s, changed DATETIME, '
+                 'PRIMARY KEY (id, version))' % columns)
+    ids = [uuid.uuid1() for _ in range(3)]
+    starts = [53247055, 218441563, 230710048]
+    conn.executemany("INSERT INTO variants (id, chromosome, start, ref, alt, version) "
+                     "VALUES (?, 'chr1', ?, 'A', 'T', 1)",
+                     [(var_id.hex, start) for var_id, start in zip(ids, starts)])
+    conn.execute("INSERT INTO variants_history (id, chromosome, start, ref, alt, version) "
+                 "VALUES (?, 'chr1', 100, 'AC', 'T', 1)", (ids[0].hex,))
+    conn.commit()
+    conn.close()
+
+    engine = make_engine('sqlite:///' + filename)
+    session = sessionmaker(bind=engine)()
+    bins = [Variant.bin.between(first, last)
+            for first, last in reg2bin_ranges(200000000 - 1, 240000000)]
+    found = session.query(Variant.id).filter(Variant.chromosome == 'chr1')\
+        .filter(or_(*bins)).filter(Variant.start >= 200000000).all()
+    assert {row.id for row in found} == set(ids[1:])
+    assert engine.execute('SELECT bin FROM variants_history').scalar() == reg2bin(99, 101)
+    assert 'ix_variants_chromosome_bin' in \
+        {index['name'] for index in sqlalchemy_inspect(engine).get_indexes('variants')}
+    session.close()
+    engine.dispose()
+
+
+def test_serializers(simple_db):
+    """
+    Column-projected serializers agree with dump() of full ORM objects
+    """
+    db_session = get_session()
+
+    for model in [Individual, Variant, Call]:
+        ser = serializer(model)
+        assert serializer(model) is ser
+        rows = db_session.query(*ser.columns).order_by(model.id).all()
+        objs = db_session.query(model).order_by(model.id).all()
+        assert len(rows) == len(objs) > 0
+        for row, obj in zip(rows, objs):
+            expected = {k: json_value(v) for k, v in dump(obj).items()}
+            assert ser(row) == expected
+            assert ser.from_object(obj) == expected
+
+    db_session.close()
+
+
+def test_migrate_guids(simple_db):
+    """
+    Round trip the DB through CHAR and back to BLOB GUID storage
+    """
+    _, _, calls, db_filename = simple_db
+    char_db, binary_db = db_filename + '.char', db_filename + '.binary'
+
+    migrate_guids(db_filename, guid.CHAR_STORAGE, output=char_db)
+    migrate_guids(char_db, guid.BINARY_STORAGE, output=binary_db)
+
+    expected = sorted((c.id.hex, c.variant_id.hex, c.genotype) for c in calls)
+    for filename, to_hex in [(char_db, lambda v: v), (binary_db, lambda v: v.hex())]:
+        conn = sqlite3.connect(filename)
+        rows = conn.execute('SELECT id, variant_id, genotype FROM calls').fetchall()
+        conn.close()
+        assert sorted((to_hex(i), to_hex(v), g) for i, v, g in rows) == expected
+        os.remove(filename)
+
+
+def test_sqlite_profile(tmpdir):
+    """
+    Profile PRAGMAs are applied to every pooled connection
+    """
+    pragmas = sqlite_pragmas('wal', cache_size=-1000)
+    assert pragmas['journal_mode'] == 'WAL' and pragmas['cache_size'] == -1000
+    assert sqlite_pragmas('default', busy_timeout=None) == {}
+
+    engine = make_engine('sqlite:///' + str(tmpdir.join('profile.db')),
+                         pragmas=pragmas, pool_size=2)
+    conns = [engine.connect() for _ in range(2)]
+    for conn in conns:
+        assert conn.execute('PRAGMA journal_mode').scalar().upper() == 'WAL'
+        assert conn.execute('PRAGMA synchronous').scalar() == 1
+        assert conn.execute('PRAGMA cache_size').scalar() == -1000
+        assert conn.execute('PRAGMA busy_timeout').scalar() == 5000
+        conn.close()
+    engine.dispose()
+
+
+def test_versioning(tmpdir):
+    """
+    Flushed changes, cascaded deletes and bulk updates/deletes are
+    all copied into the history tables
+    """
+    engine = make_engine('sqlite:///' + str(tmpdir.join('history.db')))
+    session = sessionmaker(bind=engine)()
+    versioned_session(session)
+    VariantHistory = Variant.__history_mapper__.class_  # pylint: disable=invalid-name
+    CallHistory = Call.__history_mapper__.class_  # pylint: disable=invalid-name
+
+    ind = Individual(id=uuid.uuid4(), description='Subject Z')
+    variants = [Variant(id=uuid.uuid4(), chromosome='chr2', start=100*i, ref='A', alt='C',
+                        name='rs%d' % i) for i in range(4)]
+    session.add_all([ind] + variants)
+    session.add_all([Call(id=uuid.uuid4(), individual_id=ind.id, variant_id=v.id,
+                          genotype='0/1') for v in variants])
+    session.commit()
+    var_ids = [v.id for v in variants]
+
+    # unit of work: only objects with changes get a new version
+    variants[0].name = 'renamed'
+    variants[1].name = variants[1].name
+    session.commit()
+    assert [v.version for v in variants[:2]] == [2, 1]
+    old = session.query(VariantHistory).filter_by(id=var_ids[0]).one()
+    assert (old.name, old.version, old.chromosome) == ('rs0', 1, 'chr2')
+
+    # bulk update snapshots every matched row and bumps its version
+    session.query(Variant).filter(Variant.start >= 200).update({'ref': 'G'})
+    session.commit()
+    assert [v.version for v in variants] == [2, 1, 2, 2]
+    history = session.query(VariantHistory.version, VariantHistory.ref).\
+        filter(VariantHistory.id.in_(var_ids[2:])).all()
+    assert history == [(1, 'A'), (1, 'A')]
+
+    # deletes, including cascaded and bulk ones, keep the last version
+    session.delete(ind)
+    session.commit()
+    assert session.query(Call).count() == 0
+    assert session.query(CallHistory).count() == 4
+    session.query(Variant).filter(Variant.start < 200).delete()
+    session.commit()
+    assert session.query(VariantHistory).filter_by(id=var_ids[0]).\
+        order_by(VariantHistory.version).all()[-1].name == 'renamed'
+    assert session.query(VariantHistory).count() == 5
+
+    session.close()
+    engine.dispose()
+
+
+def test_history(tmpdir):
+    """
+    Version listing, point-in-time reads and compaction of the history
+    """
+    db_filename = str(tmpdir.join('history.db'))
+    engine = make_engine('sqlite:///' + db_filename)
+    session = sessionmaker(bind=engine)()
+    versioned_session(session)
+    keys = ('id', 'name', 'version', 'created')
+
+    times = [datetime.datetime(2019, 1, day) for day in range(1, 6)]
+    var_id = uuid.uuid4()
+    variant = Variant(id=var_id, chromosome='chr3', start=10, ref='A', alt='T',
+                      name='v1', created=times[0])
+    session.add(variant)
+    session.commit()
+    for name in ('v2', 'v3'):
+        variant.name = name
+        session.commit()
+    # date the versions as if each had been superseded a day after the last
+    VariantHistory = history.history_class(Variant)  # pylint: disable=invalid-name
+    for version, changed in [(1, times[1]), (2, times[3])]:
+        session.query(VariantHistory).filter_by(id=var_id, version=version)\
+            .update({'changed': changed})
+    session.commit()
+
+    versions = history.versions(session, Variant, var_id, keys)
+    assert [(row[1], row[2], changed) for row, changed in versions] == \
+        [('v1', 1, times[1]), ('v2', 2, times[3]), ('v3', 3, None)]
+
+    def name_as_of(when):
+        row = history.as_of(session, Variant, var_id, when, keys)
+        return row and row.name
+    before = datetime.timedelta(hours=1)
+    assert name_as_of(times[0] - before) is None
+    assert name_as_of(times[1] - before) == 'v1'
+    assert name_as_of(times[1]) == 'v2'
+    assert name_as_of(times[4]) == 'v3'
+
+    # squash keeps the newest version before the horizon, prune drops it
+    assert history.compact_history(engine, times[4], squash=True)['variants_history'] == 1
+    assert name_as_of(times[1] - before) == 'v2'
+    assert history.compact_history(engine, times[4])['variants_history'] == 1
+    assert len(history.versions(session, Variant, var_id, keys)) == 1
+    session.close()
+    engine.dispose()
+
+    # history indexes missing from an existing DB are added
+    conn = sqlite3.connect(db_filename)
+    conn.execute('DROP INDEX ix_variants_history_id_changed')
+    conn.close()
+    make_engine('sqlite:///' + db_filename).dispose()
+    conn = sqlite3.connect(db_filename)
+    plan = conn.execute('EXPLAIN QUERY PLAN SELECT * FROM variants_history '
+                        'WHERE id = ? AND changed > ?', (b'', '')).fetchall()
+    conn.close()
+    assert 'ix_variants_history_id_changed' in str(plan)
+
+
+def test_export_matrix(simple_db, tmpdir):
+    """
+    Export the DB fixture as a genotype matrix, and read it back
+    """
+    inds, variants, calls, db_filename = simple_db
+    engine = make_engine('sqlite:///'+db_filename)
+    metadata = export.export_matrix(engine, str(tmpdir), batch_size=3)
+    engine.dispose()
+    assert metadata['calls'] == len(calls)
+
+    genotypes, individual_index, variant_index = export.load_matrix(str(tmpdir))
+    assert genotypes.shape == (len(inds), len(variants))
+    individual_ids = export.index_uuids(individual_index)
+    variant_ids = export.index_uuids(variant_index)
+    assert individual_ids == sorted(ind.id for ind in inds)
+    assert list(variant_index['start']) == sorted(var.start for var in variants)
+
+    expected = {(call.individual_id, call.variant_id): export.genotype_code(call.genotype)
+                for call in calls}
+    for row, ind_id in enumerate(individual_ids):
+        for column, var_id in enumerate(variant_ids):
+            assert genotypes[row, column] == expected.get((ind_id, var_id), export.ABSENT)
+
+    assert export.genotype_code('1|2') == 2
+    assert export.genotype_code('./.') == export.MISSING
+
+
+def test_variant_stats(tmpdir):
+    """
+    Keep the allele statistics up to date through flushes, bulk changes
+    and core inserts, and check them against a rebuild
+    """
+    engine = make_engine('sqlite:///' + str(tmpdir.join('stats.db')))
+    session = sessionmaker(bind=engine)()
+    versioned_session(session)
+    stats.track_variant_stats(session)
+
+    inds = [Individual(id=uuid.uuid1(), description='Subject %d' % i) for i in range(4)]
+    variants = [Variant(id=uuid.uuid1(), chromosome='chr1', start=start, ref='A', alt='T')
+                for start in (100, 200)]
+    calls = [Call(id=uuid.uuid1(), individual=ind, variant=variants[0], genotype=genotype)
+             for ind, genotype in zip(inds, ['0/0', '0/1', '1|1', './.'])]
+    session.add_all(inds + variants + calls)
+    session.commit()
+
+    def counts():
+        return {row.variant_id: tuple(getattr(row, field) for field in stats.FIELDS)
+                for row in session.query(VariantStats) if row.calls}
+
+    assert counts() == {variants[0].id: (4, 3, 6, 1, 1, 1, 1)}
+
+    calls[0].genotype = '0/1'
+    calls[1].variant = variants[1]
+    session.delete(calls[2])
+    session.commit()
+    assert counts() == {variants[0].id: (2, 1, 2, 0, 1, 0, 1),
+                        variants[1].id: (1, 1, 2, 0, 1, 0, 0)}
+
+    session.query(Call).filter(Call.genotype == './.')\
+        .update({Call.genotype: '1/1'}, synchronize_session=False)
+    call = {'id': uuid.uuid1(), 'individual_id': inds[3].id, 'variant_id': str(variants[1].id),
+            'genotype': '1/2'}
+    session.execute(Call.__table__.insert(), [call])
+    stats.record_inserts(session.execute, [call])
+    session.commit()
+    expected = {variants[0].id: (2, 3, 4, 0, 1, 1, 0),
+                variants[1].id: (2, 3, 4, 0, 2, 0, 0)}
+    assert counts() == expected
+
+    with engine.begin() as conn:
+        assert stats.rebuild_stats(conn) == 2
+    assert counts() == expected
+
+    session.delete(variants[1])
+    session.commit()
+    assert set(counts()) == {variants[0].id}
+    assert stats.summary(expected[variants[0].id])['allele_frequency'] == 0.75
+    session.close()
+    engine.dispose()
+
+
+def test_compact_genotypes(simple_db, tmpdir):
+    """
+    Store genotypes as integer codes and formats by interned id, read
+    them back as strings, and migrate to and from compact storage
+    """
+    for genotype in ['0/1', '1|1', './.', '2', '0/1/2', '']:
+        assert compact.decode_genotype(compact.encode_genotype(genotype)) == genotype
+    assert compact.encode_genotype('0/1|2') is None
+    assert compact.encode_genotype('0/01') is None
+
+    engine = make_engine('sqlite:///' + str(tmpdir.join('compact.db')),
+                         genotype_storage=compact.COMPACT_STORAGE)
+    session = sessionmaker(bind=engine)()
+    variant = Variant(id=uuid.uuid1(), chromosome='chr1', start=100, ref='A', alt='T')
+    values = [('0/1', 'GQ:DP'), ('1|1', 'GQ:DP'), ('0/1|2', ''), (None, None)]
+    session.add_all([variant] + [Call(id=uuid.uuid1(), individual=Individual(id=uuid.uuid1()),
+                                      variant=variant, genotype=genotype, fmt=fmt)
+                                 for genotype, fmt in values])
+    session.commit()
+    session.close()
+
+    raw = engine.execute('SELECT genotype, fmt FROM calls').fetchall()
+    assert all(isinstance(value, int) for row in raw for value in row if value is not None)
+    assert engine.execute('SELECT count(*) FROM call_strings').scalar() == 2
+    engine.dispose()
+
+    engine = make_engine('sqlite:///' + str(tmpdir.join('compact.db')))
+    assert compact.detect_storage(engine) == compact.COMPACT_STORAGE
+    session = sessionmaker(bind=engine)()
+    assert sorted(session.query(Call.genotype, Call.fmt), key=str) == sorted(values, key=str)
+    assert session.query(Call).filter(Call.genotype == '1|1').one().fmt == 'GQ:DP'
+    session.close()
+    engine.dispose()
+
+    _, _, calls, db_filename = simple_db
+    compact_db, text_db = db_filename + '.compact', db_filename + '.text'
+    migrate_guids(db_filename, output=compact_db, genotype_storage=compact.COMPACT_STORAGE)
+    migrate_guids(compact_db, output=text_db, genotype_storage=compact.TEXT_STORAGE)
+    expected = sorted((c.id.hex, c.genotype) for c in calls)
+    for filename in (compact_db, text_db):
+        conn = sqlite3.connect(filename)
+        rows = conn.execute('SELECT id, genotype FROM calls').fetchall()
+        conn.close()
+        assert isinstance(rows[0][1], int) == (filename == compact_db)
+        assert sorted((i.hex(), compact.decode_genotype(g) if isinstance(g, int) else g)
+                      for i, g in rows) == expected
+        os.remove(filename)
+
+
 def test_relationships(simple_db):
     """
     Test the individual <-> call <-> variant relationship
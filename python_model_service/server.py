@@ -0,0 +1,425 @@
+"""
+Serve the WSGI application with tornado, either in this process or in
+a supervised pool of pre-forked worker processes
+
+Workers share listening sockets bound by the parent before forking, and
+the kernel spreads connections between them.  Anything which must not be
+shared across a fork - DB engines and sessions, logging threads - is set
+up in each worker by the `setup` callback.
+
+The supervisor restarts workers which die abnormally.  On SIGHUP it
+replaces the workers one at a time, each new worker starting before the
+old one is told to finish its requests and exit; on SIGTERM or SIGINT
+all workers are shut down the same way.  Workers are forked from the
+supervisor, so a restart refreshes processes but does not reload code.
+
+By default each worker runs the WSGI app on its IOLoop thread, one
+request at a time, as tornado's WSGIContainer does.  With `threads`, it
+instead hands requests to a bounded thread pool (ThreadPoolWSGIContainer)
+so that one slow query doesn't hold up every other client, and streams
+out responses without a Content-Length as they are produced;
+WSGIContainer collects every response body before sending it.
+"""
+import os
+import json
+import time
+import signal
+import asyncio
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import tornado
+import tornado.httpserver
+import tornado.netutil
+import tornado.web
+import tornado.wsgi
+from tornado import httputil
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from python_model_service.api import etags
+
+LOGGER = logging.getLogger(__name__)
+
+# abnormal worker exits tolerated before the supervisor gives up
+MAX_RESTARTS = 100
+
+# seconds a stopping worker waits for open connections to finish
+SHUTDOWN_GRACE = 30.0
+
+# seconds between supervisor checks on its workers
+POLL_INTERVAL = 0.2
+
+# requests which may wait for a free thread before new ones are refused
+DEFAULT_QUEUE_DEPTH = 64
+
+
+class ThreadPoolWSGIContainer(tornado.wsgi.WSGIContainer):
+    """
+    WSGIContainer which runs the app on a pool of threads rather than on
+    the IOLoop thread
+
+    Requests beyond the number of threads wait for one, up to queue_depth
+    of them; past that, requests are refused with a 503.  The app, including
+    any streamed response and the app-context teardown, runs entirely in
+    one pool thread per request, so thread-local state such as the
+    orm.get_session() scoped_session is per request as before.
+
+    Responses without a Content-Length - streamed lists, compressed
+    responses - are sent chunked as the app produces them, rather than
+    collected first.
+    """
+    def __init__(self, wsgi_application, threads, queue_depth=DEFAULT_QUEUE_DEPTH):
+        super(ThreadPoolWSGIContainer, self).__init__(wsgi_application)
+        self.executor = ThreadPoolExecutor(threads)
+        self.capacity = threads + queue_depth
+        self.pending = 0  # only changed on the IOLoop thread
+
+    def __call__(self, request):
+        if self.pending >= self.capacity:
+            body = json.dumps({'message': 'Server busy', 'code': 503}).encode()
+            self._respond(request, '503 Service Unavailable',
+                          [('Content-Type', 'application/json'), ('Retry-After', '1')],
+                          body)
+            return
+        environ = self.environ(request)
+        environ['wsgi.multithread'] = True
+        self.pending += 1
+        io_loop = IOLoop.current()
+        future = io_loop.run_in_executor(self.executor, self._run_app, io_loop, request, environ)
+        io_loop.add_future(future, functools.partial(self._finish, request))
+
+    def _run_app(self, io_loop, request, environ):
+        """
+        In a pool thread: run the app.  A response without a Content-Length
+        is streamed out from here, and None returned; otherwise the status,
+        headers and body are returned for _finish to write.
+        """
+        data = {}
+        response = []
+
+        def start_response(status, headers, exc_info=None):  # pylint:disable=unused-argument
+            data['status'] = status
+            data['headers'] = headers
+            return response.append
+
+        app_response = self.wsgi_application(environ, start_response)
+        try:
+            if data and _streamable(data['status'], data['headers']):
+                self._stream(io_loop, request, data['status'], data['headers'],
+                             b''.join(response), app_response)
+                return None
+            response.extend(app_response)
+        finally:
+            if hasattr(app_response, 'close'):
+                app_response.close()
+        if not data:
+            raise Exception('WSGI app did not call start_response')
+        return data['status'], data['headers'], b''.join(response)
+
+    def _stream(self, io_loop, request, status,  # pylint:disable=too-many-arguments
+                headers, written, chunks):
+        """
+        In a pool thread: write the response chunk by chunk as the app
+        produces it, waiting for each chunk to be sent so that a slow
+        client holds the app back rather than letting chunks pile up
+        """
+        try:
+            _on_loop(io_loop, self._write_headers, request, status, headers, written or None)
+            for chunk in chunks:
+                if chunk:
+                    _on_loop(io_loop, request.connection.write, chunk)
+        except StreamClosedError:
+            LOGGER.info('Connection closed during %s %s', request.method, request.uri)
+            return
+        except Exception:  # pylint:disable=broad-except
+            # too late for an error response: cut the body short
+            LOGGER.exception('Error streaming %s %s', request.method, request.uri)
+            _on_loop(io_loop, request.connection.close)
+            return
+        _on_loop(io_loop, self._end, request, status)
+
+    def _finish(self, request, future):
+        """Back on the IOLoop: write the response, unless it was streamed"""
+        self.pending -= 1
+        try:
+            result = future.result()
+        except Exception:  # pylint:disable=broad-except
+            LOGGER.exception('Error running %s %s', request.method, request.uri)
+            result = ('500 Internal Server Error', [('Content-Type', 'text/plain')],
+                      b'Internal Server Error\n')
+        if result is not None:
+            self._respond(request, *result)
+
+    def _respond(self, request, status, headers, body):
+        """Write a complete response"""
+        self._write_headers(request, status, headers, body)
+        self._end(request, status)
+
+    @staticmethod
+    def _write_headers(request, status, headers, body=None):
+        """
+        Write the status line and headers, filling them in as WSGIContainer
+        does, and any body so far; without a Content-Length, the rest of
+        the body follows chunked
+        """
+        status_code_str, reason = status.split(' ', 1)
+        status_code = int(status_code_str)
+        header_set = set(k.lower() for (k, v) in headers)
+        if status_code != 304:
+            if 'content-length' not in header_set and not _streamable(status, headers):
+                headers.append(('Content-Length', str(len(body or b''))))
+            if 'content-type' not in header_set:
+                headers.append(('Content-Type', 'text/html; charset=UTF-8'))
+        if 'server' not in header_set:
+            headers.append(('Server', 'TornadoServer/%s' % tornado.version))
+
+        start_line = httputil.ResponseStartLine('HTTP/1.1', status_code, reason)
+        header_obj = httputil.HTTPHeaders()
+        for key, value in headers:
+            header_obj.add(key, value)
+        return request.connection.write_headers(start_line, header_obj, chunk=body)
+
+    def _end(self, request, status):
+        """Finish the response and log it"""
+        request.connection.finish()
+        self._log(int(status.split(' ', 1)[0]), request)
+
+    async def drain(self, timeout):
+        """Wait up to timeout seconds for requests in progress to finish"""
+        deadline = time.monotonic() + timeout
+        while self.pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        return not self.pending
+
+    def shutdown(self):
+        """Stop the pool's threads"""
+        self.executor.shutdown(wait=True)
+
+
+def _streamable(status, headers):
+    """Is a response one to stream, having a body but no Content-Length?"""
+    if int(status.split(' ', 1)[0]) in (204, 304):
+        return False
+    return not any(name.lower() == 'content-length' for name, _ in headers)
+
+
+def _on_loop(io_loop, func, *args):
+    """
+    From another thread: call func on the IOLoop, and wait for it and for
+    any future it returns
+    """
+    async def call():
+        result = func(*args)
+        if result is not None:
+            await result
+    return asyncio.run_coroutine_threadsafe(call(), io_loop.asyncio_loop).result()
+
+
+def wsgi_container(wsgi_app, threads=0, queue_depth=DEFAULT_QUEUE_DEPTH):
+    """
+    Tornado request callback for the app: run on the IOLoop thread,
+    or if `threads`, on a pool of that many threads
+    """
+    if threads:
+        return ThreadPoolWSGIContainer(wsgi_app, threads, queue_depth)
+    return tornado.wsgi.WSGIContainer(wsgi_app)
+
+
+class GZipContentEncoding(tornado.web.GZipContentEncoding):
+    """
+    tornado's gzip transform, also giving a gzipped response the ETag of
+    the gzipped representation, as CompressionMiddleware does
+    """
+    def __init__(self, request):
+        super(GZipContentEncoding, self).__init__(request)
+        self._coding = 'gzip' if self._gzipping else None
+        self._if_none_match = request.headers.get('If-None-Match')
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        status_code, headers, chunk = super(GZipContentEncoding, self).transform_first_chunk(
+            status_code, headers, chunk, finishing)
+        if 'Etag' in headers:
+            if self._gzipping:
+                headers['Etag'] = etags.encoded_etag(headers['Etag'], 'gzip')
+            elif status_code == 304:
+                headers['Etag'] = etags.not_modified_etag(headers['Etag'], self._coding,
+                                                          self._if_none_match)
+        return status_code, headers, chunk
+
+
+def run_worker(wsgi_app, sockets, setup=None, worker_id=0,  # pylint:disable=too-many-arguments
+               threads=0, queue_depth=DEFAULT_QUEUE_DEPTH, routes=None, on_stop=None,
+               compress=False):
+    """
+    Serve the app on already-bound sockets until SIGTERM or SIGINT,
+    then stop accepting, let open connections finish, and return
+
+    :param setup: called as setup(worker_id) before serving; may return
+                  a function to call once serving has stopped
+    :param threads: run requests on a pool of this many threads
+    :param queue_depth: with threads, requests to queue before refusing more
+    :param routes: function of the WSGI container giving tornado routing
+                   rules for requests handled natively on the event loop;
+                   anything else goes to the WSGI app
+    :param on_stop: coroutine function awaited once requests have finished
+    :param compress: gzip the responses of the routes' handlers, for
+                     clients which accept it
+    """
+    teardown = setup(worker_id) if setup else None
+
+    container = wsgi_container(wsgi_app, threads, queue_depth)
+    if routes:
+        application = tornado.web.Application(
+            routes(container) + [(r'.*', tornado.web.FallbackHandler, {'fallback': container})],
+            transforms=[GZipContentEncoding] if compress else [])
+    else:
+        application = container
+    server = tornado.httpserver.HTTPServer(application)
+    server.add_sockets(sockets)
+    io_loop = IOLoop.current()
+
+    async def shutdown():
+        """Stop accepting, then wait for open connections to finish"""
+        server.stop()
+        if threads and not await container.drain(SHUTDOWN_GRACE):
+            LOGGER.warning('worker %d: requests still running after %.0fs',
+                           worker_id, SHUTDOWN_GRACE)
+        try:
+            await asyncio.wait_for(server.close_all_connections(), SHUTDOWN_GRACE)
+        except asyncio.TimeoutError:
+            LOGGER.warning('worker %d: connections still open after %.0fs',
+                           worker_id, SHUTDOWN_GRACE)
+        if on_stop:
+            await on_stop()
+        io_loop.stop()
+
+    def on_signal(_signum, _frame):
+        """Begin a graceful shutdown"""
+        io_loop.add_callback_from_signal(shutdown)
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    try:
+        io_loop.start()
+    finally:
+        if threads:
+            container.shutdown()
+        if teardown:
+            teardown()
+
+
+class Supervisor(object):
+    """
+    Pool of forked worker processes serving on shared sockets
+    """
+    def __init__(self, wsgi_app, sockets, workers, setup=None,  # pylint:disable=too-many-arguments
+                 max_restarts=MAX_RESTARTS, **worker_options):
+        self.wsgi_app = wsgi_app
+        self.sockets = sockets
+        self.workers = workers
+        self.setup = setup
+        self.max_restarts = max_restarts
+        self.worker_options = worker_options
+        self.restarts = 0
+        self.children = {}  # pid: worker id
+        self._stopping = False
+        self._reload = False
+
+    def spawn(self, worker_id):
+        """Fork a worker; in the child, serve and then exit"""
+        pid = os.fork()
+        if pid == 0:
+            for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, signal.SIG_DFL)
+            status = 0
+            try:
+                run_worker(self.wsgi_app, self.sockets, self.setup, worker_id,
+                           **self.worker_options)
+            except Exception:  # pylint:disable=broad-except
+                LOGGER.exception('worker %d failed', worker_id)
+                status = 1
+            finally:
+                os._exit(status)  # pylint:disable=protected-access
+        self.children[pid] = worker_id
+        LOGGER.info('worker %d started, pid %d', worker_id, pid)
+        return pid
+
+    def _stop_child(self, pid):
+        """Ask one worker to finish up, and wait for it"""
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        os.waitpid(pid, 0)
+        self.children.pop(pid, None)
+
+    def _rolling_restart(self):
+        """Replace each worker in turn, starting its replacement first"""
+        LOGGER.info('restarting workers')
+        for pid, worker_id in list(self.children.items()):
+            self.spawn(worker_id)
+            self._stop_child(pid)
+
+    def _reap(self):
+        """Handle exited workers, restarting any which died abnormally"""
+        while self.children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                return
+            worker_id = self.children.pop(pid, None)
+            if worker_id is None or self._stopping:
+                continue
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                LOGGER.info('worker %d (pid %d) exited', worker_id, pid)
+                continue
+            self.restarts += 1
+            if self.restarts > self.max_restarts:
+                raise RuntimeError('too many worker restarts')
+            LOGGER.warning('worker %d (pid %d) died with status %d; restarting',
+                           worker_id, pid, status)
+            self.spawn(worker_id)
+
+    def run(self):
+        """Start the workers and supervise them until told to stop"""
+        def on_reload(_signum, _frame):
+            self._reload = True
+
+        def on_stop(_signum, _frame):
+            self._stopping = True
+
+        signal.signal(signal.SIGHUP, on_reload)
+        signal.signal(signal.SIGTERM, on_stop)
+        signal.signal(signal.SIGINT, on_stop)
+
+        for worker_id in range(self.workers):
+            self.spawn(worker_id)
+
+        while self.children and not self._stopping:
+            if self._reload:
+                self._reload = False
+                self._rolling_restart()
+            self._reap()
+            time.sleep(POLL_INTERVAL)
+
+        self._stopping = True
+        for pid in list(self.children):
+            self._stop_child(pid)
+
+
+def serve(wsgi_app, port, workers=1, setup=None, address='', **worker_options):
+    """
+    Serve the app on a port, in this process or in `workers` worker processes
+
+    :param setup: called in each worker as setup(worker_id) before it
+                  serves; may return a function to call when it stops
+    :param worker_options: threads, queue_depth, routes, on_stop and
+                           compress, as for run_worker
+    """
+    sockets = tornado.netutil.bind_sockets(int(port), address=address)
+    if workers <= 1:
+        run_worker(wsgi_app, sockets, setup, **worker_options)
+    else:
+        Supervisor(wsgi_app, sockets, workers, setup, **worker_options).run()
+    for sock in sockets:
+        sock.close()
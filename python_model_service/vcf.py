@@ -0,0 +1,308 @@
+"""
+Streaming VCF importer
+
+Reads a (possibly bgzipped) VCF, mapping each record to a Variant and
+each sample column to an Individual, with one Call per sample per
+record.  Records are parsed in a pool of worker processes and written
+in fixed-size chunks, each chunk with bulk inserts in one transaction.
+"""
+import sys
+import argparse
+import collections
+import contextlib
+import datetime
+import gzip
+import logging
+import multiprocessing
+import uuid
+
+from python_model_service import orm
+from python_model_service.orm import compact
+from python_model_service.orm.models import Individual, Variant, Call
+from python_model_service.orm.stats import record_inserts
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 1000
+QUERY_CHUNK = 400
+
+# chunks read ahead per parsing process, before waiting for parsed ones
+CHUNKS_PER_WORKER = 2
+
+
+@contextlib.contextmanager
+def _stdin():
+    """stdin as a context manager which leaves it open"""
+    yield sys.stdin
+
+
+def open_vcf(filename):
+    """
+    Open a plain or (b)gzipped VCF for reading text; '-' is stdin
+    """
+    if filename == '-':
+        return _stdin()
+    if filename.endswith('.gz') or filename.endswith('.bgz'):
+        # bgzip files are valid multi-member gzip streams
+        return gzip.open(filename, 'rt')
+    return open(filename, 'r')
+
+
+def read_samples(vcf):
+    """
+    Skip the meta-information lines and return the sample names from
+    the #CHROM header line
+    """
+    for line in vcf:
+        if line.startswith('##'):
+            continue
+        if line.startswith('#CHROM'):
+            return line.rstrip('\n').split('\t')[9:]
+        break
+    raise ValueError('VCF has no #CHROM header line')
+
+
+def read_chunks(vcf, chunk_size):
+    """
+    Generate lists of up to chunk_size raw record lines
+    """
+    chunk = []
+    for line in vcf:
+        if not line.strip() or line.startswith('#'):
+            continue
+        chunk.append(line)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _is_ref_or_missing(genotype):
+    """True if a GT value has no alternate alleles called"""
+    alleles = genotype.replace('|', '/').split('/')
+    return all(allele in ('0', '.') for allele in alleles)
+
+
+def parse_record(line, skip_ref=False):
+    """
+    Parse a VCF record line
+
+    :param line: tab-separated record
+    :param skip_ref: drop calls with no alternate allele called
+    :return: (chromosome, start, name, ref, alt, calls) where calls is a
+             list of (sample_index, genotype, fmt)
+    """
+    fields = line.rstrip('\n').split('\t')
+    chrom, pos, name, ref, alt = fields[:5]
+    if name == '.':
+        name = ''
+
+    calls = []
+    if len(fields) > 9:
+        keys = fields[8].split(':')
+        gt_index = keys.index('GT') if 'GT' in keys else None
+        other_keys = ':'.join(k for i, k in enumerate(keys) if i != gt_index)
+        for sample_index, sample in enumerate(fields[9:]):
+            values = sample.split(':')
+            if gt_index is not None and gt_index < len(values):
+                genotype = values[gt_index]
+            else:
+                genotype = '.'
+            if skip_ref and _is_ref_or_missing(genotype):
+                continue
+            others = ':'.join(v for i, v in enumerate(values) if i != gt_index)
+            fmt = other_keys + ' ' + others if others else ''
+            calls.append((sample_index, genotype, fmt))
+
+    return chrom, int(pos), name, ref, alt, calls
+
+
+def parse_chunk(job):
+    """
+    Parse a chunk of record lines; run in the worker pool
+    """
+    lines, skip_ref = job
+    return [parse_record(line, skip_ref) for line in lines]
+
+
+def _chunks(items, size):
+    """Split a list into consecutive chunks of at most size items"""
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+
+def individual_ids(db_session, samples):
+    """
+    Map sample names to Individual ids, creating individuals
+    (description = sample name) for samples not yet in the DB
+    """
+    ids = {}
+    for chunk in _chunks(samples, QUERY_CHUNK):
+        q = db_session.query(Individual.description, Individual.id)\
+            .filter(Individual.description.in_(chunk))
+        ids.update((desc, iid) for desc, iid in q)
+
+    now = datetime.datetime.utcnow()
+    new = [{'id': uuid.uuid1(), 'description': sample, 'created': now, 'updated': now}
+           for sample in samples if sample not in ids]
+    if new:
+        db_session.execute(Individual.__table__.insert(), new)
+        db_session.commit()
+        ids.update((row['description'], row['id']) for row in new)
+
+    return [ids[sample] for sample in samples]
+
+
+def _existing_variants(db_session, records):
+    """
+    Map (chromosome, start, ref, alt) to id for any of the records'
+    variants already in the DB
+    """
+    found = {}
+    for chunk in _chunks(records, QUERY_CHUNK):
+        chromosomes = {rec[0] for rec in chunk}
+        starts = {rec[1] for rec in chunk}
+        q = db_session.query(Variant.chromosome, Variant.start, Variant.ref,
+                             Variant.alt, Variant.id)\
+            .filter(Variant.chromosome.in_(chromosomes))\
+            .filter(Variant.start.in_(starts))
+        found.update(((c, s, r, a), vid) for c, s, r, a, vid in q)
+    return found
+
+
+def _existing_calls(db_session, variant_ids):
+    """
+    Set of (variant_id, individual_id) for calls on the given variants
+    """
+    found = set()
+    for chunk in _chunks(list(variant_ids), QUERY_CHUNK):
+        q = db_session.query(Call.variant_id, Call.individual_id)\
+            .filter(Call.variant_id.in_(chunk))
+        found.update(tuple(row) for row in q)
+    return found
+
+
+def write_chunk(db_session, records, ind_ids):
+    """
+    Bulk insert a chunk of parsed records in one transaction
+
+    :return: (number of variants, number of calls) inserted
+    """
+    now = datetime.datetime.utcnow()
+    existing = _existing_variants(db_session, records)
+    existing_calls = _existing_calls(db_session, set(existing.values())) if existing else set()
+
+    variants = []
+    calls = []
+    var_ids = dict(existing)
+    for chrom, start, name, ref, alt, rec_calls in records:
+        key = (chrom, start, ref, alt)
+        vid = var_ids.get(key)
+        if vid is None:
+            vid = uuid.uuid1()
+            var_ids[key] = vid
+            variants.append({'id': vid, 'chromosome': chrom, 'start': start,
+                             'ref': ref, 'alt': alt, 'name': name,
+                             'created': now, 'updated': now})
+        for sample_index, genotype, fmt in rec_calls:
+            iid = ind_ids[sample_index]
+            if (vid, iid) in existing_calls:
+                continue
+            existing_calls.add((vid, iid))
+            calls.append({'id': uuid.uuid1(), 'variant_id': vid, 'individual_id': iid,
+                          'genotype': genotype, 'fmt': fmt,
+                          'created': now, 'updated': now})
+
+    try:
+        if variants:
+            db_session.execute(Variant.__table__.insert(), variants)
+        if calls:
+            db_session.execute(Call.__table__.insert(), calls)
+            record_inserts(db_session.execute, calls)
+        db_session.commit()
+    except orm.ORMException:
+        db_session.rollback()
+        raise
+
+    return len(variants), len(calls)
+
+
+def parse_in_order(pool, jobs, workers=None):
+    """
+    Parse jobs in a pool, yielding results in order, with no more than
+    CHUNKS_PER_WORKER chunks per process read but not yet written, so
+    that a large VCF is never read far ahead of the database writes
+    """
+    in_flight = CHUNKS_PER_WORKER * (workers or multiprocessing.cpu_count())
+    pending = collections.deque()
+    for job in jobs:
+        if len(pending) >= in_flight:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(parse_chunk, (job,)))
+    while pending:
+        yield pending.popleft().get()
+
+
+def import_vcf(filename, workers=None, chunk_size=DEFAULT_CHUNK_SIZE, skip_ref=False):
+    """
+    Stream a VCF into the database opened by orm.init_db
+
+    :param filename: VCF filename, optionally (b)gzipped; '-' for stdin
+    :param workers: number of parsing processes; 1 parses inline
+    :param chunk_size: number of records per parse job and per transaction
+    :param skip_ref: skip calls with no alternate allele called
+    :return: (number of variants, number of calls) inserted
+    """
+    db_session = orm.get_session()
+    nvariants = ncalls = 0
+
+    with open_vcf(filename) as vcf:
+        samples = read_samples(vcf)
+        ind_ids = individual_ids(db_session, samples)
+        jobs = ((chunk, skip_ref) for chunk in read_chunks(vcf, chunk_size))
+
+        pool = multiprocessing.Pool(workers) if workers != 1 else None
+        try:
+            parsed = parse_in_order(pool, jobs, workers) if pool else map(parse_chunk, jobs)
+            for records in parsed:
+                nvar, ncall = write_chunk(db_session, records, ind_ids)
+                nvariants += nvar
+                ncalls += ncall
+                LOGGER.info('imported %d variants, %d calls', nvariants, ncalls)
+        finally:
+            if pool:
+                pool.terminate()
+
+    return nvariants, ncalls
+
+
+def main(args=None):
+    """Command line entry point: import-vcf"""
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = argparse.ArgumentParser('python_model_service import-vcf',
+                                     description='Bulk load a VCF into the model service DB')
+    parser.add_argument('vcf', help='VCF file, optionally bgzipped; - for stdin')
+    parser.add_argument('--database', default="./data/model_service.sqlite")
+    parser.add_argument('--workers', type=int, default=None,
+                        help='parsing processes (default: number of CPUs)')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='records per bulk insert transaction')
+    parser.add_argument('--skip-ref', action='store_true',
+                        help='do not store hom-ref or missing genotype calls')
+    parser.add_argument('--genotype-storage', default=None, choices=compact.STORAGE_MODES,
+                        help='store genotypes and formats as text or compact integers, '
+                             'if the database is new (default: text)')
+    parser.add_argument('--loglevel', default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARN', 'ERROR', 'CRITICAL'])
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=getattr(logging, args.loglevel.upper()),
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    orm.init_db('sqlite:///' + args.database, genotype_storage=args.genotype_storage)
+    nvariants, ncalls = import_vcf(args.vcf, workers=args.workers,
+                                   chunk_size=args.chunk_size, skip_ref=args.skip_ref)
+    LOGGER.info('done: %d variants, %d calls', nvariants, ncalls)
+    return 0
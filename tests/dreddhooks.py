@@ -8,6 +8,7 @@ import dredd_hooks as hooks
 
 ORDER = ["/v1/individuals > Add an individual to the database > 201 > application/json",
          "/v1/individuals > Add an individual to the database > 405 > application/json",
+         "/v1/individuals:batch > Add a batch of individuals to the database > 200 > application/json",
          "/v1/individuals > Get all individuals > 200 > application/json",
          "/v1/individuals/{individual_id} > Get specific individual > 404 > application/json",
          "/v1/individuals/{individual_id} > Get specific individual > 200 > application/json",
@@ -15,6 +16,7 @@ ORDER = ["/v1/individuals > Add an individual to the database > 201 > applicatio
          "/v1/individuals/{individual_id} > Update specific individual > 404 > application/json",
          "/v1/variants > Add a variant to the database > 201 > application/json",
          "/v1/variants > Add a variant to the database > 405 > application/json",
+         "/v1/variants:batch > Add a batch of variants to the database > 200 > application/json",
          "/v1/variants > Get all variants within genomic range > 200 > application/json",
          "/v1/variants/{variant_id} > Get specific variant > 200 > application/json",
          "/v1/variants/{variant_id} > Get specific variant > 404 > application/json",
@@ -22,6 +24,7 @@ ORDER = ["/v1/individuals > Add an individual to the database > 201 > applicatio
          "/v1/variants/{variant_id} > Update specific variant > 404 > application/json",
          "/v1/calls > Add a call to the database > 201 > application/json",
          "/v1/calls > Add a call to the database > 405 > application/json",
+         "/v1/calls:batch > Add a batch of calls to the database > 200 > application/json",
          "/v1/calls > Get all calls > 200 > application/json",
          "/v1/calls/{call_id} > Get specific call > 200 > application/json",
          "/v1/calls/{call_id} > Get specific call > 404 > application/json",
@@ -31,6 +34,9 @@ ORDER = ["/v1/individuals > Add an individual to the database > 201 > applicatio
          "/v1/individuals/{individual_id}/variants > Get variants called in an individual > 404 > application/json",
          "/v1/variants/{variant_id}/individuals > Get individuals with a given variant called > 200 > application/json",
          "/v1/variants/{variant_id}/individuals > Get individuals with a given variant called > 404 > application/json",
+         "/v1/variants/{variant_id}/stats > Get a variant's allele statistics > 200 > application/json",
+         "/v1/variants/{variant_id}/stats > Get a variant's allele statistics > 404 > application/json",
+         "/v1/genotypes > Get the genotypes of the variants within a genomic range, as a matrix > 200 > application/json",
          "/v1/individuals/{individual_id} > Delete specific individual > 204 > application/json",
          "/v1/individuals/{individual_id} > Delete specific individual > 404 > application/json",
          "/v1/variants/{variant_id} > Delete specific variant > 204 > application/json",
@@ -120,6 +126,7 @@ def insert_individual_id(transaction):
 
 
 @hooks.before("/v1/variants/{variant_id}/individuals > Get individuals with a given variant called > 200 > application/json")
+@hooks.before("/v1/variants/{variant_id}/stats > Get a variant's allele statistics > 200 > application/json")
 @hooks.before("/v1/variants/{variant_id} > Get specific variant > 200 > application/json")
 @hooks.before("/v1/variants/{variant_id} > Update specific variant > 204 > application/json")
 @hooks.before("/v1/variants/{variant_id} > Delete specific variant > 204 > application/json")
@@ -146,3 +153,13 @@ def prepare_call_request(transaction):
     request_body['individual_id'] = response_stash['individual_ids'][0]
     request_body['variant_id'] = response_stash['variant_ids'][0]
     transaction['request']['body'] = json.dumps(request_body)
+
+
+@hooks.before("/v1/calls:batch > Add a batch of calls to the database > 200 > application/json")
+def prepare_call_batch_request(transaction):
+    """Update the body of the example call batch with saved variant and individual ids"""
+    request_body = json.loads(transaction['request']['body'])
+    for call in request_body:
+        call['individual_id'] = response_stash['individual_ids'][-1]
+        call['variant_id'] = response_stash['variant_ids'][-1]
+    transaction['request']['body'] = json.dumps(request_body)
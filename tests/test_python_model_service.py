@@ -3,10 +3,313 @@
 
 """Tests for `python_model_service` package."""
 
+import asyncio
+import json
 import subprocess
+import threading
+import uuid
+import zlib
+
+import pytest
+from sqlalchemy.orm import Query, sessionmaker
+
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+
+from benchmarks import startup
+from python_model_service import orm
+from python_model_service.orm.models import Variant
+from python_model_service.orm.serializers import serializer
+from python_model_service.vcf import parse_record
+from python_model_service.api.cache import ObjectCache
+from python_model_service.api import etags, validation
+from python_model_service.api.operations import _genotype_matrix
+from python_model_service.api.streaming import CompressionMiddleware, accepted_coding, json_array
+from python_model_service.api.metrics import Metrics
+from python_model_service.server import ThreadPoolWSGIContainer
+
+
+def run_async(coroutine):
+    """Run a coroutine to completion on a new event loop"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
 
 
 def test_dredd():
     subprocess.check_call(['dredd', '--language=python',
                            '--hookfiles=./dreddhooks.py'],
                           cwd='./tests')
+
+
+def test_parse_vcf_record():
+    line = '20\t1110696\trs6040355\tA\tG,T\t67\tPASS\tNS=2\tGT:GQ:DP\t1|2:21:6\t0/0:2:0\t./.:35:4\n'
+    chrom, start, name, ref, alt, calls = parse_record(line)
+    assert (chrom, start, name, ref, alt) == ('20', 1110696, 'rs6040355', 'A', 'G,T')
+    assert calls == [(0, '1|2', 'GQ:DP 21:6'), (1, '0/0', 'GQ:DP 2:0'), (2, './.', 'GQ:DP 35:4')]
+
+    _, _, _, _, _, calls = parse_record(line, skip_ref=True)
+    assert calls == [(0, '1|2', 'GQ:DP 21:6')]
+
+
+def test_object_cache():
+    now = [0.0]
+    cache = ObjectCache(maxsize=2, ttl=10, clock=lambda: now[0])
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)                   # evicts b, the least recently used
+    assert cache.get('b') is None
+    cache.invalidate('c')
+    assert cache.get('c') is None
+    now[0] = 11.0                       # a has expired
+    assert cache.get('a') is None
+
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions']) == (1, 3, 1)
+    assert (stats['invalidations'], stats['expirations'], stats['size']) == (1, 1, 0)
+
+
+def test_startup_budget():
+    # building the connexion app is timed by the benchmark, not here
+    result = startup.run(repeat=3, app=False)
+    assert result['loaded'] == []
+    assert result['over_budget'] == []
+
+
+def test_response_validation_policy():
+    try:
+        validation.configure_validation(strict=False, sample_rate=0.0,
+                                        operations=['get_variants'])
+        assert validation.VALIDATION.sampled('get_variants')
+        assert not validation.VALIDATION.sampled('get_calls')
+        validation.configure_validation(sample_rate=1.0)
+        assert validation.VALIDATION.sampled('get_calls')
+        validation.configure_validation(strict=True, sample_rate=0.0)
+        assert validation.VALIDATION.sampled('get_calls')
+    finally:
+        validation.configure_validation(strict=True, sample_rate=validation.DEFAULT_SAMPLE_RATE,
+                                        operations=())
+
+
+def test_sampled_response_recorder():
+    # pylint:disable=protected-access
+    sent = []
+    body = validation._Recorder(iter(['[1,', b'2]']), sent.append)
+    assert list(body) == ['[1,', b'2]']
+    body.close()
+    assert [validation._joined(chunks) for chunks in sent] == [b'[1,2]']
+
+    # a body not sent in full isn't checked
+    body = validation._Recorder(iter([b'[1,', b'2]']), sent.append)
+    next(iter(body))
+    body.close()
+    assert len(sent) == 1
+
+    # nor is one too long to keep, which counts as dropped
+    dropped = validation.STATS.dropped
+    body = validation._Recorder(iter([b'[1,', b'2]']), sent.append, max_size=3)
+    assert list(body) == [b'[1,', b'2]']
+    body.close()
+    assert len(sent) == 1 and validation.STATS.dropped == dropped + 1
+
+
+def test_thread_pool_wsgi_container():
+    release = threading.Event()
+
+    def app(environ, start_response):
+        if environ['PATH_INFO'] == '/slow':
+            release.wait(10)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [threading.current_thread().name.encode()]
+
+    async def run():
+        container = ThreadPoolWSGIContainer(app, threads=2, queue_depth=0)
+        sockets = bind_sockets(0, '127.0.0.1')
+        server = HTTPServer(container)
+        server.add_sockets(sockets)
+        url = 'http://127.0.0.1:%d/' % sockets[0].getsockname()[1]
+        client = AsyncHTTPClient()
+
+        # a slow request doesn't hold up others...
+        slow = [asyncio.ensure_future(client.fetch(url + 'slow'))]
+        fast = await client.fetch(url + 'fast')
+        # (requests run on the pool's threads, not the event loop's)
+        assert fast.code == 200 and fast.body != threading.current_thread().name.encode()
+
+        # ...until every thread is busy and the queue is full
+        slow.append(asyncio.ensure_future(client.fetch(url + 'slow')))
+        while container.pending < 2:
+            await asyncio.sleep(0.01)
+        busy = await client.fetch(url + 'fast', raise_error=False)
+        assert busy.code == 503
+
+        release.set()
+        responses = await asyncio.gather(*slow)
+        assert [response.code for response in responses] == [200, 200]
+        server.stop()
+        container.shutdown()
+
+    run_async(run())
+
+
+def test_compression():
+    assert accepted_coding('gzip, deflate') == 'gzip'
+    assert accepted_coding('gzip;q=0.5, deflate') == 'deflate'
+    assert accepted_coding('br, *;q=0.1') == 'gzip'
+    assert accepted_coding('identity') is None
+    assert accepted_coding('gzip;q=0') is None
+
+    chunks = list(json_array(range(5), lambda n: {'n': n}, batch_rows=2))
+    assert len(chunks) == 4
+    assert json.loads(''.join(chunks)) == [{'n': n} for n in range(5)]
+    assert list(json_array([], str)) == ['[]']
+
+    def app(environ, start_response):
+        # a streamed body, in chunks, with no Content-Length
+        start_response(environ['PATH_INFO'][1:], [('Content-Type', 'application/json'),
+                                                  ('ETag', '"1"')])
+        return iter([b'[', b'"spam",' * 1000, b'"eggs"]'])
+
+    wrapped = CompressionMiddleware(app, min_size=16)
+    sent = {}
+
+    def start_response(status, headers, exc_info=None):  # pylint:disable=unused-argument
+        sent['headers'] = dict(headers)
+
+    for coding, wbits in (('gzip', 16 + zlib.MAX_WBITS), ('deflate', zlib.MAX_WBITS)):
+        environ = {'PATH_INFO': '/200 OK', 'HTTP_ACCEPT_ENCODING': coding}
+        body = b''.join(wrapped(environ, start_response))
+        assert sent['headers']['Content-Encoding'] == coding
+        assert sent['headers']['Vary'] == 'Accept-Encoding'
+        assert sent['headers']['ETag'] == '"1-%s"' % coding
+        assert len(body) < 1000
+        assert zlib.decompress(body, wbits) == b'[' + b'"spam",' * 1000 + b'"eggs"]'
+
+    body = b''.join(wrapped({'PATH_INFO': '/304 Not Modified', 'HTTP_ACCEPT_ENCODING': 'gzip'},
+                            start_response))
+    assert 'Content-Encoding' not in sent['headers']
+    body = b''.join(wrapped({'PATH_INFO': '/200 OK'}, start_response))
+    assert 'Content-Encoding' not in sent['headers'] and body.startswith(b'["spam"')
+    assert sent['headers']['Vary'] == 'Accept-Encoding' and sent['headers']['ETag'] == '"1"'
+
+    async def run():
+        # the thread pool container streams it out chunked
+        container = ThreadPoolWSGIContainer(wrapped, threads=1)
+        sockets = bind_sockets(0, '127.0.0.1')
+        server = HTTPServer(container)
+        server.add_sockets(sockets)
+        url = 'http://127.0.0.1:%d/200%%20OK' % sockets[0].getsockname()[1]
+        response = await AsyncHTTPClient().fetch(url, decompress_response=True)
+        assert response.headers['Transfer-Encoding'] == 'chunked'
+        assert response.body.endswith(b'"eggs"]')
+        server.stop()
+        container.shutdown()
+
+    run_async(run())
+
+
+def test_async_statement(tmpdir):
+    async_operations = pytest.importorskip('python_model_service.api.async_operations')
+    pytest.importorskip('aiosqlite')
+
+    database = str(tmpdir.join('async.db'))
+    engine = orm.make_engine('sqlite:///' + database)
+    session = sessionmaker(bind=engine, expire_on_commit=False)()
+    variant = Variant(id=uuid.uuid4(), chromosome='1', start=100, ref='A', alt='T', name='rs1')
+    session.add(variant)
+    session.commit()
+
+    ser = serializer(Variant)
+    query = Query(ser.columns).filter(Variant.id == variant.id)
+    statement = async_operations.Statement(query, engine.dialect)
+
+    async def run():
+        db = async_operations.AsyncDB(database, size=1)
+        rows = await db.fetch(statement)
+        await db.close()
+        return rows
+
+    rows = run_async(run())
+    assert [ser(row) for row in rows] == [ser.from_object(variant)]
+
+
+def test_metrics():
+    metrics = Metrics()
+    with metrics.track('get_variants') as tracker:
+        assert metrics.in_flight['get_variants'] == 1
+        metrics.add_db_time(0.002)
+        tracker.status = 404
+    with pytest.raises(RuntimeError):
+        with metrics.track('get_variants'):
+            raise RuntimeError('failed')
+    metrics.register_collector(lambda: [('cache_size', 'gauge', 'Cached objects', 7)])
+
+    lines = metrics.render().splitlines()
+    assert 'model_service_requests_total{operation="get_variants",code="404"} 1' in lines
+    assert 'model_service_requests_total{operation="get_variants",code="500"} 1' in lines
+    assert 'model_service_requests_in_flight{operation="get_variants"} 0' in lines
+    assert 'model_service_request_duration_seconds_count{operation="get_variants"} 2' in lines
+    bucket = 'model_service_db_duration_seconds_bucket{operation="get_variants",le="%s"} %d'
+    assert bucket % ('0.001', 1) in lines
+    assert bucket % ('0.0025', 2) in lines
+    assert bucket % ('+Inf', 2) in lines
+    assert '# TYPE model_service_cache_size gauge' in lines
+    assert 'model_service_cache_size 7' in lines
+
+
+def test_etags():
+    etag = etags.object_etag(3)
+    assert etags.not_modified('"2", "3"', etag)
+    assert etags.not_modified('W/"3"', etag)            # weak comparison
+    assert etags.not_modified('*', etag)
+    assert not etags.not_modified('"2"', etag)
+    assert not etags.not_modified(None, etag)
+
+    assert etags.matching_versions(None) is None
+    assert etags.matching_versions('*') is None
+    assert etags.matching_versions('"3", W/"4", "x"') == [3]   # strong tags only
+
+    # a compressed representation has its own tag, but matches the same
+    gzipped = etags.encoded_etag(etag, 'gzip')
+    assert gzipped == '"3-gzip"'
+    assert etags.not_modified(gzipped, etag)
+    assert etags.matching_versions(gzipped) == [3]
+    assert etags.not_modified_etag(etag, 'gzip', gzipped) == gzipped
+    assert etags.not_modified_etag(etag, 'gzip', etag) == etag
+    assert etags.not_modified_etag(etag, None, gzipped) == etag
+
+    ids = [uuid.uuid4(), uuid.uuid4()]
+    page = etags.list_etag([(ids[0], 1), (ids[1], 1)], 0, 1)
+    assert page == etags.list_etag([(ids[0], 1), (ids[1], 1)], 0, 1)
+    assert page != etags.list_etag([(ids[0], 1), (ids[1], 2)], 0, 1)
+    assert page != etags.list_etag([(ids[0], 1)], 0, 1)
+    assert page != etags.list_etag([(ids[0], 1), (ids[1], 1)], 0, 1, link='<...>; rel="next"')
+
+
+def test_genotype_matrix():
+    ser = serializer(Variant)
+    inds = sorted(uuid.uuid4() for _ in range(3))
+    variants = [Variant(id=uuid.uuid4(), chromosome='1', start=start, ref='A', alt='T')
+                for start in (100, 200)]
+
+    def row(variant, ind_id, genotype):
+        return tuple(getattr(variant, key) for key in ser.keys) + (ind_id, genotype)
+
+    # joined rows, ordered by variant; the second variant has no calls
+    rows = [row(variants[0], inds[2], '0/1'), row(variants[0], inds[0], '1/1'),
+            row(variants[1], None, None)]
+
+    matrix = _genotype_matrix(rows, ser)
+    assert matrix['individuals'] == [str(inds[0]), str(inds[2])]
+    assert [variant['start'] for variant in matrix['variants']] == [100, 200]
+    assert matrix['genotypes'] == [['1/1', None], ['0/1', None]]
+
+    matrix = _genotype_matrix(rows, ser, individual_ids=[inds[2], inds[1]], sparse=True)
+    assert matrix['individuals'] == [str(inds[2]), str(inds[1])]
+    assert matrix['calls'] == {'rows': [0], 'columns': [0], 'genotypes': ['0/1']}